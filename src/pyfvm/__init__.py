@@ -1,18 +1,64 @@
-from . import fvm_problem, linear_fvm_problem
+from . import fvm_problem, linear_fvm_problem, schwarz, structured
 from .__about__ import __version__
+from .adjoint import AdjointSolver
+from .autodiff import AutodiffProblem
 from .discretize import discretize
 from .discretize_linear import discretize_linear, split
+from .discretize_system import discretize_system
+from .finite_differences import FiniteDifferenceJacobian
 from .fvm_matrix import get_fvm_matrix
-from .nonlinear_methods import newton
+from .linear_solvers import MixedPrecisionSolver, SolverContext
+from .mesh_batch import MeshBatch
+from .multigrid import AgglomerationMultigrid
+from .nonlinear_methods import (
+    SolverReport,
+    anderson,
+    inexact_newton,
+    jfnk,
+    newton,
+    pseudo_arclength,
+    pseudo_transient,
+)
+from .nullspace import DeflatedSolver, constant_mode, gauge_mode
+from .preconditioners import get_block_jacobi_preconditioner, get_jacobi_preconditioner
+from .recycling import RecyclingGmres
+from .schwarz import SchwarzPreconditioner
+from .sparsity import CsrBatch
+from .wirtinger import WirtingerOperator
 
 __all__ = [
     "__version__",
     "discretize",
     "discretize_linear",
+    "discretize_system",
     "split",
     "newton",
+    "inexact_newton",
+    "jfnk",
+    "anderson",
+    "pseudo_transient",
+    "pseudo_arclength",
+    "AdjointSolver",
+    "SolverReport",
+    "SolverContext",
+    "MixedPrecisionSolver",
+    "RecyclingGmres",
+    "DeflatedSolver",
+    "constant_mode",
+    "gauge_mode",
     "fvm_problem",
     "linear_fvm_problem",
+    "schwarz",
+    "structured",
     "get_fvm_matrix",
+    "FiniteDifferenceJacobian",
+    "AutodiffProblem",
+    "get_jacobi_preconditioner",
+    "get_block_jacobi_preconditioner",
+    "AgglomerationMultigrid",
+    "SchwarzPreconditioner",
+    "CsrBatch",
+    "WirtingerOperator",
+    "MeshBatch",
     "EdgeMatrixKernel",
 ]
@@ -0,0 +1,141 @@
+import numpy as np
+from scipy import sparse
+from scipy.sparse import linalg
+
+from .linear_solvers import krylov_solve
+from .wirtinger import WirtingerOperator, from_real, to_real
+
+
+class AdjointSolver:
+    """Gradients of scalar objectives J(u, lambda) at solutions u of F(u, lambda) = 0
+    with respect to the (vector) parameter of a discretized problem (see the
+    `num_parameters` argument of `discretize`).
+
+    With the adjoint state psi from J_u(u)^H psi = dJ/du, the gradient is
+    dJ/dlambda - psi^H dF/dlambda: one linear solve with the adjoint Jacobian,
+    independent of the number of parameters, plus one evaluation of the compiled
+    parameter derivatives. For real problems, ^H is the transpose. If the residual
+    has conj() or abs() terms of complex unknowns, the Jacobian is only
+    real-linear (a `WirtingerOperator`); then, the adjoint of its real form is
+    used, dJ/du is dJ/dRe(u) + i dJ/dIm(u), and the gradient is
+    dJ/dlambda - Re(psi^H dF/dlambda).
+
+    Pass the `linear_solver` of the forward solve (a `SolverContext` with
+    `method="lu"`) to reuse its factorization. It usually belongs to the Jacobian
+    of the second-to-last Newton iterate, so the adjoint system is solved with
+    GMRES preconditioned by the adjoint factors, which takes one or two
+    iterations close to the solution. Without a factorization to reuse, the
+    Jacobian is factored once and kept for the next solves: as is at the same `u`,
+    and as a preconditioner at others until a solve needs `rebuild_iterations`
+    GMRES iterations more than the first one with it, or after `max_age` reuses
+    (cf. `SolverContext`).
+    """
+
+    def __init__(
+        self,
+        problem,
+        jacobian,
+        linear_solver=None,
+        rtol=1.0e-12,
+        rebuild_iterations=10,
+        max_age=None,
+    ):
+        self.problem = problem
+        self.jacobian = jacobian
+        self.linear_solver = linear_solver
+        self.rtol = rtol
+        self.rebuild_iterations = rebuild_iterations
+        self.max_age = max_age
+        self.num_factorizations = 0
+        self.num_linear_iterations = 0
+        self._lu = None
+        # the state and parameter the kept factorization belongs to
+        self._lu_state = None
+        self._age = 0
+        self._is_stale = False
+        self._base_iterations = None
+
+    def solve(self, u, rhs, lmbda=None):
+        """Solve J_u(u)^H psi = rhs for the adjoint state psi."""
+        return self._solve(u, rhs, lmbda)[0]
+
+    def _solve(self, u, rhs, lmbda):
+        """The adjoint state and whether the Jacobian is only real-linear."""
+        J = self.jacobian.get_linear_operator(u, lmbda=lmbda)
+        if isinstance(J, WirtingerOperator):
+            psi = self._solve_matrix(J.get_real_matrix(), to_real(rhs), u, lmbda)
+            return from_real(psi), True
+        return self._solve_matrix(sparse.csr_matrix(J), rhs, u, lmbda), False
+
+    def _solve_matrix(self, matrix, rhs, u, lmbda):
+        lu = getattr(self.linear_solver, "lu", None)
+        if lu is None or lu.shape != matrix.shape:
+            if self._is_current(u, lmbda):
+                return self._lu.solve(rhs, trans="H")
+            lu = self._lu if self._is_reusable(matrix) else None
+        if lu is None:
+            return self._factor(matrix, u, lmbda).solve(rhs, trans="H")
+
+        def precondition(b):
+            return lu.solve(b, trans="H")
+
+        M = linalg.LinearOperator(matrix.shape, matvec=precondition, dtype=lu.L.dtype)
+        psi, info, num_iterations = krylov_solve(
+            "gmres", matrix.conj().T, rhs, self.rtol, M=M, x0=precondition(rhs)
+        )
+        self.num_linear_iterations += num_iterations
+        if info != 0:
+            # The factorization is too far off; refactor.
+            return self._factor(matrix, u, lmbda).solve(rhs, trans="H")
+
+        if lu is self._lu:
+            self._age += 1
+            if self._base_iterations is None:
+                self._base_iterations = num_iterations
+            elif num_iterations > self._base_iterations + self.rebuild_iterations:
+                self._is_stale = True
+        return psi
+
+    def _factor(self, matrix, u, lmbda):
+        self._lu = linalg.splu(sparse.csc_matrix(matrix))
+        self._lu_state = (u.copy(), None if lmbda is None else np.copy(lmbda))
+        self._age = 0
+        self._is_stale = False
+        self._base_iterations = None
+        self.num_factorizations += 1
+        return self._lu
+
+    def _is_current(self, u, lmbda):
+        if self._lu_state is None:
+            return False
+        u_lu, lmbda_lu = self._lu_state
+        if (lmbda is None) != (lmbda_lu is None):
+            return False
+        return np.array_equal(u, u_lu) and (
+            lmbda is None or np.array_equal(lmbda, lmbda_lu)
+        )
+
+    def _is_reusable(self, matrix):
+        return (
+            self._lu is not None
+            and self._lu.shape == matrix.shape
+            and not self._is_stale
+            and (self.max_age is None or self._age < self.max_age)
+        )
+
+    def get_gradient(self, u, dJdu, dJdlmbda=None, lmbda=None):
+        """The gradient of the objective with respect to the parameter at the
+        solution `u`, given the partial derivatives of the objective `dJdu` (with
+        respect to the state, an array of the size of `u`) and `dJdlmbda` (with
+        respect to the parameter; zero by default).
+        """
+        if lmbda is None:
+            lmbda = self.problem.lmbda
+        psi, is_real_linear = self._solve(u, dJdu, lmbda)
+        dfdl = self.problem.eval_parameter_derivative(u, lmbda)
+        gradient = -(dfdl @ psi.conj())
+        if is_real_linear:
+            gradient = gradient.real
+        if dJdlmbda is not None:
+            gradient = gradient + np.asarray(dJdlmbda)
+        return gradient
@@ -2,7 +2,15 @@ import numpy as np
 import sympy
 
 from . import form_language, fvm_problem, jacobian
-from .discretize_linear import _discretize_edge_integral
+from .discretize_linear import (
+    _call_with_parameter,
+    _discretize_edge_integral,
+    _get_edge_integrand,
+    _run_tasks,
+    _stack_kernel_output,
+)
+from .sparsity import cast_data
+from .structured import get_mesh_stencil
 
 
 class EdgeKernel:
@@ -11,27 +19,30 @@ class EdgeKernel:
         self.subdomains = [None]
         return
 
-    def eval(self, u, mesh, cell_ids):
+    def eval(self, u, mesh, cell_ids, lmbda=None, dtype=None):
+        """Returns the edge contributions of shape (..., 2, *nec.shape[1:]) (or, for
+        Jacobian kernels, (..., 2, 2, *nec.shape[1:])), where the leading axes are
+        the batch axes of `u`. With `dtype`, e.g., `np.float32`, the kernel is
+        evaluated in that precision.
+        """
         node_edge_face_cells = mesh.idx[-1][..., cell_ids]
-        X = mesh.points[node_edge_face_cells]
+        u = cast_data(u, dtype)
+        X = cast_data(mesh.points, dtype)[node_edge_face_cells]
         x0 = X[..., 0]
         x1 = X[..., 1]
-        edge_ce_ratio = mesh.ce_ratios[..., cell_ids]
-        edge_length = np.sqrt(mesh.ei_dot_ei[..., cell_ids])
-        zero = np.zeros(node_edge_face_cells.shape)
-        return (
-            np.array(
-                self.val(
-                    u[node_edge_face_cells[0]],
-                    u[node_edge_face_cells[1]],
-                    x0,
-                    x1,
-                    edge_ce_ratio,
-                    edge_length,
-                )
-            )
-            + zero
+        edge_ce_ratio = cast_data(mesh.ce_ratios[..., cell_ids], dtype)
+        edge_length = np.sqrt(cast_data(mesh.ei_dot_ei[..., cell_ids], dtype))
+        vals = self.val(
+            u[..., node_edge_face_cells[0]],
+            u[..., node_edge_face_cells[1]],
+            x0,
+            x1,
+            edge_ce_ratio,
+            edge_length,
+            lmbda,
         )
+        shape = u.shape[:-1] + node_edge_face_cells.shape[1:]
+        return _stack_kernel_output(vals, shape, node_edge_face_cells.ndim - 1)
 
 
 class VertexKernel:
@@ -40,11 +51,12 @@ class VertexKernel:
         self.subdomains = [None]
         return
 
-    def eval(self, u, mesh, vertex_ids):
-        control_volumes = mesh.control_volumes[vertex_ids]
-        X = mesh.points[vertex_ids].T
-        zero = np.zeros(len(control_volumes))
-        return self.val(u, control_volumes, X) + zero
+    def eval(self, u, mesh, vertex_ids, lmbda=None, dtype=None):
+        control_volumes = cast_data(mesh.control_volumes[vertex_ids], dtype)
+        X = cast_data(mesh.points[vertex_ids].T, dtype)
+        u = cast_data(u[..., vertex_ids], dtype)
+        zero = np.zeros(len(control_volumes), dtype=control_volumes.dtype)
+        return self.val(u, control_volumes, X, lmbda) + zero
 
 
 class FaceKernel:
@@ -53,11 +65,11 @@ class FaceKernel:
         self.subdomain = subdomain
         return
 
-    def eval(self, u, mesh, cell_face_nodes):
-        face_areas = mesh.get_face_areas(cell_face_nodes)
-        X = mesh.points[cell_face_nodes].T
-        zero = np.zeros(len(cell_face_nodes))
-        return self.val(u, face_areas, X) + zero
+    def eval(self, u, mesh, cell_face_nodes, lmbda=None, dtype=None):
+        face_areas = cast_data(mesh.get_face_areas(cell_face_nodes), dtype)
+        X = cast_data(mesh.points[cell_face_nodes].T, dtype)
+        zero = np.zeros(len(cell_face_nodes), dtype=face_areas.dtype)
+        return self.val(cast_data(u, dtype), face_areas, X, lmbda) + zero
 
 
 class DirichletKernel:
@@ -66,156 +78,323 @@ class DirichletKernel:
         self.subdomain = subdomain
         return
 
-    def eval(self, u, mesh, vertex_mask):
-        assert len(u) == np.sum(vertex_mask)
+    def eval(self, u, mesh, vertex_mask, lmbda=None):
+        # `vertex_mask` can also be an index array
         X = mesh.points[vertex_mask].T
-        zero = np.zeros(np.sum(vertex_mask))
-        return self.val(u, X) + zero
+        assert u.shape[-1] == X.shape[1]
+        zero = np.zeros(X.shape[1])
+        return self.val(u, X, lmbda) + zero
 
 
-def discretize(obj, mesh):
-    u = sympy.Function("u")
+def discretize(
+    obj, mesh, lmbda=None, structured=False, processes=None, num_parameters=None
+):
+    """Discretize the nonlinear problem `obj` on `mesh`; returns the residual
+    `FvmProblem` and its `Jacobian`.
 
-    lmbda = sympy.Function("lambda")
-    try:
-        res = obj.apply(u, lmbda)
-    except TypeError:
-        res = obj.apply(u)
+    If `obj.apply` takes a parameter, `apply(u, lmbda)` (likewise
+    `dirichlet(u, lmbda)`), its value is given by `lmbda`; it can also be passed to
+    `FvmProblem.eval()` and `Jacobian.get_linear_operator()`. The derivative of the
+    residual with respect to the parameter is compiled as well; see
+    `FvmProblem.eval_parameter_derivative()`. Without `lmbda`, `apply` gets the
+    undefined sympy function `lambda` instead, as in earlier versions.
+
+    With `num_parameters`, the parameter is a vector of that length instead, which
+    `apply` indexes as `lmbda[0]`, `lmbda[1]`,...; the derivatives with respect to
+    all of its components are compiled, e.g., for adjoint gradients.
+
+    With `structured=True` (or `"auto"` if the mesh is detected to be structured),
+    residual edge contributions are added without `np.add.at` and the Jacobian is
+    assembled in DIA format; see `discretize_linear`.
+
+    With `processes`, the symbolic work for the integrals and Dirichlet conditions
+    is spread over a pool of that many processes.
+
+    For coupled systems of several fields, see `discretize_system`.
+    """
+    u = sympy.Function("u")
 
-    # res = obj.apply(u)
+    lmbda_symbol, lmbda_arg, parameters = _get_parameter_symbols(lmbda, num_parameters)
+    res = _call_with_parameter(obj.apply, u, lmbda_arg)
 
     # See <http://docs.sympy.org/dev/modules/utilities/lambdify.html>.
     a2a = [{"ImmutableMatrix": np.array}, "numpy"]
 
-    edge_kernels = set()
-    vertex_kernels = set()
-    face_kernels = set()
+    # The integrands are user callables that cannot be sent to other processes;
+    # evaluate them here. The symbolic work (simplify, diff,...) is independent for
+    # every integral and can be done in parallel.
+    x = sympy.DeferredVector("x")
+    tasks = []
+    for integral in res.integrals:
+        if isinstance(integral.measure, form_language.ControlVolumeSurface):
+            expr = _get_edge_integrand(integral.integrand)
+            tasks.append((_compile_edge_integral, (expr, u, parameters)))
+        elif isinstance(integral.measure, form_language.ControlVolume):
+            tasks.append(
+                (_compile_vertex_integral, (integral.integrand(x), u, parameters))
+            )
+        else:
+            assert isinstance(integral.measure, form_language.CellSurface)
+            tasks.append(
+                (_compile_face_integral, (integral.integrand(x), u, parameters))
+            )
+
+    subdomains = len(tasks) * [None]
+    dirichlet = getattr(obj, "dirichlet", None)
+    if callable(dirichlet):
+        for f, subdomain in _call_with_parameter(dirichlet, u, lmbda_arg):
+            tasks.append((_compile_dirichlet, (f(x), u, parameters)))
+            subdomains.append(subdomain)
+
+    results = _run_tasks(tasks, processes)
+
+    # For every kind of integral, the kernels of the residual, the Jacobian, the
+    # conj() part of the Jacobian, and the derivatives with respect to the
+    # parameter(s); cf. the outputs of the _compile_* functions.
+    num_kernel_sets = 3 + len(parameters)
+    edge_kernels = [set() for _ in range(num_kernel_sets)]
+    vertex_kernels = [set() for _ in range(num_kernel_sets)]
+    face_kernels = [set() for _ in range(num_kernel_sets)]
+    dirichlet_kernels = [set() for _ in range(num_kernel_sets)]
     edge_matrix_kernels = set()
     # vertex_matrix_kernels = set()
     # boundary_matrix_kernels = set()
 
-    jacobian_edge_kernels = set()
-    jacobian_vertex_kernels = set()
-    jacobian_face_kernels = set()
-
-    for integral in res.integrals:
-        if isinstance(integral.measure, form_language.ControlVolumeSurface):
-            # discretization
+    uk0 = sympy.Symbol("uk0")
+    for (fun, _), exprs, subdomain in zip(tasks, results, subdomains):
+        if fun is _compile_edge_integral:
+            uk1 = sympy.Symbol("uk1")
             x0 = sympy.Symbol("x0")
             x1 = sympy.Symbol("x1")
             el = sympy.Symbol("edge_length")
             er = sympy.Symbol("edge_ce_ratio")
-            expr, index_vars = _discretize_edge_integral(
-                integral.integrand, x0, x1, el, er, [u]
-            )
-            expr = sympy.simplify(expr)
+            args = (uk0, uk1, x0, x1, er, el, lmbda_symbol)
+            for kernels, expr in zip(edge_kernels, exprs):
+                kernels.add(EdgeKernel(sympy.lambdify(args, expr, modules=a2a)))
 
-            # Turn edge around
-            uk0 = index_vars[0][0]
-            uk1 = index_vars[0][1]
-            expr_turned = expr.subs(
-                {uk0: uk1, uk1: uk0, x0: x1, x1: x0}, simultaneous=True
-            )
+        elif fun is _compile_vertex_integral:
+            args = (uk0, sympy.Symbol("control_volume"), x, lmbda_symbol)
+            for kernels, expr in zip(vertex_kernels, exprs):
+                kernels.add(VertexKernel(sympy.lambdify(args, expr, modules=a2a)))
 
-            val = sympy.lambdify(
-                (uk0, uk1, x0, x1, er, el), [expr, expr_turned], modules=a2a
-            )
-            edge_kernels.add(EdgeKernel(val))
+        elif fun is _compile_face_integral:
+            args = (uk0, sympy.Symbol("face_area"), x, lmbda_symbol)
+            for kernels, expr in zip(face_kernels, exprs):
+                kernels.add(FaceKernel(sympy.lambdify(args, expr, modules=a2a)))
 
-            # Linearization
-            expr_lin0 = [sympy.diff(expr, var) for var in [uk0, uk1]]
-            expr_lin1 = [sympy.diff(expr_turned, var) for var in [uk0, uk1]]
-            val_lin = sympy.lambdify(
-                (uk0, uk1, x0, x1, er, el), [expr_lin0, expr_lin1], modules=a2a
-            )
+        else:
+            assert fun is _compile_dirichlet
+            args = (uk0, x, lmbda_symbol)
+            for kernels, expr in zip(dirichlet_kernels, exprs):
+                val = sympy.lambdify(args, expr, modules=a2a)
+                kernels.add(DirichletKernel(val, subdomain))
+
+    stencil = get_mesh_stencil(mesh, structured)
+
+    parameter_derivatives = [
+        fvm_problem.FvmProblem(
+            mesh,
+            edge,
+            vertex,
+            face,
+            dirichlet,
+            [],
+            [],
+            [],
+            stencil=stencil,
+            lmbda=lmbda,
+        )
+        for edge, vertex, face, dirichlet in zip(
+            edge_kernels[3:],
+            vertex_kernels[3:],
+            face_kernels[3:],
+            dirichlet_kernels[3:],
+        )
+    ]
+    if num_parameters is not None:
+        parameter_derivative = parameter_derivatives
+    elif parameters:
+        parameter_derivative = parameter_derivatives[0]
+    else:
+        parameter_derivative = None
+
+    residual = fvm_problem.FvmProblem(
+        mesh,
+        edge_kernels[0],
+        vertex_kernels[0],
+        face_kernels[0],
+        dirichlet_kernels[0],
+        edge_matrix_kernels,
+        [],
+        [],
+        stencil=stencil,
+        lmbda=lmbda,
+        parameter_derivative=parameter_derivative,
+    )
 
-            jacobian_edge_kernels.add(EdgeKernel(val_lin))
+    # Residuals with conj(u), abs(u),... are only real-differentiable; their
+    # Jacobian has a part acting on conj(phi).
+    conjugate = None
+    if not all(_is_zero(exprs[2]) for exprs in results):
+        conjugate = jacobian.Jacobian(
+            mesh,
+            edge_kernels[2],
+            vertex_kernels[2],
+            face_kernels[2],
+            dirichlet_kernels[2],
+            stencil=stencil,
+            lmbda=lmbda,
+        )
 
-        elif isinstance(integral.measure, form_language.ControlVolume):
-            x = sympy.DeferredVector("x")
+    jac = jacobian.Jacobian(
+        mesh,
+        edge_kernels[1],
+        vertex_kernels[1],
+        face_kernels[1],
+        dirichlet_kernels[1],
+        stencil=stencil,
+        lmbda=lmbda,
+        conjugate=conjugate,
+    )
 
-            fx = integral.integrand(x)
+    return residual, jac
 
-            # discretization
-            uk0 = sympy.Symbol("uk0")
-            try:
-                expr = fx.subs(u(x), uk0)
-            except AttributeError:  # 'float' object has no
-                expr = fx
-            control_volume = sympy.Symbol("control_volume")
-            expr *= control_volume
 
-            val = sympy.lambdify((uk0, control_volume, x), expr, modules=a2a)
+def _get_parameter_symbols(lmbda, num_parameters):
+    """The parameter symbol of the kernels, the argument for `apply(u, lmbda)`, and
+    the symbols to differentiate with respect to.
+    """
+    if num_parameters is not None:
+        # "lambda" is a Python keyword and can't be an array argument of lambdify
+        lmbda_symbol = sympy.DeferredVector("lmbda")
+        return (
+            lmbda_symbol,
+            lmbda_symbol,
+            [lmbda_symbol[k] for k in range(num_parameters)],
+        )
 
-            vertex_kernels.add(VertexKernel(val))
+    lmbda_symbol = sympy.Symbol("lambda")
+    if lmbda is not None:
+        return lmbda_symbol, lmbda_symbol, [lmbda_symbol]
 
-            # Linearization
-            expr_lin = sympy.diff(expr, uk0)
-            val_lin = sympy.lambdify((uk0, control_volume, x), expr_lin, modules=a2a)
-            jacobian_vertex_kernels.add(VertexKernel(val_lin))
+    # Without a parameter value, `apply(u, lmbda)` gets the undefined function
+    # `lambda` as it always did, and there is no derivative to compile.
+    return lmbda_symbol, sympy.Function("lambda"), []
 
-        else:
-            assert isinstance(integral.measure, form_language.CellSurface)
-            x = sympy.DeferredVector("x")
-            fx = integral.integrand(x)
 
-            # discretization
-            uk0 = sympy.Symbol("uk0")
-            try:
-                expr = fx.subs(u(x), uk0)
-            except AttributeError:  # 'float' object has no
-                expr = fx
-            face_area = sympy.Symbol("face_area")
-            expr *= face_area
+def _compile_edge_integral(expr, u, parameters):
+    # discretization
+    x0 = sympy.Symbol("x0")
+    x1 = sympy.Symbol("x1")
+    el = sympy.Symbol("edge_length")
+    er = sympy.Symbol("edge_ce_ratio")
+    expr, index_vars = _discretize_edge_integral(expr, x0, x1, el, er, [u])
+    expr = sympy.simplify(expr)
 
-            val = sympy.lambdify((uk0, face_area, x), expr, modules=a2a)
+    # Turn edge around
+    uk0 = index_vars[0][0]
+    uk1 = index_vars[0][1]
+    expr_turned = expr.subs({uk0: uk1, uk1: uk0, x0: x1, x1: x0}, simultaneous=True)
 
-            face_kernels.add(FaceKernel(val))
+    # Linearization
+    d0 = [_wirtinger_diff(expr, var) for var in [uk0, uk1]]
+    d1 = [_wirtinger_diff(expr_turned, var) for var in [uk0, uk1]]
+    expr_lin = [[d[0] for d in d0], [d[0] for d in d1]]
+    expr_lin_conj = [[d[1] for d in d0], [d[1] for d in d1]]
 
-            # Linearization
-            expr_lin = sympy.diff(expr, uk0)
-            val_lin = sympy.lambdify((uk0, face_area, x), expr_lin, modules=a2a)
-            jacobian_face_kernels.add(FaceKernel(val_lin))
+    # Derivatives with respect to the parameters
+    expr_dlmbda = [
+        [sympy.diff(expr, p), sympy.diff(expr_turned, p)] for p in parameters
+    ]
 
-    dirichlet_kernels = set()
-    jacobian_dirichlet_kernels = set()
-    dirichlet = getattr(obj, "dirichlet", None)
-    if callable(dirichlet):
-        u = sympy.Function("u")
-        x = sympy.DeferredVector("x")
-        for f, subdomain in dirichlet(u):
-            uk0 = sympy.Symbol("uk0")
-            try:
-                expr = f(x).subs(u(x), uk0)
-            except AttributeError:  # 'float' object has no
-                expr = fx
+    return [[expr, expr_turned], expr_lin, expr_lin_conj] + expr_dlmbda
 
-            val = sympy.lambdify((uk0, x), expr, modules=a2a)
 
-            dirichlet_kernels.add(DirichletKernel(val, subdomain))
+def _compile_vertex_integral(fx, u, parameters):
+    x = sympy.DeferredVector("x")
 
-            # Linearization
-            expr_lin = sympy.diff(expr, uk0)
-            val_lin = sympy.lambdify((uk0, x), expr_lin, modules=a2a)
-            jacobian_dirichlet_kernels.add(DirichletKernel(val_lin, subdomain))
+    # discretization
+    uk0 = sympy.Symbol("uk0")
+    try:
+        expr = fx.subs(u(x), uk0)
+    except AttributeError:  # 'float' object has no
+        expr = fx
+    control_volume = sympy.Symbol("control_volume")
+    expr *= control_volume
 
-    residual = fvm_problem.FvmProblem(
-        mesh,
-        edge_kernels,
-        vertex_kernels,
-        face_kernels,
-        dirichlet_kernels,
-        edge_matrix_kernels,
-        [],
-        [],
-    )
+    # Linearization
+    expr_lin, expr_lin_conj = _wirtinger_diff(expr, uk0)
 
-    jac = jacobian.Jacobian(
-        mesh,
-        jacobian_edge_kernels,
-        jacobian_vertex_kernels,
-        jacobian_face_kernels,
-        jacobian_dirichlet_kernels,
-    )
+    expr_dlmbda = [sympy.diff(expr, p) for p in parameters]
 
-    return residual, jac
+    return [expr, expr_lin, expr_lin_conj] + expr_dlmbda
+
+
+def _compile_face_integral(fx, u, parameters):
+    x = sympy.DeferredVector("x")
+
+    # discretization
+    uk0 = sympy.Symbol("uk0")
+    try:
+        expr = fx.subs(u(x), uk0)
+    except AttributeError:  # 'float' object has no
+        expr = fx
+    face_area = sympy.Symbol("face_area")
+    expr *= face_area
+
+    # Linearization
+    expr_lin, expr_lin_conj = _wirtinger_diff(expr, uk0)
+
+    expr_dlmbda = [sympy.diff(expr, p) for p in parameters]
+
+    return [expr, expr_lin, expr_lin_conj] + expr_dlmbda
+
+
+def _compile_dirichlet(fx, u, parameters):
+    x = sympy.DeferredVector("x")
+
+    uk0 = sympy.Symbol("uk0")
+    try:
+        expr = fx.subs(u(x), uk0)
+    except AttributeError:  # 'float' object has no
+        expr = fx
+
+    # Linearization
+    expr_lin, expr_lin_conj = _wirtinger_diff(expr, uk0)
+
+    expr_dlmbda = [sympy.diff(expr, p) for p in parameters]
+
+    return [expr, expr_lin, expr_lin_conj] + expr_dlmbda
+
+
+def _wirtinger_diff(expr, var):
+    """The Wirtinger derivatives d/dz and d/dconj(z) of `expr` with respect to the
+    complex variable z = `var`, with z and conj(z) treated as independent. For
+    holomorphic expressions, the second one is 0; for real `var`, the derivative is
+    their sum.
+    """
+    # Write abs(), re(), im() of `var` in terms of conj().
+    def has_var(e):
+        return isinstance(e, (sympy.Abs, sympy.re, sympy.im)) and e.has(var)
+
+    def rewrite(e):
+        a = e.args[0]
+        if isinstance(e, sympy.Abs):
+            return sympy.sqrt(a * sympy.conjugate(a))
+        if isinstance(e, sympy.re):
+            return (a + sympy.conjugate(a)) / 2
+        return (a - sympy.conjugate(a)) / (2 * sympy.I)
+
+    var_conj = sympy.Dummy()
+    expr = sympy.sympify(expr).replace(has_var, rewrite)
+    expr = expr.subs(sympy.conjugate(var), var_conj)
+    return [
+        sympy.diff(expr, v).subs(var_conj, sympy.conjugate(var))
+        for v in [var, var_conj]
+    ]
+
+
+def _is_zero(exprs):
+    if isinstance(exprs, (list, tuple)):
+        return all(_is_zero(e) for e in exprs)
+    return exprs == 0
@@ -1,9 +1,13 @@
+import inspect
+from concurrent.futures import ProcessPoolExecutor
+
 import numpy as np
 import sympy
 from sympy.matrices.expressions.matexpr import MatrixExpr, MatrixSymbol
 
 from . import form_language
-from .linear_fvm_problem import get_linear_fvm_problem
+from .linear_fvm_problem import get_linear_fvm_operator, get_linear_fvm_problem
+from .structured import get_mesh_stencil
 
 
 def split(expr, variables):
@@ -45,36 +49,84 @@ def split(expr, variables):
     return affine, linear, nonlinear
 
 
+def _stack_kernel_output(vals, shape, num_mesh_axes):
+    """Broadcast the nested lists of kernel values to `shape` and stack them right
+    after the batch axes. Single-precision values keep their precision.
+    """
+    if isinstance(vals, (list, tuple)):
+        axis = len(shape) - num_mesh_axes
+        return np.stack(
+            [_stack_kernel_output(v, shape, num_mesh_axes) for v in vals], axis=axis
+        )
+    dtype = np.result_type(vals)
+    if not np.issubdtype(dtype, np.inexact):
+        dtype = np.result_type(dtype, float)
+    return np.broadcast_to(vals, shape).astype(dtype)
+
+
+def _call_with_parameter(fun, u, lmbda):
+    """Call `fun(u, lmbda)`, or `fun(u)` if it doesn't take a parameter."""
+    try:
+        signature = inspect.signature(fun)
+    except (TypeError, ValueError):
+        return fun(u, lmbda)
+
+    num_positional = 0
+    for parameter in signature.parameters.values():
+        if parameter.kind == parameter.VAR_POSITIONAL:
+            return fun(u, lmbda)
+        if parameter.kind in [
+            parameter.POSITIONAL_ONLY,
+            parameter.POSITIONAL_OR_KEYWORD,
+        ]:
+            num_positional += 1
+    return fun(u, lmbda) if num_positional > 1 else fun(u)
+
+
+def _expand_parameter(lmbda, num_mesh_axes):
+    """Make an array of parameter values broadcastable against mesh data by
+    appending `num_mesh_axes` axes.
+    """
+    if lmbda is None or np.ndim(lmbda) == 0:
+        return lmbda
+    return np.reshape(lmbda, np.shape(lmbda) + num_mesh_axes * (1,))
+
+
 class EdgeLinearKernel:
-    def __init__(self, linear, affine):
+    def __init__(self, linear, affine, lmbda=None):
         self.linear = linear
         self.affine = affine
+        self.lmbda = lmbda
         self.subdomains = [None]
 
     def eval(self, mesh, cell_mask):
+        """Returns the edge matrix of shape (..., 2, 2, *nec.shape[1:]), the edge
+        right-hand side of shape (..., 2, *nec.shape[1:]), and the edge indices nec.
+        The leading axes are those of the parameter `lmbda`.
+        """
         edge_ce_ratio = mesh.ce_ratios[..., cell_mask]
         edge_length = mesh.edge_lengths[..., cell_mask]
         nec = mesh.idx[-1][..., cell_mask]
         X = mesh.points[nec]
 
-        val = self.linear(X[0], X[1], edge_ce_ratio, edge_length)
-        rhs = self.affine(X[0], X[1], edge_ce_ratio, edge_length)
+        num_mesh_axes = nec.ndim - 1
+        lmbda = _expand_parameter(self.lmbda, num_mesh_axes)
+        val = self.linear(X[0], X[1], edge_ce_ratio, edge_length, lmbda)
+        rhs = self.affine(X[0], X[1], edge_ce_ratio, edge_length, lmbda)
 
-        ones = np.ones(nec.shape[1:])
-        for i in [0, 1]:
-            rhs[i] *= ones
-            for j in [0, 1]:
-                if not isinstance(val[i][j], np.ndarray):
-                    val[i][j] *= ones
+        shape = np.shape(self.lmbda) + nec.shape[1:]
+        val = _stack_kernel_output(val, shape, num_mesh_axes)
+        rhs = _stack_kernel_output(rhs, shape, num_mesh_axes)
 
         return val, rhs, nec
 
 
 class VertexLinearKernel:
-    def __init__(self, mesh, linear, affine):
+    def __init__(self, mesh, linear, affine, lmbda=None):
         self.mesh = mesh
         self.linear = linear
         self.affine = affine
+        self.lmbda = lmbda
         self.subdomains = [None]
         return
 
@@ -82,24 +134,24 @@ class VertexLinearKernel:
         control_volumes = self.mesh.control_volumes[vertex_mask]
         X = self.mesh.points[vertex_mask].T
 
-        res0 = self.linear(control_volumes, X)
-        res1 = self.affine(control_volumes, X)
+        lmbda = _expand_parameter(self.lmbda, 1)
+        res0 = self.linear(control_volumes, X, lmbda)
+        res1 = self.affine(control_volumes, X, lmbda)
 
-        n = len(control_volumes)
-        if isinstance(res0, float):
-            res0 *= np.ones(n)
-        if isinstance(res1, float):
-            res1 *= np.ones(n)
+        shape = np.shape(self.lmbda) + control_volumes.shape
+        res0 = np.broadcast_to(res0, shape)
+        res1 = np.broadcast_to(res1, shape)
 
         return (res0, res1)
 
 
 class FaceLinearKernel:
-    def __init__(self, mesh, coeff, affine, subdomains):
+    def __init__(self, mesh, coeff, affine, subdomains, lmbda=None):
         self.mesh = mesh
         self.coeff = coeff
         self.affine = affine
         self.subdomains = subdomains
+        self.lmbda = lmbda
         return
 
     def eval(self, face_cells_inside):
@@ -119,8 +171,8 @@ class FaceLinearKernel:
         # coeff and affine can return just a float, for example.)
         zero = np.zeros(ids.shape).T
         return (
-            face_parts * (self.coeff(X.T) + zero).T,
-            face_parts * (self.affine(X.T) + zero).T,
+            face_parts * (self.coeff(X.T, self.lmbda) + zero).T,
+            face_parts * (self.affine(X.T, self.lmbda) + zero).T,
         )
 
 
@@ -134,15 +186,36 @@ class DirichletLinearKernel:
 
     def eval(self, vertex_mask):
         X = self.mesh.points[vertex_mask].T
-        zero = np.zeros(np.sum(vertex_mask))
+        zero = np.zeros(X.shape[1:])
         return (self.coeff(X) + zero, self.rhs(X) + zero)
 
 
 def _discretize_edge_integral(
-    integrand, x0, x1, edge_length, edge_ce_ratio, index_functions
+    expr, x0, x1, edge_length, edge_ce_ratio, index_functions
 ):
     discretizer = DiscretizeEdgeIntegral(x0, x1, edge_length, edge_ce_ratio)
-    return discretizer.generate(integrand, index_functions)
+    return discretizer.generate(expr, index_functions)
+
+
+def _get_edge_integrand(integrand):
+    """Evaluate the integrand at the symbolic point that DiscretizeEdgeIntegral
+    expects.
+    """
+    return integrand(sympy.MatrixSymbol("x", 3, 1))
+
+
+def _run_tasks(tasks, processes=None):
+    """Run the symbolic compilation tasks, given as (function, args) pairs. With
+    `processes`, they are distributed over a pool of that many processes. The
+    results only contain sympy expressions, so they can be sent back to the main
+    process; lambdify() must be called there.
+    """
+    if processes is None or processes <= 1 or len(tasks) < 2:
+        return [fun(*args) for fun, args in tasks]
+
+    with ProcessPoolExecutor(max_workers=processes) as executor:
+        futures = [executor.submit(fun, *args) for fun, args in tasks]
+        return [future.result() for future in futures]
 
 
 class DiscretizeEdgeIntegral:
@@ -164,6 +237,8 @@ class DiscretizeEdgeIntegral:
                 return self.visit_ChainOp(node, sympy.Add)
             elif node.is_Mul:
                 return self.visit_ChainOp(node, sympy.Mul)
+            elif node.is_Pow:
+                return self.visit_ChainOp(node, sympy.Pow)
             elif node.is_Number:
                 return node
             elif node.is_Symbol:
@@ -182,13 +257,14 @@ class DiscretizeEdgeIntegral:
         )
         return node
 
-    def generate(self, node, index_functions=None):
-        """Entrance point to this class."""
+    def generate(self, expr, index_functions=None):
+        """Entrance point to this class. `expr` is the integrand evaluated at
+        `x = sympy.MatrixSymbol("x", 3, 1)`; see `_get_edge_integrand`.
+        """
         if index_functions is None:
             index_functions = []
 
         x = sympy.MatrixSymbol("x", 3, 1)
-        expr = node(x)
 
         out = self.edge_ce_ratio * self.edge_length * self.visit(expr)
 
@@ -248,9 +324,48 @@ class DiscretizeEdgeIntegral:
         return ret
 
 
-def discretize_linear(obj, mesh):
+def discretize_linear(
+    obj,
+    mesh,
+    lmbda=None,
+    structured=False,
+    processes=None,
+    matrix_free=False,
+    dtype=None,
+):
+    """Discretize the linear problem `obj` on `mesh`; returns the matrix and the
+    right-hand side.
+
+    If `obj.apply` takes a parameter, `apply(u, lmbda)`, its value is given by
+    `lmbda`. For an array of k parameter values, all systems are assembled in one
+    vectorized pass; the result is then a `CsrBatch` (k matrices sharing one
+    sparsity pattern, data of shape (k, nnz)) and right-hand sides of shape (k, n).
+
+    With `structured=True`, the mesh must be a structured tensor-product mesh (e.g.,
+    from `meshzoo.rectangle_tri`) and the matrix is assembled directly in DIA format.
+    `structured="auto"` does so only if the mesh is detected to be structured.
+
+    With `processes`, the symbolic work for the integrals and Dirichlet conditions
+    is spread over a pool of that many processes.
+
+    With `matrix_free=True`, the matrix is returned as a `LinearOperator` that
+    evaluates the compiled kernels in every matvec, e.g., for Krylov solvers on
+    meshes where storing the matrix is too expensive. Its `diagonal()` and
+    `row_sums()` are computed from the kernels as well.
+
+    With `dtype=np.float32`, the matrix is stored in single precision (complex64
+    for complex problems), e.g., to be factored by
+    `linear_solvers.MixedPrecisionSolver`. The kernel values are cast as they are
+    computed, so the assembly runs in single precision as well. The right-hand
+    side stays in double precision.
+    """
     u = sympy.Function("u")
-    res = obj.apply(u)
+    lmbda_symbol = sympy.Symbol("lambda")
+    res = _call_with_parameter(obj.apply, u, lmbda_symbol)
+
+    if lmbda is not None:
+        lmbda = np.asarray(lmbda)
+        assert lmbda.ndim <= 1
 
     # See <http://docs.sympy.org/dev/modules/utilities/lambdify.html>. A sympy.Matrix
     # _always_ has two dimensions, meaning that even if you seemingly create a vector 'a
@@ -266,107 +381,160 @@ def discretize_linear(obj, mesh):
 
     mods = [{"ImmutableDenseMatrix": vector2vector}, "numpy"]
 
+    # The integrands are user callables that cannot be sent to other processes;
+    # evaluate them here. The symbolic work (simplify, split,...) is independent for
+    # every integral and can be done in parallel.
+    x = sympy.DeferredVector("x")
+    tasks = []
+    for integral in res.integrals:
+        if isinstance(integral.measure, form_language.ControlVolumeSurface):
+            expr = _get_edge_integrand(integral.integrand)
+            tasks.append((_compile_linear_edge_integral, (expr, u)))
+        elif isinstance(integral.measure, form_language.ControlVolume):
+            tasks.append((_compile_linear_vertex_integral, (integral.integrand(x), u)))
+        else:
+            assert isinstance(integral.measure, form_language.CellSurface)
+            tasks.append((_compile_linear_face_integral, (integral.integrand(x), u)))
+
+    subdomains = len(tasks) * [None]
+    dirichlet = getattr(obj, "dirichlet", None)
+    if callable(dirichlet):
+        for f, subdomain in dirichlet(u):
+            tasks.append((_compile_linear_dirichlet, (f(x), u)))
+            subdomains.append(subdomain)
+
+    results = _run_tasks(tasks, processes)
+
     edge_kernels = set()
     vertex_kernels = set()
     face_kernels = set()
-    for integral in res.integrals:
-        if isinstance(integral.measure, form_language.ControlVolumeSurface):
-            # discretization
+    dirichlet_kernels = set()
+    for (fun, _), (linear, affine), subdomain in zip(tasks, results, subdomains):
+        if fun is _compile_linear_edge_integral:
             x0 = sympy.Symbol("x0")
             x1 = sympy.Symbol("x1")
             el = sympy.Symbol("edge_length")
             er = sympy.Symbol("edge_ce_ratio")
-            expr, index_vars = _discretize_edge_integral(
-                integral.integrand, x0, x1, el, er, [u]
+            args = (x0, x1, er, el, lmbda_symbol)
+            l_eval = sympy.lambdify(args, linear, modules=mods)
+            a_eval = sympy.lambdify(args, affine, modules=mods)
+            edge_kernels.add(EdgeLinearKernel(l_eval, a_eval, lmbda))
+
+        elif fun is _compile_linear_vertex_integral:
+            control_volume = sympy.Symbol("control_volume")
+            args = (control_volume, x, lmbda_symbol)
+            l_eval = sympy.lambdify(args, linear, modules=mods)
+            a_eval = sympy.lambdify(args, affine, modules=mods)
+            vertex_kernels.add(VertexLinearKernel(mesh, l_eval, a_eval, lmbda))
+
+        elif fun is _compile_linear_face_integral:
+            l_eval = sympy.lambdify((x, lmbda_symbol), linear, modules=mods)
+            a_eval = sympy.lambdify((x, lmbda_symbol), affine, modules=mods)
+            face_kernels.add(
+                FaceLinearKernel(
+                    mesh, l_eval, a_eval, [form_language.Boundary()], lmbda
+                )
             )
-            expr = sympy.simplify(expr)
 
-            uk0 = index_vars[0][0]
-            uk1 = index_vars[0][1]
+        else:
+            assert fun is _compile_linear_dirichlet
+            coeff_eval = sympy.lambdify((x), linear, modules=mods)
+            rhs_eval = sympy.lambdify((x), -affine, modules=mods)
+            dirichlet_kernels.add(
+                DirichletLinearKernel(mesh, coeff_eval, rhs_eval, subdomain)
+            )
 
-            affine0, linear0, nonlinear = split(expr, [uk0, uk1])
-            assert nonlinear == 0
+    stencil = get_mesh_stencil(mesh, structured)
+
+    if matrix_free:
+        assert np.ndim(lmbda) == 0, "matrix_free needs a single parameter value"
+        return get_linear_fvm_operator(
+            mesh,
+            edge_kernels,
+            vertex_kernels,
+            face_kernels,
+            dirichlet_kernels,
+            stencil=stencil,
+        )
 
-            # Turn edge around
-            expr_turned = expr.subs(
-                {uk0: uk1, uk1: uk0, x0: x1, x1: x0}, simultaneous=True
-            )
-            affine1, linear1, nonlinear = split(expr_turned, [uk0, uk1])
-            assert nonlinear == 0
+    return get_linear_fvm_problem(
+        mesh,
+        edge_kernels,
+        vertex_kernels,
+        face_kernels,
+        dirichlet_kernels,
+        stencil=stencil,
+        batch_shape=np.shape(lmbda),
+        dtype=dtype,
+    )
 
-            linear = [[linear0[0], linear0[1]], [linear1[0], linear1[1]]]
-            affine = [affine0, affine1]
 
-            l_eval = sympy.lambdify((x0, x1, er, el), linear, modules=mods)
-            a_eval = sympy.lambdify((x0, x1, er, el), affine, modules=mods)
+def _compile_linear_edge_integral(expr, u):
+    # discretization
+    x0 = sympy.Symbol("x0")
+    x1 = sympy.Symbol("x1")
+    el = sympy.Symbol("edge_length")
+    er = sympy.Symbol("edge_ce_ratio")
+    expr, index_vars = _discretize_edge_integral(expr, x0, x1, el, er, [u])
+    expr = sympy.simplify(expr)
 
-            edge_kernels.add(EdgeLinearKernel(l_eval, a_eval))
+    uk0 = index_vars[0][0]
+    uk1 = index_vars[0][1]
 
-        elif isinstance(integral.measure, form_language.ControlVolume):
-            x = sympy.DeferredVector("x")
-            fx = integral.integrand(x)
-
-            # discretization
-            uk0 = sympy.Symbol("uk0")
-            try:
-                expr = fx.subs(u(x), uk0)
-            except AttributeError:  # 'float' object has no
-                expr = fx
-            control_volume = sympy.Symbol("control_volume")
-            expr *= control_volume
+    affine0, linear0, nonlinear = split(expr, [uk0, uk1])
+    assert nonlinear == 0
 
-            affine, linear, nonlinear = split(expr, uk0)
-            assert nonlinear == 0
+    # Turn edge around
+    expr_turned = expr.subs({uk0: uk1, uk1: uk0, x0: x1, x1: x0}, simultaneous=True)
+    affine1, linear1, nonlinear = split(expr_turned, [uk0, uk1])
+    assert nonlinear == 0
 
-            l_eval = sympy.lambdify((control_volume, x), linear, modules=mods)
-            a_eval = sympy.lambdify((control_volume, x), affine, modules=mods)
+    linear = [[linear0[0], linear0[1]], [linear1[0], linear1[1]]]
+    affine = [affine0, affine1]
+    return linear, affine
 
-            vertex_kernels.add(VertexLinearKernel(mesh, l_eval, a_eval))
 
-        else:
-            assert isinstance(integral.measure, form_language.CellSurface)
-            x = sympy.DeferredVector("x")
-            fx = integral.integrand(x)
+def _compile_linear_vertex_integral(fx, u):
+    x = sympy.DeferredVector("x")
 
-            # discretization
-            uk = sympy.Symbol("uk")
-            try:
-                expr = fx.subs(u(x), uk)
-            except AttributeError:  # 'float' object has no subs()
-                expr = fx
+    # discretization
+    uk0 = sympy.Symbol("uk0")
+    try:
+        expr = fx.subs(u(x), uk0)
+    except AttributeError:  # 'float' object has no
+        expr = fx
+    control_volume = sympy.Symbol("control_volume")
+    expr *= control_volume
 
-            affine, linear, nonlinear = split(expr, uk)
-            assert nonlinear == 0
+    affine, linear, nonlinear = split(expr, uk0)
+    assert nonlinear == 0
+    return linear, affine
 
-            l_eval = sympy.lambdify((x,), linear, modules=mods)
-            a_eval = sympy.lambdify((x,), affine, modules=mods)
 
-            face_kernels.add(
-                FaceLinearKernel(mesh, l_eval, a_eval, [form_language.Boundary()])
-            )
+def _compile_linear_face_integral(fx, u):
+    x = sympy.DeferredVector("x")
 
-    dirichlet_kernels = set()
-    dirichlet = getattr(obj, "dirichlet", None)
-    if callable(dirichlet):
-        u = sympy.Function("u")
-        x = sympy.DeferredVector("x")
-        for f, subdomain in dirichlet(u):
-            uk0 = sympy.Symbol("uk0")
-            try:
-                expr = f(x).subs(u(x), uk0)
-            except AttributeError:  # 'float' object has no
-                expr = fx
+    # discretization
+    uk = sympy.Symbol("uk")
+    try:
+        expr = fx.subs(u(x), uk)
+    except AttributeError:  # 'float' object has no subs()
+        expr = fx
 
-            affine, coeff, nonlinear = split(expr, uk0)
-            assert nonlinear == 0
+    affine, linear, nonlinear = split(expr, uk)
+    assert nonlinear == 0
+    return linear, affine
 
-            coeff_eval = sympy.lambdify((x), coeff, modules=mods)
-            rhs_eval = sympy.lambdify((x), -affine, modules=mods)
 
-            dirichlet_kernels.add(
-                DirichletLinearKernel(mesh, coeff_eval, rhs_eval, subdomain)
-            )
+def _compile_linear_dirichlet(fx, u):
+    x = sympy.DeferredVector("x")
 
-    return get_linear_fvm_problem(
-        mesh, edge_kernels, vertex_kernels, face_kernels, dirichlet_kernels
-    )
+    uk0 = sympy.Symbol("uk0")
+    try:
+        expr = fx.subs(u(x), uk0)
+    except AttributeError:  # 'float' object has no subs()
+        expr = fx
+
+    affine, coeff, nonlinear = split(expr, uk0)
+    assert nonlinear == 0
+    return coeff, affine
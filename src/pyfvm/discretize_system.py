@@ -0,0 +1,317 @@
+import npx
+import numpy as np
+import sympy
+from scipy import sparse
+
+from . import form_language
+from .discretize_linear import (
+    _call_with_parameter,
+    _discretize_edge_integral,
+    _get_edge_integrand,
+    _run_tasks,
+    _stack_kernel_output,
+)
+from .sparsity import SparsityPattern
+
+
+class SystemEdgeKernel:
+    def __init__(self, val, equation):
+        self.val = val
+        self.equation = equation
+        self.subdomains = [None]
+
+    def eval(self, u, mesh, cell_ids, lmbda=None):
+        """`u` has the fields as rows. Returns the edge contributions to the
+        equation of shape (2, *nec.shape[1:]) (or, for Jacobian kernels, the
+        derivatives with respect to all fields, (2, 2, num_fields, *nec.shape[1:])).
+        """
+        nec = mesh.idx[-1][..., cell_ids]
+        X = mesh.points[nec]
+        vals = self.val(
+            *u[:, nec[0]],
+            *u[:, nec[1]],
+            X[..., 0],
+            X[..., 1],
+            mesh.ce_ratios[..., cell_ids],
+            np.sqrt(mesh.ei_dot_ei[..., cell_ids]),
+            lmbda,
+        )
+        return _stack_kernel_output(vals, nec.shape[1:], nec.ndim - 1)
+
+
+class SystemVertexKernel:
+    def __init__(self, val, equation):
+        self.val = val
+        self.equation = equation
+        self.subdomains = [None]
+
+    def eval(self, u, mesh, vertex_ids, lmbda=None):
+        control_volumes = mesh.control_volumes[vertex_ids]
+        X = mesh.points[vertex_ids].T
+        vals = self.val(*u[:, vertex_ids], control_volumes, X, lmbda)
+        return _stack_kernel_output(vals, control_volumes.shape, 1)
+
+
+class SystemDirichletKernel:
+    def __init__(self, val, subdomain, field):
+        self.val = val
+        self.subdomain = subdomain
+        self.field = field
+
+    def eval(self, u, mesh, vertex_mask, lmbda=None):
+        X = mesh.points[vertex_mask].T
+        vals = self.val(*u[:, vertex_mask], X, lmbda)
+        return _stack_kernel_output(vals, X.shape[1:], 1)
+
+
+def discretize_system(obj, mesh, num_fields, lmbda=None, processes=None):
+    """Discretize a coupled nonlinear system of `num_fields` fields, e.g., the
+    electron and hole densities of drift-diffusion models; returns the residual
+    `FvmSystem` and its `SystemJacobian`.
+
+    `obj.apply(u)` (or `apply(u, lmbda)`) gets the list of fields and returns a list
+    of `num_fields` equations, one integral sum each; only integrals over control
+    volumes and their surfaces are supported. `obj.dirichlet(u)` returns triples
+    `(f, subdomain, k)`; `f(x) = 0` replaces equation `k` on the subdomain.
+
+    The unknowns are interleaved per vertex, i.e., field k of vertex i is at
+    position `i * num_fields + k`. The Jacobian is a `bsr_matrix` with one
+    `num_fields x num_fields` block per pair of neighboring vertices, so it stores
+    one column index per block, and its diagonal blocks can be used for block
+    Jacobi (`get_block_jacobi_preconditioner`).
+    """
+    fields = [sympy.Function(f"u{k}") for k in range(num_fields)]
+
+    lmbda_symbol = sympy.Symbol("lambda")
+    equations = _call_with_parameter(obj.apply, fields, lmbda_symbol)
+    assert len(equations) == num_fields, "need one equation per field"
+
+    a2a = [{"ImmutableMatrix": np.array}, "numpy"]
+
+    x = sympy.DeferredVector("x")
+    tasks = []
+    kinds = []
+    for k, equation in enumerate(equations):
+        for integral in equation.integrals:
+            if isinstance(integral.measure, form_language.ControlVolumeSurface):
+                expr = _get_edge_integrand(integral.integrand)
+                tasks.append((_compile_edge_integral, (expr, fields)))
+                kinds.append(("edge", k))
+            else:
+                assert isinstance(
+                    integral.measure, form_language.ControlVolume
+                ), "only dS and dV integrals are supported for systems"
+                tasks.append(
+                    (_compile_vertex_integral, (integral.integrand(x), fields))
+                )
+                kinds.append(("vertex", k))
+
+    dirichlet = getattr(obj, "dirichlet", None)
+    if callable(dirichlet):
+        for f, subdomain, k in dirichlet(fields):
+            tasks.append((_compile_vertex_integral, (f(x), fields, False)))
+            kinds.append(("dirichlet", (subdomain, k)))
+
+    results = _run_tasks(tasks, processes)
+
+    uk0 = [sympy.Symbol(f"{f}k0") for f in fields]
+    uk1 = [sympy.Symbol(f"{f}k1") for f in fields]
+    edge_args = uk0 + uk1 + list(sympy.symbols("x0 x1 edge_ce_ratio edge_length"))
+    edge_args += [lmbda_symbol]
+    vertex_args = uk0 + [sympy.Symbol("control_volume"), x, lmbda_symbol]
+    dirichlet_args = uk0 + [x, lmbda_symbol]
+
+    # the kernels of the residual and the Jacobian
+    edge_kernels = ([], [])
+    vertex_kernels = ([], [])
+    dirichlet_kernels = ([], [])
+    for (kind, k), exprs in zip(kinds, results):
+        if kind == "edge":
+            for kernels, expr in zip(edge_kernels, exprs):
+                val = sympy.lambdify(edge_args, expr, modules=a2a)
+                kernels.append(SystemEdgeKernel(val, k))
+        elif kind == "vertex":
+            for kernels, expr in zip(vertex_kernels, exprs):
+                val = sympy.lambdify(vertex_args, expr, modules=a2a)
+                kernels.append(SystemVertexKernel(val, k))
+        else:
+            subdomain, field = k
+            for kernels, expr in zip(dirichlet_kernels, exprs):
+                val = sympy.lambdify(dirichlet_args, expr, modules=a2a)
+                kernels.append(SystemDirichletKernel(val, subdomain, field))
+
+    residual = FvmSystem(
+        mesh,
+        num_fields,
+        edge_kernels[0],
+        vertex_kernels[0],
+        dirichlet_kernels[0],
+        lmbda,
+    )
+    jacobian = SystemJacobian(
+        mesh,
+        num_fields,
+        edge_kernels[1],
+        vertex_kernels[1],
+        dirichlet_kernels[1],
+        lmbda,
+    )
+    return residual, jacobian
+
+
+def _compile_edge_integral(expr, fields):
+    x0 = sympy.Symbol("x0")
+    x1 = sympy.Symbol("x1")
+    el = sympy.Symbol("edge_length")
+    er = sympy.Symbol("edge_ce_ratio")
+    expr, index_vars = _discretize_edge_integral(expr, x0, x1, el, er, fields)
+    expr = sympy.simplify(expr)
+
+    # Turn edge around
+    swap = {x0: x1, x1: x0}
+    for var0, var1 in index_vars:
+        swap.update({var0: var1, var1: var0})
+    expr_turned = expr.subs(swap, simultaneous=True)
+
+    # Linearization: the derivatives of the contributions to either node with
+    # respect to all fields at either node
+    expr_lin = [
+        [
+            [sympy.diff(e, index_vars[k][node]) for k in range(len(fields))]
+            for node in [0, 1]
+        ]
+        for e in [expr, expr_turned]
+    ]
+    return [expr, expr_turned], expr_lin
+
+
+def _compile_vertex_integral(fx, fields, is_integral=True):
+    x = sympy.DeferredVector("x")
+
+    uk0 = [sympy.Symbol(f"{f}k0") for f in fields]
+    expr = sympy.sympify(fx).subs({f(x): v for f, v in zip(fields, uk0)})
+    if is_integral:
+        expr *= sympy.Symbol("control_volume")
+
+    expr_lin = [sympy.diff(expr, v) for v in uk0]
+    return expr, expr_lin
+
+
+class FvmSystem:
+    """The residual of a system discretized by `discretize_system`."""
+
+    def __init__(
+        self, mesh, num_fields, edge_kernels, vertex_kernels, dirichlets, lmbda=None
+    ):
+        self.mesh = mesh
+        self.num_fields = num_fields
+        self.edge_kernels = edge_kernels
+        self.vertex_kernels = vertex_kernels
+        self.dirichlets = dirichlets
+        self.lmbda = lmbda
+
+    def eval(self, u, lmbda=None):
+        """Evaluate the residual at the (interleaved) state `u`."""
+        if lmbda is None:
+            lmbda = self.lmbda
+        U = u.reshape(-1, self.num_fields).T
+        out = np.zeros_like(U)
+
+        for edge_kernel in self.edge_kernels:
+            for subdomain in edge_kernel.subdomains:
+                cell_mask = self.mesh.get_cell_mask(subdomain)
+                vals = edge_kernel.eval(U, self.mesh, cell_mask, lmbda)
+                idx = self.mesh.idx[-1][..., cell_mask]
+                if np.iscomplexobj(vals):
+                    np.add.at(out[edge_kernel.equation], idx, vals)
+                else:
+                    npx.add_at(out[edge_kernel.equation], idx, vals)
+
+        for vertex_kernel in self.vertex_kernels:
+            for subdomain in vertex_kernel.subdomains:
+                vertex_mask = self.mesh.get_vertex_mask(subdomain)
+                out[vertex_kernel.equation, vertex_mask] += vertex_kernel.eval(
+                    U, self.mesh, vertex_mask, lmbda
+                )
+
+        for dirichlet in self.dirichlets:
+            vertex_mask = self.mesh.get_vertex_mask(dirichlet.subdomain)
+            out[dirichlet.field, vertex_mask] = dirichlet.eval(
+                U, self.mesh, vertex_mask, lmbda
+            )
+
+        return out.T.reshape(-1)
+
+
+class SystemJacobian:
+    """The Jacobian of a system discretized by `discretize_system`."""
+
+    def __init__(
+        self, mesh, num_fields, edge_kernels, vertex_kernels, dirichlets, lmbda=None
+    ):
+        self.mesh = mesh
+        self.num_fields = num_fields
+        self.edge_kernels = edge_kernels
+        self.vertex_kernels = vertex_kernels
+        self.dirichlets = dirichlets
+        self.lmbda = lmbda
+        self._pattern = None
+
+    def get_linear_operator(self, u, lmbda=None):
+        """Returns the Jacobian at the (interleaved) state `u` as a `bsr_matrix` with
+        `num_fields x num_fields` blocks.
+        """
+        if lmbda is None:
+            lmbda = self.lmbda
+        k = self.num_fields
+        U = u.reshape(-1, k).T
+        n = U.shape[1]
+
+        # COO blocks; the block entries are leading axes, so that they are summed
+        # like batches by the SparsityPattern.
+        V = []
+        I_ = []
+        J = []
+        for edge_kernel in self.edge_kernels:
+            for subdomain in edge_kernel.subdomains:
+                cell_mask = self.mesh.get_cell_mask(subdomain)
+                nec = self.mesh.idx[-1][..., cell_mask]
+                vals = edge_kernel.eval(U, self.mesh, cell_mask, lmbda)
+                for a in [0, 1]:
+                    for b in [0, 1]:
+                        blocks = np.zeros((k, k) + nec[a].shape, dtype=vals.dtype)
+                        blocks[edge_kernel.equation] = vals[a][b]
+                        V.append(blocks.reshape(k, k, -1))
+                        I_.append(nec[a].reshape(-1))
+                        J.append(nec[b].reshape(-1))
+
+        for vertex_kernel in self.vertex_kernels:
+            for subdomain in vertex_kernel.subdomains:
+                verts = np.arange(n)[self.mesh.get_vertex_mask(subdomain)]
+                vals = vertex_kernel.eval(U, self.mesh, verts, lmbda)
+                blocks = np.zeros((k, k, len(verts)), dtype=vals.dtype)
+                blocks[vertex_kernel.equation] = vals
+                V.append(blocks)
+                I_.append(verts)
+                J.append(verts)
+
+        V = np.concatenate(V, axis=-1)
+        I_ = np.concatenate(I_)
+        J = np.concatenate(J)
+
+        # The sparsity pattern doesn't depend on u, so the COO-to-CSR conversion is
+        # only done once.
+        if self._pattern is None:
+            self._pattern = SparsityPattern(I_, J, n)
+        data = np.ascontiguousarray(np.moveaxis(self._pattern.get_data(V), -1, 0))
+
+        # Dirichlet conditions replace the rows of their field.
+        for dirichlet in self.dirichlets:
+            verts = np.arange(n)[self.mesh.get_vertex_mask(dirichlet.subdomain)]
+            vals = dirichlet.eval(U, self.mesh, verts, lmbda)
+            data[self._pattern.get_row_entries(verts), dirichlet.field] = 0.0
+            data[self._pattern.diagonal_index[verts], dirichlet.field] = vals.T
+
+        return sparse.bsr_matrix(
+            (data, self._pattern.indices, self._pattern.indptr), shape=(n * k, n * k)
+        )
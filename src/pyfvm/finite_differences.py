@@ -0,0 +1,156 @@
+import numpy as np
+from scipy import sparse
+
+from .sparsity import SparsityPattern
+
+
+class FiniteDifferenceJacobian:
+    """Sparse Jacobian of an arbitrary residual callable `f(u)` on the vertices of
+    `mesh` from compressed finite differences.
+
+    The Jacobian is assumed to have the sparsity pattern of the mesh's vertex graph
+    (a vertex couples with itself and its edge neighbors), like all edge and vertex
+    integrals. The columns are colored such that no two columns of a color share a
+    row (a distance-2 coloring of the vertex graph); one residual evaluation then
+    gives all columns of a color at once. That is a handful of evaluations, e.g.,
+    9 or 10 on triangle meshes, independent of the mesh size.
+
+    The step for column j is `eps * max(|u_j|, 1)`. `get_linear_operator(u)`
+    returns a CSR matrix, so the object can be passed as the `jacobian` of
+    `inexact_newton`. For complex `u`, `f` must be complex-differentiable; for
+    residuals with conj() or abs() terms, use `get_wirtinger_matrices()`.
+    """
+
+    def __init__(self, f, mesh, eps=None):
+        self.f = f
+        self.mesh = mesh
+        self.eps = np.sqrt(np.finfo(float).eps) if eps is None else eps
+
+        nec = mesh.idx[-1]
+        n = len(mesh.points)
+        I_ = np.concatenate([nec[0].reshape(-1), nec[1].reshape(-1)])
+        J = np.concatenate([nec[1].reshape(-1), nec[0].reshape(-1)])
+        self.pattern = SparsityPattern(I_, J, n)
+
+        self.colors = get_distance2_coloring(
+            self.pattern.get_csr(np.ones(self.pattern.nnz))
+        )
+        self.num_colors = np.max(self.colors) + 1 if n > 0 else 0
+
+        # the data indices of the entries in the columns of every color
+        col_colors = self.colors[self.pattern.indices]
+        order = np.argsort(col_colors, kind="stable")
+        counts = np.bincount(col_colors, minlength=self.num_colors)
+        self._color_entries = np.split(order, np.cumsum(counts)[:-1])
+
+    def get_linear_operator(self, u, f0=None):
+        """The Jacobian at `u` as a CSR matrix. Pass `f0 = f(u)` if it's known."""
+        data = self._get_data(u, 1.0, f0)
+        return self.pattern.get_csr(data)
+
+    def get_wirtinger_matrices(self, u, f0=None):
+        """For complex `u` and a residual that is only real-differentiable (e.g.,
+        because of |u|^2), the matrices A and B with J phi = A phi + B conj(phi).
+        Takes twice as many residual evaluations as `get_linear_operator()`.
+        """
+        u = np.asarray(u, dtype=complex)
+        if f0 is None:
+            f0 = self.f(u)
+        data_real = self._get_data(u, 1.0, f0)
+        data_imag = self._get_data(u, 1.0j, f0)
+        A = self.pattern.get_csr(0.5 * (data_real - 1j * data_imag))
+        B = self.pattern.get_csr(0.5 * (data_real + 1j * data_imag))
+        return A, B
+
+    def _get_data(self, u, direction, f0):
+        """The difference quotients of `f` in the directions `direction` e_j."""
+        if f0 is None:
+            f0 = self.f(u)
+        h = self.eps * np.maximum(np.abs(u), 1.0)
+
+        rows = self.pattern.rows
+        cols = self.pattern.indices
+        dtype = np.result_type(u, f0, direction)
+        data = np.zeros(self.pattern.nnz, dtype=dtype)
+        for color, entries in enumerate(self._color_entries):
+            is_colored = self.colors == color
+            step = np.where(is_colored, h, 0.0)
+            df = self.f(u + direction * step) - f0
+            data[entries] = df[rows[entries]] / h[cols[entries]]
+        return data
+
+
+def get_distance2_coloring(graph, ordering="smallest_last"):
+    """Color the vertices of the graph given by the sparsity pattern of `graph`
+    such that vertices at distance 1 or 2 have different colors.
+    """
+    return get_coloring(graph, distance=2, ordering=ordering)
+
+
+def get_coloring(graph, distance=1, ordering="smallest_last"):
+    """Color the vertices of the graph given by the sparsity pattern of `graph`
+    such that vertices at distance up to `distance` (1 or 2) have different colors.
+
+    This is the sequential greedy coloring: the vertices take the smallest color
+    not used by their neighbors, one after the other. With the "largest_first"
+    ordering, the vertices of highest degree go first; with "smallest_last", the
+    order is the reverse of repeatedly removing a vertex of smallest degree, which
+    needs at most one color more than the largest minimum degree of a subgraph.
+    Either way, the number of colors is at most the maximum degree plus one.
+    """
+    assert distance in [1, 2]
+    assert ordering in ["largest_first", "smallest_last"]
+    n = graph.shape[0]
+    graph = sparse.csr_matrix(graph, dtype=float)
+    graph.data[:] = 1.0
+    graph = graph + graph.T
+    if distance == 2:
+        graph = graph + sparse.identity(n, format="csr")
+        graph = sparse.csr_matrix(graph @ graph)
+    graph.setdiag(0.0)
+    graph.eliminate_zeros()
+
+    indptr = graph.indptr.tolist()
+    indices = graph.indices.tolist()
+    if ordering == "largest_first":
+        order = np.argsort(-np.diff(graph.indptr), kind="stable").tolist()
+    else:
+        order = _get_smallest_last_order(indptr, indices, n)
+
+    colors = [-1] * n
+    for v in order:
+        used = {colors[w] for w in indices[indptr[v] : indptr[v + 1]]}
+        color = 0
+        while color in used:
+            color += 1
+        colors[v] = color
+    return np.array(colors, dtype=int)
+
+
+def _get_smallest_last_order(indptr, indices, n):
+    """The reverse of the order in which the vertices are removed if a vertex of
+    smallest degree (in the remaining graph) is removed in every step. The
+    vertices are kept in buckets by degree, so this takes linear time.
+    """
+    degree = [indptr[v + 1] - indptr[v] for v in range(n)]
+    buckets = [set() for _ in range(max(degree, default=0) + 1)]
+    for v, d in enumerate(degree):
+        buckets[d].add(v)
+
+    is_removed = [False] * n
+    order = []
+    d = 0
+    for _ in range(n):
+        # Removing a vertex lowers the degrees of its neighbors by one at most.
+        d = max(d - 1, 0)
+        while not buckets[d]:
+            d += 1
+        v = buckets[d].pop()
+        is_removed[v] = True
+        order.append(v)
+        for w in indices[indptr[v] : indptr[v + 1]]:
+            if not is_removed[w]:
+                buckets[degree[w]].remove(w)
+                degree[w] -= 1
+                buckets[degree[w]].add(w)
+    return order[::-1]
@@ -2,6 +2,7 @@ import npx
 import numpy as np
 
 from . import fvm_matrix
+from .restriction import RestrictionCache, scatter
 
 
 class FvmProblem:
@@ -15,12 +16,19 @@ class FvmProblem:
         edge_matrix_kernels,
         vertex_matrix_kernels,
         face_matrix_kernels,
+        stencil=None,
+        lmbda=None,
+        parameter_derivative=None,
     ):
         self.mesh = mesh
         self.edge_kernels = edge_kernels
         self.vertex_kernels = vertex_kernels
         self.face_kernels = face_kernels
         self.dirichlets = dirichlets
+        self.stencil = stencil
+        self.lmbda = lmbda
+        self.parameter_derivative = parameter_derivative
+        self._restrictions = RestrictionCache(mesh)
 
         if edge_matrix_kernels or vertex_matrix_kernels or face_matrix_kernels:
             self.matrix = fvm_matrix.get_fvm_matrix(
@@ -34,34 +42,103 @@ class FvmProblem:
             self.matrix = None
         return
 
-    def eval(self, u):
-
+    def eval(self, u, lmbda=None):
+        """Evaluate the residual at `u`. `u` can also be a batch of states of shape
+        (k, n), in which case all states are evaluated at once. `lmbda` overrides
+        the parameter value given to `discretize`.
+        """
+        if lmbda is None:
+            lmbda = self.lmbda
         if self.matrix is None:
             out = np.zeros_like(u)
         else:
-            out = self.matrix.dot(u)
+            out = self.matrix.dot(u.T).T
 
         for edge_kernel in self.edge_kernels:
             for subdomain in edge_kernel.subdomains:
                 cell_mask = self.mesh.get_cell_mask(subdomain)
-                npx.add_at(
-                    out,
-                    self.mesh.idx[-1],
-                    edge_kernel.eval(u, self.mesh, cell_mask),
-                )
+                vals = edge_kernel.eval(u, self.mesh, cell_mask, lmbda)
+                if self.stencil is not None and isinstance(cell_mask, slice):
+                    self.stencil.scatter(out, vals)
+                elif u.ndim == 1 and not np.iscomplexobj(vals):
+                    npx.add_at(out, self.mesh.idx[-1][..., cell_mask], vals)
+                elif u.ndim == 1:
+                    # npx.add_at() is based on np.bincount(), which is real-only
+                    np.add.at(out, self.mesh.idx[-1][..., cell_mask], vals)
+                else:
+                    # Scatter all states at once with the batch axis in the back
+                    np.add.at(
+                        out.T,
+                        self.mesh.idx[-1][..., cell_mask],
+                        np.moveaxis(vals, 0, -1),
+                    )
 
         for vertex_kernel in self.vertex_kernels:
             for subdomain in vertex_kernel.subdomains:
                 vertex_mask = self.mesh.get_vertex_mask(subdomain)
-                out[vertex_mask] += vertex_kernel.eval(u, self.mesh, vertex_mask)
+                out[..., vertex_mask] += vertex_kernel.eval(
+                    u, self.mesh, vertex_mask, lmbda
+                )
 
         for face_kernel in self.face_kernels:
             for subdomain in face_kernel.subdomains:
                 face_mask = self.mesh.get_face_mask(subdomain)
-                np.add(out, face_mask, face_kernel.eval(u, self.mesh, face_mask))
+                np.add(out, face_mask, face_kernel.eval(u, self.mesh, face_mask, lmbda))
 
         for dirichlet in self.dirichlets:
             vertex_mask = self.mesh.get_vertex_mask(dirichlet.subdomain)
-            out[vertex_mask] = dirichlet.eval(u[vertex_mask], self.mesh, vertex_mask)
+            out[..., vertex_mask] = dirichlet.eval(
+                u[..., vertex_mask], self.mesh, vertex_mask, lmbda
+            )
 
         return out
+
+    def eval_rows(self, u, vertices, lmbda=None):
+        """Evaluate the residual at `u` only in the rows of `vertices` (an array of
+        unique vertex indices), e.g., for local smoothers or nonlinear Gauss-Seidel.
+        Only the kernels on the cells touching the vertices are evaluated; these are
+        cached for the last subsets. Returns the rows in the order of `vertices`.
+        """
+        if lmbda is None:
+            lmbda = self.lmbda
+        restriction = self._restrictions.get(vertices)
+        if self.matrix is None:
+            shape = u.shape[:-1] + (len(restriction.vertices),)
+            out = np.zeros(shape, dtype=u.dtype)
+        else:
+            out = (self.matrix[restriction.vertices] @ u.T).T
+
+        for edge_kernel in self.edge_kernels:
+            for subdomain in edge_kernel.subdomains:
+                cells, local = restriction.get_cells(subdomain)
+                scatter(out, local, edge_kernel.eval(u, self.mesh, cells, lmbda))
+
+        for vertex_kernel in self.vertex_kernels:
+            for subdomain in vertex_kernel.subdomains:
+                verts, local = restriction.get_vertices(subdomain)
+                out[..., local] += vertex_kernel.eval(u, self.mesh, verts, lmbda)
+
+        for face_kernel in self.face_kernels:
+            for subdomain in face_kernel.subdomains:
+                faces, _, local = restriction.get_faces(subdomain)
+                scatter(out, local, face_kernel.eval(u, self.mesh, faces, lmbda))
+
+        for dirichlet in self.dirichlets:
+            verts, local = restriction.get_vertices(dirichlet.subdomain)
+            out[..., local] = dirichlet.eval(u[..., verts], self.mesh, verts, lmbda)
+
+        return out
+
+    def eval_parameter_derivative(self, u, lmbda=None):
+        """Evaluate the derivative dF/dlambda of the residual at `u`. For a vector
+        parameter (`discretize(..., num_parameters=p)`), returns the derivatives
+        with respect to its components as the rows of an array of shape (p, n).
+        """
+        assert (
+            self.parameter_derivative is not None
+        ), "pass `lmbda` to discretize() for the parameter derivative"
+        if lmbda is None:
+            lmbda = self.lmbda
+        if isinstance(self.parameter_derivative, list):
+            return np.array([d.eval(u, lmbda) for d in self.parameter_derivative])
+        return self.parameter_derivative.eval(u, lmbda)
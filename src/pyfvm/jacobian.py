@@ -1,44 +1,315 @@
 import numpy as np
 from scipy import sparse
 
+from .kernel_operator import KernelOperator
+from .restriction import RestrictionCache
+from .sparsity import CsrBatch, SparsityPattern, cast_data
+from .wirtinger import WirtingerOperator
+
 
 class Jacobian:
-    def __init__(self, mesh, edge_kernels, vertex_kernels, face_kernels, dirichlets):
+    def __init__(
+        self,
+        mesh,
+        edge_kernels,
+        vertex_kernels,
+        face_kernels,
+        dirichlets,
+        stencil=None,
+        lmbda=None,
+        conjugate=None,
+    ):
         self.mesh = mesh
         self.edge_kernels = edge_kernels
         self.vertex_kernels = vertex_kernels
         self.face_kernels = face_kernels
         self.dirichlets = dirichlets
+        self.stencil = stencil
+        self.lmbda = lmbda
+        # the Jacobian of the conj(u) part for real-linear Jacobians
+        self.conjugate = conjugate
+        self._pattern = None
+        self._restrictions = RestrictionCache(mesh)
+        # the state, parameter, and CSR data of the last incremental Jacobian
+        self._last = None
         return
 
-    def get_linear_operator(self, u):
+    def get_linear_operator(
+        self, u, matrix_free=False, lmbda=None, dtype=None, incremental=False
+    ):
+        """Returns the Jacobian at `u` as a CSR matrix. For a batch of states of shape
+        (k, n), returns a `CsrBatch` of k matrices sharing one sparsity pattern.
+
+        With `matrix_free=True`, returns a `JacobianOperator` that evaluates the
+        Jacobian kernels at `u` in every matvec instead of storing the matrix. Its
+        diagonal and row sums are computed from the kernels as well.
+
+        With `incremental=True`, the Jacobian is kept, and the next incremental call
+        only re-evaluates the kernels around the vertices where `u` changed, e.g.,
+        for fronts that only move through a small part of the mesh. The rows of the
+        changed vertices and their neighbors are recomputed in place; the returned
+        matrix shares its data with the kept one, so matrices from earlier
+        incremental calls are updated, too.
+
+        `lmbda` overrides the parameter value given to `discretize`. With `dtype`,
+        e.g., `np.float32`, the kernel values are cast to that precision as they
+        are computed, and the matrix is assembled and stored in it.
+
+        If the residual has conj() or abs() terms of complex unknowns, the Jacobian
+        at a complex `u` is a `WirtingerOperator` phi -> A phi + B conj(phi); at a
+        real `u`, it is the matrix A + B.
+        """
+        if lmbda is None:
+            lmbda = self.lmbda
+
+        if self.conjugate is not None:
+            assert not matrix_free, "matrix_free isn't supported for conj() terms"
+            assert u.ndim == 1, "conj() terms need a single state"
+            A = self._get_matrix(u, lmbda, dtype, incremental)
+            B = self.conjugate.get_linear_operator(
+                u, lmbda=lmbda, dtype=dtype, incremental=incremental
+            )
+            if np.isrealobj(u):
+                return A + B
+            return WirtingerOperator(A, B)
+
+        if matrix_free:
+            assert u.ndim == 1, "matrix_free needs a single state"
+            return JacobianOperator(self, u.copy(), lmbda)
+
+        return self._get_matrix(u, lmbda, dtype, incremental)
+
+    def _get_matrix(self, u, lmbda, dtype, incremental):
+        if incremental:
+            assert u.ndim == 1, "incremental needs a single state"
+            data = self._get_incremental_data(u, lmbda)
+            return self._pattern.get_csr(cast_data(data, dtype))
+
+        if self.stencil is not None and not self.face_kernels and u.ndim == 1:
+            return self._get_dia_matrix(u, lmbda, dtype)
+
+        data = cast_data(self._get_data(u, lmbda, dtype), dtype)
+        if u.ndim == 1:
+            return self._pattern.get_csr(data)
+
+        return CsrBatch(
+            self._pattern.indptr, self._pattern.indices, data, self._pattern.shape
+        )
+
+    def _get_data(self, u, lmbda, dtype=None):
+        # The sparsity pattern doesn't depend on u, so the COO-to-CSR conversion is
+        # only done once, and the COO indices are only needed for it.
         V, I, J = _get_VIJ(
-            self.mesh, u, self.edge_kernels, self.vertex_kernels, self.face_kernels
+            self.mesh,
+            u,
+            self.edge_kernels,
+            self.vertex_kernels,
+            self.face_kernels,
+            lmbda,
+            dtype,
+            indices=self._pattern is None,
         )
+        if self._pattern is None:
+            # One unknown per vertex
+            self._pattern = SparsityPattern(I, J, len(self.mesh.points))
+        data = self._pattern.get_data(V)
+
+        # Apply Dirichlet conditions.
+        for dirichlet in self.dirichlets:
+            vertex_mask = self.mesh.get_vertex_mask(dirichlet.subdomain)
+            self._pattern.set_rows(
+                data,
+                np.where(vertex_mask)[0],
+                dirichlet.eval(u[..., vertex_mask], self.mesh, vertex_mask, lmbda),
+            )
+        return data
+
+    def _get_incremental_data(self, u, lmbda):
+        if self._last is None or not np.array_equal(self._last[1], lmbda):
+            data = self._get_data(u, lmbda)
+            self._last = (u.copy(), lmbda, data)
+            return data
+
+        u_last, _, data = self._last
+        changed = np.flatnonzero(u != u_last)
+        if len(changed) == 0:
+            return data
+
+        # The entries depending on u at the changed vertices are in the rows of the
+        # nodes of the cells touching them.
+        cells = np.unique(self._restrictions.vertex_cells[changed].indices)
+        rows = np.unique(self.mesh.idx[-1][..., cells])
+        restriction = self._restrictions.get(rows, cache=False)
+
+        V, I_, J = self._get_restricted_VIJ(restriction, u, lmbda)
+        data[self._pattern.get_row_entries(rows)] = 0.0
+        np.add.at(data, self._pattern.get_entries(rows[I_], J), V)
 
-        # One unknown per vertex
+        for dirichlet in self.dirichlets:
+            verts, _ = restriction.get_vertices(dirichlet.subdomain)
+            self._pattern.set_rows(
+                data, verts, dirichlet.eval(u[verts], self.mesh, verts, lmbda)
+            )
+
+        u_last[changed] = u[changed]
+        return data
+
+    def get_rows(self, u, vertices, lmbda=None):
+        """Returns the rows of the Jacobian at `u` for `vertices` (an array of unique
+        vertex indices) as a CSR matrix of shape (len(vertices), n). Like
+        `FvmProblem.eval_rows()`, only the kernels on the cells touching the vertices
+        are evaluated.
+        """
+        if lmbda is None:
+            lmbda = self.lmbda
+        assert u.ndim == 1, "get_rows needs a single state"
+        restriction = self._restrictions.get(vertices)
+        V, I_, J = self._get_restricted_VIJ(restriction, u, lmbda)
+
+        # Dirichlet rows only have their diagonal entry.
+        for dirichlet in self.dirichlets:
+            verts, local = restriction.get_vertices(dirichlet.subdomain)
+            is_kept = ~np.isin(I_, local)
+            vals = dirichlet.eval(u[verts], self.mesh, verts, lmbda)
+            V = np.concatenate([V[is_kept], np.broadcast_to(vals, verts.shape)])
+            I_ = np.concatenate([I_[is_kept], local])
+            J = np.concatenate([J[is_kept], verts])
+
+        shape = (len(restriction.vertices), len(self.mesh.points))
+        return sparse.csr_matrix((V, (I_, J)), shape=shape)
+
+    def _get_restricted_VIJ(self, restriction, u, lmbda):
+        """COO entries of the rows of `restriction` without the Dirichlet conditions;
+        the row indices are local.
+        """
+        V = []
+        I_ = []
+        J = []
+        for edge_kernel in self.edge_kernels:
+            for subdomain in edge_kernel.subdomains:
+                cells, local = restriction.get_cells(subdomain)
+                nec = self.mesh.idx[-1][..., cells]
+                v_matrix = edge_kernel.eval(u, self.mesh, cells, lmbda)
+                for i in [0, 1]:
+                    is_inside = local[i] >= 0
+                    for j in [0, 1]:
+                        V.append(v_matrix[i][j][is_inside])
+                        I_.append(local[i][is_inside])
+                        J.append(nec[j][is_inside])
+
+        for vertex_kernel in self.vertex_kernels:
+            for subdomain in vertex_kernel.subdomains:
+                verts, local = restriction.get_vertices(subdomain)
+                vals = vertex_kernel.eval(u, self.mesh, verts, lmbda)
+                V.append(np.broadcast_to(vals, verts.shape))
+                I_.append(local)
+                J.append(verts)
+
+        for face_kernel in self.face_kernels:
+            for subdomain in face_kernel.subdomains:
+                faces, nodes, local = restriction.get_faces(subdomain)
+                vals = face_kernel.eval(u, self.mesh, faces, lmbda)
+                is_inside = local >= 0
+                V.append(np.broadcast_to(vals, local.shape)[is_inside])
+                I_.append(local[is_inside])
+                J.append(nodes[is_inside])
+
+        V = np.concatenate(V) if V else np.zeros(0, dtype=u.dtype)
+        I_ = np.concatenate(I_) if I_ else np.zeros(0, dtype=int)
+        J = np.concatenate(J) if J else np.zeros(0, dtype=int)
+        return V, I_, J
+
+    def _get_dia_matrix(self, u, lmbda, dtype=None):
         n = len(self.mesh.points)
-        matrix = sparse.coo_matrix((V, (I, J)), shape=(n, n))
-        # Transform to CSR format for efficiency
-        matrix = matrix.tocsr()
+        diag = np.zeros(n, dtype=u.dtype)
+
+        edge_vals = []
+        for edge_kernel in self.edge_kernels:
+            for subdomain in edge_kernel.subdomains:
+                cell_mask = self.mesh.get_cell_mask(subdomain)
+                edge_vals.append(edge_kernel.eval(u, self.mesh, cell_mask, lmbda))
+
+        for vertex_kernel in self.vertex_kernels:
+            for subdomain in vertex_kernel.subdomains:
+                vertex_mask = self.mesh.get_vertex_mask(subdomain)
+                diag[vertex_mask] += vertex_kernel.eval(
+                    u, self.mesh, vertex_mask, lmbda
+                )
+
+        data = self.stencil.get_dia_data(diag, edge_vals)
 
-        # Apply Dirichlet conditions.
-        d = matrix.diagonal()
         for dirichlet in self.dirichlets:
             vertex_mask = self.mesh.get_vertex_mask(dirichlet.subdomain)
-            # Set all Dirichlet rows to 0.
-            for i in np.where(vertex_mask)[0]:
-                matrix.data[matrix.indptr[i] : matrix.indptr[i + 1]] = 0.0
+            rows = np.where(vertex_mask)[0]
+            self.stencil.zero_rows(data, rows)
+            self.stencil.set_diagonal(
+                data,
+                rows,
+                dirichlet.eval(u[vertex_mask], self.mesh, vertex_mask, lmbda),
+            )
+
+        return self.stencil.get_dia_matrix(cast_data(data, dtype))
+
 
-            # Set the diagonal.
-            d[vertex_mask] = dirichlet.eval(u[vertex_mask], self.mesh, vertex_mask)
+class JacobianOperator(KernelOperator):
+    """Matrix-free Jacobian at `u`; every matvec evaluates the Jacobian kernels.
+    It is complex if `u` or the parameter is complex.
+    """
 
-        matrix.setdiag(d)
+    def __init__(self, jacobian, u, lmbda=None):
+        self.jacobian = jacobian
+        self.u = u
+        self.lmbda = lmbda
+        is_complex = np.iscomplexobj(u) or np.iscomplexobj(lmbda)
+        dtype = complex if is_complex else float
+        super().__init__(jacobian.mesh, jacobian.stencil, dtype)
 
-        return matrix
+    def _get_edge_values(self, restriction=None):
+        for edge_kernel in self.jacobian.edge_kernels:
+            for subdomain in edge_kernel.subdomains:
+                cell_mask = self._get_cells(subdomain, restriction)
+                nec = self.mesh.idx[-1][..., cell_mask]
+                vals = edge_kernel.eval(self.u, self.mesh, cell_mask, self.lmbda)
+                yield vals, nec, cell_mask
 
+    def _get_vertex_values(self, restriction=None):
+        for vertex_kernel in self.jacobian.vertex_kernels:
+            for subdomain in vertex_kernel.subdomains:
+                vertex_mask = self._get_vertices(subdomain, restriction)
+                vals = vertex_kernel.eval(self.u, self.mesh, vertex_mask, self.lmbda)
+                yield vals, vertex_mask
 
-def _get_VIJ(mesh, u, edge_kernels, vertex_kernels, face_kernels):
+    def _get_face_values(self):
+        for face_kernel in self.jacobian.face_kernels:
+            for subdomain in face_kernel.subdomains:
+                face_mask = self.mesh.get_face_mask(subdomain)
+                faces = self.mesh.idx[-1][face_mask]
+                yield face_kernel.eval(self.u, self.mesh, face_mask, self.lmbda), faces
+
+    def _get_dirichlet_values(self, restriction=None):
+        for dirichlet in self.jacobian.dirichlets:
+            vertex_mask = self._get_vertices(dirichlet.subdomain, restriction)
+            diag = dirichlet.eval(
+                self.u[vertex_mask], self.mesh, vertex_mask, self.lmbda
+            )
+            yield diag, vertex_mask
+
+
+def _get_VIJ(
+    mesh,
+    u,
+    edge_kernels,
+    vertex_kernels,
+    face_kernels,
+    lmbda=None,
+    dtype=None,
+    indices=True,
+):
+    """COO entries of the Jacobian without the Dirichlet conditions. With `dtype`,
+    the kernels are evaluated in that precision. With `indices=False`, I and J are
+    None.
+    """
+    batch_shape = u.shape[:-1]
     V = []
     I_ = []
     J = []
@@ -46,45 +317,44 @@ def _get_VIJ(mesh, u, edge_kernels, vertex_kernels, face_kernels):
     for edge_kernel in edge_kernels:
         for subdomain in edge_kernel.subdomains:
             cell_mask = mesh.get_cell_mask(subdomain)
-            v_matrix = edge_kernel.eval(u, mesh, cell_mask)
-
-            V.append(v_matrix[0, 0].flatten())
-            V.append(v_matrix[0, 1].flatten())
-            V.append(v_matrix[1, 0].flatten())
-            V.append(v_matrix[1, 1].flatten())
-
-            I_.append(mesh.idx[-1][0].flatten())
-            I_.append(mesh.idx[-1][0].flatten())
-            I_.append(mesh.idx[-1][1].flatten())
-            I_.append(mesh.idx[-1][1].flatten())
+            nec = mesh.idx[-1][..., cell_mask]
+            v_matrix = edge_kernel.eval(u, mesh, cell_mask, lmbda, dtype)
+            v_matrix = cast_data(v_matrix.reshape(batch_shape + (2, 2, -1)), dtype)
 
-            J.append(mesh.idx[-1][0].flatten())
-            J.append(mesh.idx[-1][1].flatten())
-            J.append(mesh.idx[-1][0].flatten())
-            J.append(mesh.idx[-1][1].flatten())
+            for i in [0, 1]:
+                for j in [0, 1]:
+                    V.append(v_matrix[..., i, j, :])
+                    if indices:
+                        I_.append(nec[i].flatten())
+                        J.append(nec[j].flatten())
 
     for vertex_kernel in vertex_kernels:
         for subdomain in vertex_kernel.subdomains:
             vertex_mask = mesh.get_vertex_mask(subdomain)
-            vals_matrix = vertex_kernel.eval(u, mesh, vertex_mask)
+            vals_matrix = vertex_kernel.eval(u, mesh, vertex_mask, lmbda, dtype)
 
-            if vertex_mask == np.s_[:]:
-                verts = np.arange(len(vals_matrix))
-            V.append(vals_matrix)
-            I_.append(verts)
-            J.append(verts)
+            verts = np.arange(len(mesh.points))[vertex_mask]
+            V.append(cast_data(vals_matrix, dtype))
+            if indices:
+                I_.append(verts)
+                J.append(verts)
 
     for face_kernel in face_kernels:
         for subdomain in face_kernel.subdomains:
             face_mask = mesh.get_face_mask(subdomain)
-            vals_matrix = face_kernel.eval(u, mesh, face_mask)
+            vals_matrix = face_kernel.eval(u, mesh, face_mask, lmbda, dtype)
             faces = mesh.idx[-1][face_mask]
-            V.append(vals_matrix)
-            I_.append(faces)
-            J.append(faces)
+            V.append(cast_data(vals_matrix, dtype))
+            if indices:
+                I_.append(faces)
+                J.append(faces)
 
-    # Finally, make V, I, J into 1D-arrays.
-    V = np.concatenate(V)
+    # Finally, make V, I, J into 1D-arrays (with leading batch axes for V).
+    V = np.concatenate(
+        [np.broadcast_to(v, batch_shape + v.shape[-1:]) for v in V], axis=-1
+    )
+    if not indices:
+        return V, None, None
     I_ = np.concatenate(I_)
     J = np.concatenate(J)
 
@@ -0,0 +1,199 @@
+import npx
+import numpy as np
+from scipy import sparse
+from scipy.sparse import linalg
+
+from .restriction import RestrictionCache
+
+
+class KernelOperator(linalg.LinearOperator):
+    """Matrix-free operator on the vertices of a mesh.
+
+    Subclasses provide the kernel values via `_get_edge_values()` (2x2 edge matrices
+    with their node-edge-cell indices), `_get_vertex_values()`, `_get_face_values()`,
+    and `_get_dirichlet_values()`. Matvecs, the diagonal, and the row sums are
+    computed from those without ever forming the matrix. Given a `Restriction`, the
+    edge, vertex, and Dirichlet values are only evaluated on the cells and vertices
+    of it, which `get_submatrix()` uses.
+
+    Without a `dtype`, it is the result type of the kernel values, evaluated when
+    the dtype is first needed.
+    """
+
+    def __init__(self, mesh, stencil=None, dtype=None):
+        self.mesh = mesh
+        self.stencil = stencil
+        self._restrictions = RestrictionCache(mesh)
+        n = len(mesh.points)
+        super().__init__(dtype, (n, n))
+
+    @property
+    def dtype(self):
+        if self._dtype is None:
+            self._dtype = self._get_dtype()
+        return self._dtype
+
+    @dtype.setter
+    def dtype(self, dtype):
+        self._dtype = dtype
+
+    def _get_dtype(self):
+        dtype = np.dtype(float)
+        for values in [
+            self._get_edge_values(),
+            self._get_vertex_values(),
+            self._get_face_values(),
+            self._get_dirichlet_values(),
+        ]:
+            for vals, *_ in values:
+                dtype = np.result_type(dtype, vals)
+        return dtype
+
+    def _get_edge_values(self, restriction=None):
+        return []
+
+    def _get_vertex_values(self, restriction=None):
+        return []
+
+    def _get_face_values(self):
+        return []
+
+    def _get_dirichlet_values(self, restriction=None):
+        return []
+
+    def _get_cells(self, subdomain, restriction):
+        if restriction is None:
+            return self.mesh.get_cell_mask(subdomain)
+        return restriction.get_cells(subdomain)[0]
+
+    def _get_vertices(self, subdomain, restriction):
+        if restriction is None:
+            return self.mesh.get_vertex_mask(subdomain)
+        return restriction.get_vertices(subdomain)[0]
+
+    def _matvec(self, x):
+        x = np.ravel(x)
+        out = np.zeros(self.shape[0], dtype=np.result_type(x, self.dtype))
+
+        for v_matrix, nec, cell_mask in self._get_edge_values():
+            vals = v_matrix[:, 0] * x[nec[0]] + v_matrix[:, 1] * x[nec[1]]
+            scatter_edge_values(out, nec, vals, self.stencil, cell_mask)
+
+        for vals, vertex_mask in self._get_vertex_values():
+            out[vertex_mask] += vals * x[vertex_mask]
+
+        for vals, ids in self._get_face_values():
+            _add_at(out, ids, vals * x[ids])
+
+        # Dirichlet rows only have their diagonal entry.
+        for coeff, vertex_mask in self._get_dirichlet_values():
+            out[vertex_mask] = coeff * x[vertex_mask]
+
+        return out
+
+    def diagonal(self):
+        """The diagonal of the operator."""
+        return self._sum_rows(lambda v: np.stack([v[0, 0], v[1, 1]]))
+
+    def row_sums(self, absolute=False):
+        """The row sums of the operator.
+
+        With `absolute=True`, returns |a_ii| plus the absolute values of all cell
+        contributions to the off-diagonal entries. This is an upper bound of the l1
+        norms of the rows and exact if the contributions to an entry have equal
+        signs.
+        """
+        if absolute:
+            off_diagonal = self._sum_rows(
+                lambda v: np.abs(np.stack([v[0, 1], v[1, 0]])), diagonal=False
+            )
+            return np.abs(self.diagonal()) + off_diagonal
+
+        return self._sum_rows(lambda v: v[:, 0] + v[:, 1])
+
+    def get_submatrix(self, vertices):
+        """The principal submatrix for `vertices` (an array of unique vertex indices)
+        as a CSR matrix. Only the kernels on the cells touching the vertices are
+        evaluated, so the cost is proportional to the size of the subset.
+        """
+        restriction = self._restrictions.get(vertices, cache=False)
+        V = []
+        I_ = []
+        J = []
+        for v_matrix, nec, _ in self._get_edge_values(restriction):
+            local = restriction.get_local(nec)
+            for i in [0, 1]:
+                is_inside = local[i] >= 0
+                for j in [0, 1]:
+                    V.append(v_matrix[i][j][is_inside])
+                    I_.append(local[i][is_inside])
+                    J.append(nec[j][is_inside])
+
+        for vals, verts in self._get_vertex_values(restriction):
+            V.append(np.broadcast_to(vals, verts.shape))
+            I_.append(restriction.get_local(verts))
+            J.append(verts)
+
+        # The boundary faces are few; evaluate all of them and keep the rows inside.
+        for vals, ids in self._get_face_values():
+            local = restriction.get_local(ids)
+            is_inside = local >= 0
+            V.append(np.broadcast_to(vals, ids.shape)[is_inside])
+            I_.append(local[is_inside])
+            J.append(ids[is_inside])
+
+        V = np.concatenate(V) if V else np.zeros(0, dtype=self.dtype)
+        I_ = np.concatenate(I_) if I_ else np.zeros(0, dtype=int)
+        J = np.concatenate(J) if J else np.zeros(0, dtype=int)
+
+        # Dirichlet rows only have their diagonal entry.
+        for coeff, verts in self._get_dirichlet_values(restriction):
+            local = restriction.get_local(verts)
+            is_kept = ~np.isin(I_, local)
+            V = np.concatenate([V[is_kept], np.broadcast_to(coeff, verts.shape)])
+            I_ = np.concatenate([I_[is_kept], local])
+            J = np.concatenate([J[is_kept], verts])
+
+        shape = (len(restriction.vertices), self.shape[1])
+        rows = sparse.csr_matrix((V, (I_, J)), shape=shape)
+        return rows[:, restriction.vertices]
+
+    def _sum_rows(self, edge_fun, diagonal=True):
+        """Sum `edge_fun(v_matrix)` into the rows, plus (if `diagonal`) the vertex,
+        face, and Dirichlet values.
+        """
+        out = np.zeros(self.shape[0], dtype=self.dtype)
+
+        for v_matrix, nec, cell_mask in self._get_edge_values():
+            vals = edge_fun(v_matrix)
+            scatter_edge_values(out, nec, vals, self.stencil, cell_mask)
+
+        if diagonal:
+            for vals, vertex_mask in self._get_vertex_values():
+                out[vertex_mask] += vals
+
+            for vals, ids in self._get_face_values():
+                _add_at(out, ids, vals)
+
+        for coeff, vertex_mask in self._get_dirichlet_values():
+            out[vertex_mask] = coeff if diagonal else 0.0
+
+        return out
+
+
+def scatter_edge_values(out, nec, vals, stencil=None, cell_mask=None):
+    """Add the edge values `vals` of shape (2, *nec.shape[1:]) to the vertices `nec`
+    of `out`. The structured-mesh stencil avoids `add_at` if it covers all cells.
+    """
+    if stencil is not None and isinstance(cell_mask, slice):
+        stencil.scatter(out, vals)
+    else:
+        _add_at(out, nec, vals)
+
+
+def _add_at(out, indices, vals):
+    # npx.add_at() is real-only
+    if np.iscomplexobj(vals):
+        np.add.at(out, indices, vals)
+    else:
+        npx.add_at(out, indices, vals)
@@ -1,71 +1,220 @@
 import npx
 import numpy as np
-from scipy import sparse
+
+from .kernel_operator import KernelOperator, scatter_edge_values
+from .sparsity import CsrBatch, SparsityPattern, cast_data
 
 
 def get_linear_fvm_problem(
-    mesh, edge_kernels, vertex_kernels, face_kernels, dirichlets
+    mesh,
+    edge_kernels,
+    vertex_kernels,
+    face_kernels,
+    dirichlets,
+    stencil=None,
+    batch_shape=(),
+    dtype=None,
 ):
-    V, I, J, rhs = _get_VIJ(mesh, edge_kernels, vertex_kernels, face_kernels)
+    """Assemble the matrix and the right-hand side of a linear problem. With
+    `dtype`, e.g., `np.float32`, the off-diagonal kernel values are cast to `dtype`
+    as they are computed, and the matrix is summed up and stored in it; the
+    right-hand side is always double.
+    """
+    if stencil is not None and not face_kernels and batch_shape == ():
+        return _get_linear_fvm_problem_dia(
+            mesh, edge_kernels, vertex_kernels, dirichlets, stencil, dtype
+        )
+
+    V, I, J, rhs = _get_VIJ(
+        mesh, edge_kernels, vertex_kernels, face_kernels, batch_shape, dtype
+    )
 
     # One unknown per vertex
     n = len(mesh.points)
-    # Transform to CSR format for efficiency
-    matrix = sparse.coo_matrix((V, (I, J)), shape=(n, n))
-    matrix = matrix.tocsr()
+    # Transform to CSR format for efficiency. For a batch, the sparsity pattern is
+    # shared.
+    pattern = SparsityPattern(I, J, n)
+    data = pattern.get_data(V)
 
     # Apply Dirichlet conditions.
-    d = matrix.diagonal()
     for dirichlet in dirichlets:
         vertex_mask = mesh.get_vertex_mask(dirichlet.subdomain)
-        # Set all Dirichlet rows to 0.
-        for i in np.where(vertex_mask)[0]:
-            matrix.data[matrix.indptr[i] : matrix.indptr[i + 1]] = 0.0
+        # Set all Dirichlet rows to 0, set the diagonal and RHS.
+        coeff, rhs_vals = dirichlet.eval(vertex_mask)
+        pattern.set_rows(data, np.where(vertex_mask)[0], coeff)
+        rhs[..., vertex_mask] = rhs_vals
+
+    data = cast_data(data, dtype)
+    if batch_shape == ():
+        return pattern.get_csr(data), rhs
+
+    return CsrBatch(pattern.indptr, pattern.indices, data, pattern.shape), rhs
+
+
+def get_linear_fvm_operator(
+    mesh, edge_kernels, vertex_kernels, face_kernels, dirichlets, stencil=None
+):
+    """Like `get_linear_fvm_problem`, but instead of a sparse matrix, return a
+    `LinearFvmOperator` whose matvec evaluates the kernels against the input vector.
+    """
+    n = len(mesh.points)
+    rhs = np.zeros(n)
+
+    for edge_kernel in edge_kernels:
+        for subdomain in edge_kernel.subdomains:
+            cell_mask = mesh.get_cell_mask(subdomain)
+            _, v_rhs, nec = edge_kernel.eval(mesh, cell_mask)
+            scatter_edge_values(rhs, nec, -v_rhs, stencil, cell_mask)
+
+    for vertex_kernel in vertex_kernels:
+        for subdomain in vertex_kernel.subdomains:
+            vertex_mask = mesh.get_vertex_mask(subdomain)
+            _, vals_rhs = vertex_kernel.eval(vertex_mask)
+            rhs[vertex_mask] -= vals_rhs
+
+    for face_kernel in face_kernels:
+        for subdomain in face_kernel.subdomains:
+            face_mask = mesh.get_face_mask(subdomain)
+            _, vals_rhs = face_kernel.eval(face_mask)
+            npx.subtract_at(rhs, mesh.idx[-1][..., face_mask], vals_rhs)
+
+    for dirichlet in dirichlets:
+        vertex_mask = mesh.get_vertex_mask(dirichlet.subdomain)
+        _, rhs_vals = dirichlet.eval(vertex_mask)
+        rhs[vertex_mask] = rhs_vals
+
+    operator = LinearFvmOperator(
+        mesh, edge_kernels, vertex_kernels, face_kernels, dirichlets, stencil
+    )
+    return operator, rhs
+
+
+class LinearFvmOperator(KernelOperator):
+    """Matrix-free matrix of a linear problem. No matrix entries or indices are
+    stored; every matvec evaluates the kernels.
+    """
 
-        # Set the diagonal and RHS.
+    def __init__(
+        self, mesh, edge_kernels, vertex_kernels, face_kernels, dirichlets, stencil
+    ):
+        self.edge_kernels = edge_kernels
+        self.vertex_kernels = vertex_kernels
+        self.face_kernels = face_kernels
+        self.dirichlets = dirichlets
+        super().__init__(mesh, stencil)
+
+    def _get_edge_values(self, restriction=None):
+        for edge_kernel in self.edge_kernels:
+            for subdomain in edge_kernel.subdomains:
+                cell_mask = self._get_cells(subdomain, restriction)
+                v_mtx, _, nec = edge_kernel.eval(self.mesh, cell_mask)
+                yield v_mtx, nec, cell_mask
+
+    def _get_vertex_values(self, restriction=None):
+        for vertex_kernel in self.vertex_kernels:
+            for subdomain in vertex_kernel.subdomains:
+                vertex_mask = self._get_vertices(subdomain, restriction)
+                yield vertex_kernel.eval(vertex_mask)[0], vertex_mask
+
+    def _get_face_values(self):
+        for face_kernel in self.face_kernels:
+            for subdomain in face_kernel.subdomains:
+                face_mask = self.mesh.get_face_mask(subdomain)
+                ids = self.mesh.idx[-1][..., face_mask]
+                yield face_kernel.eval(face_mask)[0], ids
+
+    def _get_dirichlet_values(self, restriction=None):
+        for dirichlet in self.dirichlets:
+            vertex_mask = self._get_vertices(dirichlet.subdomain, restriction)
+            yield dirichlet.eval(vertex_mask)[0], vertex_mask
+
+
+def _get_linear_fvm_problem_dia(
+    mesh, edge_kernels, vertex_kernels, dirichlets, stencil, dtype=None
+):
+    n = len(mesh.points)
+    diag = np.zeros(n)
+    rhs = np.zeros(n)
+
+    edge_vals = []
+    for edge_kernel in edge_kernels:
+        for subdomain in edge_kernel.subdomains:
+            cell_mask = mesh.get_cell_mask(subdomain)
+            # The stencil covers all cells
+            assert isinstance(cell_mask, slice)
+
+            v_mtx, v_rhs, _ = edge_kernel.eval(mesh, cell_mask)
+            edge_vals.append(np.array(v_mtx))
+            stencil.scatter(rhs, -np.array(v_rhs))
+
+    for vertex_kernel in vertex_kernels:
+        for subdomain in vertex_kernel.subdomains:
+            vertex_mask = mesh.get_vertex_mask(subdomain)
+            vals_matrix, vals_rhs = vertex_kernel.eval(vertex_mask)
+            diag[vertex_mask] += vals_matrix
+            rhs[vertex_mask] -= vals_rhs
+
+    data = stencil.get_dia_data(diag, edge_vals)
+
+    # Apply Dirichlet conditions.
+    for dirichlet in dirichlets:
+        vertex_mask = mesh.get_vertex_mask(dirichlet.subdomain)
+        rows = np.where(vertex_mask)[0]
         coeff, rhs_vals = dirichlet.eval(vertex_mask)
-        d[vertex_mask] = coeff
+        stencil.zero_rows(data, rows)
+        stencil.set_diagonal(data, rows, coeff)
         rhs[vertex_mask] = rhs_vals
 
-    matrix.setdiag(d)
+    return stencil.get_dia_matrix(cast_data(data, dtype)), rhs
+
 
-    return matrix, rhs
+def _add_at(a, indices, b):
+    """npx.add_at() for `a` with a leading batch axis."""
+    if a.ndim == 1:
+        npx.add_at(a, indices, b)
+    else:
+        np.add.at(a.T, indices, np.moveaxis(b, 0, -1))
 
 
-def _get_VIJ(mesh, edge_kernels, vertex_kernels, face_kernels):
+def _get_VIJ(
+    mesh, edge_kernels, vertex_kernels, face_kernels, batch_shape=(), dtype=None
+):
     V = []
     I = []
     J = []
     n = len(mesh.points)
     # Treating the diagonal explicitly makes tocsr() faster at the cost of a bunch of
     # np.add.at().
-    diag = np.zeros(n)
+    diag = np.zeros(batch_shape + (n,))
     #
-    rhs = np.zeros(n)
+    rhs = np.zeros(batch_shape + (n,))
 
     for edge_kernel in edge_kernels:
         for subdomain in edge_kernel.subdomains:
             cell_mask = mesh.get_cell_mask(subdomain)
 
             v_mtx, v_rhs, nec = edge_kernel.eval(mesh, cell_mask)
+            v_mtx = v_mtx.reshape(batch_shape + (2, 2, -1))
+            v_rhs = v_rhs.reshape(batch_shape + (2, -1))
+            nec = nec.reshape(2, -1)
 
             # Diagonal entries.
             # Manually sum up the entries corresponding to the same i, j first.
-            npx.add_at(diag, nec[0], v_mtx[0][0])
-            npx.add_at(diag, nec[1], v_mtx[1][1])
+            _add_at(diag, nec[0], v_mtx[..., 0, 0, :])
+            _add_at(diag, nec[1], v_mtx[..., 1, 1, :])
 
             # offdiagonal entries
-            V.append(v_mtx[0][1])
+            V.append(cast_data(v_mtx[..., 0, 1, :], dtype))
             I.append(nec[0])
             J.append(nec[1])
             #
-            V.append(v_mtx[1][0])
+            V.append(cast_data(v_mtx[..., 1, 0, :], dtype))
             I.append(nec[1])
             J.append(nec[0])
 
             # Right-hand side.
-            npx.subtract_at(rhs, nec[0], v_rhs[0])
-            npx.subtract_at(rhs, nec[1], v_rhs[1])
+            _add_at(rhs, nec[0], -v_rhs[..., 0, :])
+            _add_at(rhs, nec[1], -v_rhs[..., 1, :])
 
             # if dot() is used in the expression, the shape of of v_matrix will
             # be (2, 2, 1, k) instead of (2, 2, 871, k).
@@ -85,12 +234,8 @@ def _get_VIJ(mesh, edge_kernels, vertex_kernels, face_kernels):
 
             # np.add.at(diag, verts, vals_matrix)
             # np.subtract.at(rhs, verts, vals_rhs)
-            if vertex_mask == np.s_[:]:
-                diag += vals_matrix
-                rhs -= vals_rhs
-            else:
-                diag[vertex_mask] += vals_matrix
-                rhs[vertex_mask] -= vals_rhs
+            diag[..., vertex_mask] += vals_matrix
+            rhs[..., vertex_mask] -= vals_rhs
 
     for face_kernel in face_kernels:
         for subdomain in face_kernel.subdomains:
@@ -99,7 +244,7 @@ def _get_VIJ(mesh, edge_kernels, vertex_kernels, face_kernels):
 
             ids = mesh.idx[-1][..., face_mask]
 
-            V.append(vals_matrix)
+            V.append(cast_data(vals_matrix, dtype))
             I.append(ids)
             J.append(ids)
 
@@ -108,10 +253,10 @@ def _get_VIJ(mesh, edge_kernels, vertex_kernels, face_kernels):
     # add diagonal
     I.append(np.arange(n))
     J.append(np.arange(n))
-    V.append(diag)
+    V.append(cast_data(diag, dtype))
 
-    # Finally, make V, I, J into 1D-arrays.
-    V = np.concatenate([v.flat for v in V])
+    # Finally, make V, I, J into 1D-arrays (with leading batch axes for V).
+    V = np.concatenate([np.reshape(v, batch_shape + (-1,)) for v in V], axis=-1)
     I = np.concatenate([i.flat for i in I])
     J = np.concatenate([j.flat for j in J])
 
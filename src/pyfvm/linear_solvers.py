@@ -0,0 +1,416 @@
+import inspect
+
+import numpy as np
+from scipy import sparse
+from scipy.sparse import linalg
+
+from .recycling import RecyclingGmres
+from .wirtinger import WirtingerOperator, from_real, to_real
+
+
+def krylov_solve(method, A, b, rtol, M=None, x0=None, maxiter=None):
+    """Solve A x = b with one of scipy's Krylov methods ("gmres", "cg",
+    "bicgstab",...) up to the relative residual `rtol`. Returns the solution, the
+    scipy info flag, and the number of iterations.
+    """
+    solver = getattr(linalg, method)
+    num_iterations = [0]
+
+    def callback(*args):
+        num_iterations[0] += 1
+
+    kwargs = {"M": M, "x0": x0, "maxiter": maxiter, "callback": callback}
+    if method == "gmres":
+        kwargs["callback_type"] = "pr_norm"
+    # scipy < 1.12 calls the relative tolerance `tol`
+    if "rtol" in inspect.signature(solver).parameters:
+        kwargs["rtol"] = rtol
+    else:
+        kwargs["tol"] = rtol
+    x, info = solver(A, b, atol=0.0, **kwargs)
+    return x, info, num_iterations[0]
+
+
+def _solve_real(solve, real_matrix, rhs, rtol):
+    """Solve a system with a `WirtingerOperator` through its real form."""
+    x, num_iterations = solve(real_matrix, to_real(rhs), rtol)
+    return from_real(x), num_iterations
+
+
+def get_lu_preconditioner(matrix):
+    """Sparse LU factorization of `matrix` as a preconditioner for scipy's Krylov
+    methods.
+    """
+    lu = linalg.splu(sparse.csc_matrix(matrix))
+    return linalg.LinearOperator(matrix.shape, matvec=lu.solve, dtype=lu.L.dtype)
+
+
+class DirectSolver:
+    """Sparse LU solver. The factorization is kept as long as the same matrix is
+    passed, so a lagged Jacobian is factored only once.
+    """
+
+    def __init__(self):
+        self.num_factorizations = 0
+        self._matrix = None
+        self._lu = None
+
+    @property
+    def lu(self):
+        """The factorization (`scipy.sparse.linalg.SuperLU`) of the last matrix, or
+        None; e.g., for adjoint solves with its transpose.
+        """
+        return self._lu
+
+    def __call__(self, matrix, rhs, rtol=None):
+        if isinstance(matrix, WirtingerOperator):
+            return _solve_real(self, matrix.get_real_matrix(), rhs, rtol)
+        if matrix is not self._matrix:
+            self._lu = linalg.splu(sparse.csc_matrix(matrix))
+            self._matrix = matrix
+            self.num_factorizations += 1
+        return self._lu.solve(rhs), 0
+
+
+class KrylovSolver:
+    """Krylov solver for Newton corrections. `preconditioner` is a function that
+    takes the matrix and returns a preconditioner for scipy's Krylov methods; it is
+    only called when the matrix changes.
+    """
+
+    def __init__(self, method="gmres", preconditioner=None, maxiter=None):
+        self.method = method
+        self.preconditioner = preconditioner
+        self.maxiter = maxiter
+        self._matrix = None
+        self._M = None
+
+    def __call__(self, matrix, rhs, rtol):
+        if isinstance(matrix, WirtingerOperator):
+            return _solve_real(self, matrix.get_real_operator(), rhs, rtol)
+        if self.preconditioner is not None and matrix is not self._matrix:
+            self._M = self.preconditioner(matrix)
+            self._matrix = matrix
+
+        x, info, num_iterations = krylov_solve(
+            self.method, matrix, rhs, rtol, M=self._M, maxiter=self.maxiter
+        )
+        if info < 0:
+            raise RuntimeError(f"{self.method} broke down (info = {info})")
+        assert np.all(np.isfinite(x))
+        return x, num_iterations
+
+
+class MixedPrecisionSolver:
+    """Solves linear systems to double-precision accuracy with a single-precision
+    sparse LU factorization (`method="lu"`) or pyamg hierarchy (`method="amg"`).
+
+    The setup is built from `matrix` cast to `dtype` (or from an already
+    single-precision `setup_matrix`, e.g., from `discretize_linear(...,
+    dtype=np.float32)`) and is kept as long as the same matrix is passed. Residuals
+    are computed in double precision with `matrix`, which can also be a matrix-free
+    operator. With LU, the solution is improved by iterative refinement; with AMG,
+    the V-cycle preconditions a double-precision Krylov method.
+
+    Call it as `(matrix, rhs, rtol) -> (x, num_iterations)`, e.g., as the
+    `linear_solver` of `inexact_newton`. With a `jacobian`, `jacobian_solver`
+    assembles the Jacobian only in `dtype` and can be passed to `newton`.
+    """
+
+    def __init__(
+        self,
+        jacobian=None,
+        method="lu",
+        dtype=np.float32,
+        krylov_method="gmres",
+        rtol=1.0e-10,
+        max_iter=50,
+        amg_options=None,
+    ):
+        assert method in ["lu", "amg"]
+        self.jacobian = jacobian
+        self.method = method
+        self.dtype = dtype
+        self.krylov_method = krylov_method
+        self.rtol = rtol
+        self.max_iter = max_iter
+        self.amg_options = {} if amg_options is None else amg_options
+
+        self.num_setups = 0
+        self._setup_matrix = None
+        self._solve = None
+
+    def _setup(self, matrix):
+        dtype = self.dtype
+        if np.issubdtype(matrix.dtype, np.complexfloating):
+            dtype = np.promote_types(dtype, np.complex64)
+
+        if self.method == "lu":
+            lu = linalg.splu(sparse.csc_matrix(matrix, dtype=dtype))
+            self._solve = lu.solve
+        else:
+            import pyamg
+
+            ml = pyamg.smoothed_aggregation_solver(
+                sparse.csr_matrix(matrix, dtype=dtype), **self.amg_options
+            )
+            M = ml.aspreconditioner()
+            self._solve = M.matvec
+
+        self._dtype = dtype
+        self._setup_matrix = matrix
+        self.num_setups += 1
+
+    def _precondition(self, r):
+        """Apply the low-precision setup to a double-precision vector."""
+        scale = np.max(np.abs(r))
+        if scale == 0.0:
+            return np.zeros_like(r)
+        # Scale to avoid underflow in single precision.
+        x = self._solve((r / scale).astype(self._dtype))
+        return scale * x.astype(np.result_type(r, x, np.float64))
+
+    def __call__(self, matrix, rhs, rtol=None, setup_matrix=None):
+        if rtol is None:
+            rtol = self.rtol
+        if setup_matrix is None:
+            setup_matrix = matrix
+        if setup_matrix is not self._setup_matrix:
+            self._setup(setup_matrix)
+
+        if self.method == "amg":
+            dtype = np.result_type(rhs, self._dtype, np.float64)
+            M = linalg.LinearOperator(
+                matrix.shape, matvec=self._precondition, dtype=dtype
+            )
+            x, info, num_iterations = krylov_solve(
+                self.krylov_method, matrix, rhs, rtol, M=M, maxiter=self.max_iter
+            )
+            if info < 0:
+                raise RuntimeError(f"{self.krylov_method} broke down (info = {info})")
+            return x, num_iterations
+
+        # iterative refinement
+        rhs_norm = np.linalg.norm(rhs)
+        x = np.zeros(matrix.shape[0], dtype=np.result_type(rhs, self._dtype))
+        r = rhs
+        k = 0
+        while k < self.max_iter and np.linalg.norm(r) > rtol * rhs_norm:
+            x += self._precondition(r)
+            r = rhs - matrix @ x
+            k += 1
+        return x, k
+
+    def jacobian_solver(self, u, rhs):
+        """Solve J(u) du = rhs; can be passed to `newton`. The Jacobian is only
+        assembled in `dtype`; the residuals are computed matrix-free.
+        """
+        setup_matrix = self.jacobian.get_linear_operator(u, dtype=self.dtype)
+        operator = self.jacobian.get_linear_operator(u, matrix_free=True)
+        return self(operator, rhs, setup_matrix=setup_matrix)[0]
+
+
+def get_linear_solver(linear_solver):
+    """Turn the `linear_solver` argument of the nonlinear solvers into a function
+    `(matrix, rhs, rtol) -> (x, num_linear_iterations)`.
+    """
+    if linear_solver == "direct":
+        return DirectSolver()
+    if linear_solver == "gcrodr":
+        return RecyclingGmres()
+    if isinstance(linear_solver, str):
+        return KrylovSolver(linear_solver)
+    assert callable(linear_solver)
+    return linear_solver
+
+
+def _get_amg_defaults():
+    """pyamg's default smoothers and coarse solver."""
+    import pyamg
+
+    defaults = {}
+    for fun, keys in [
+        (pyamg.smoothed_aggregation_solver, ["presmoother", "postsmoother"]),
+        (pyamg.multilevel.MultilevelSolver, ["coarse_solver"]),
+    ]:
+        parameters = inspect.signature(fun).parameters
+        for key in keys:
+            defaults[key] = parameters[key].default
+    return defaults
+
+
+class SolverContext:
+    """Keeps the setup of a linear solver, a sparse LU factorization
+    (`method="lu"`) or a pyamg smoothed aggregation hierarchy (`method="amg"`),
+    across a sequence of matrices with the same sparsity pattern, e.g., the
+    Jacobians of a Newton iteration.
+
+    Every system is solved with a Krylov method preconditioned by the kept setup.
+    The LU factorization of an older matrix is reused as is; for AMG, the
+    aggregates and transfer operators are kept and only the coarse-level matrices
+    and the smoothers are recomputed from the new values. The setup is rebuilt from
+    scratch for the next matrix once a solve needed `rebuild_iterations` Krylov
+    iterations more than the first solve after the last setup, or after `max_age`
+    refreshes.
+
+    Call it as `(matrix, rhs, rtol) -> (x, num_linear_iterations)`, e.g., as the
+    `linear_solver` of `inexact_newton`. With a `jacobian`, `jacobian_solver` can
+    be passed to `newton`.
+
+    With `krylov_method="gcrodr"`, the Krylov solves recycle a deflation subspace
+    from one system to the next (see `RecyclingGmres`).
+
+    `near_nullspace` (vectors as columns) is passed to pyamg as the candidate
+    vectors `B` that the aggregation-based interpolation reproduces exactly, e.g.,
+    `[constant_mode(mesh), gauge_mode(psi)]` stacked as columns. By default, pyamg
+    uses the constant vector.
+
+    `presmoother`, `postsmoother`, and `coarse_solver` are passed to pyamg (as are
+    the other `amg_options`); without them, pyamg's defaults are used for the setup
+    and for the refreshes.
+    """
+
+    def __init__(
+        self,
+        jacobian=None,
+        method="lu",
+        krylov_method="gmres",
+        rtol=1.0e-10,
+        rebuild_iterations=10,
+        max_age=None,
+        amg_options=None,
+        near_nullspace=None,
+        presmoother=None,
+        postsmoother=None,
+        coarse_solver=None,
+    ):
+        assert method in ["lu", "amg"]
+        self.jacobian = jacobian
+        self.method = method
+        self.krylov_method = krylov_method
+        self.rtol = rtol
+        self.rebuild_iterations = rebuild_iterations
+        self.max_age = max_age
+        self.amg_options = {} if amg_options is None else dict(amg_options)
+        for key, value in [
+            ("presmoother", presmoother),
+            ("postsmoother", postsmoother),
+            ("coarse_solver", coarse_solver),
+        ]:
+            if value is not None:
+                self.amg_options[key] = value
+        if near_nullspace is not None:
+            B = np.asarray(near_nullspace)
+            self.amg_options["B"] = B.reshape(B.shape[0], -1)
+
+        self.num_setups = 0
+        self.num_refreshes = 0
+        self.num_solves = 0
+        self.num_linear_iterations = 0
+
+        self._matrix = None
+        self._setup_matrix = None
+        self._lu = None
+        self._ml = None
+        self._M = None
+        self._age = 0
+        self._is_stale = False
+        self._base_iterations = None
+        self._recycler = RecyclingGmres() if krylov_method == "gcrodr" else None
+
+    @property
+    def lu(self):
+        """The kept factorization (`scipy.sparse.linalg.SuperLU`) for
+        `method="lu"`, or None.
+        """
+        return self._lu
+
+    def _setup(self, matrix):
+        if self.method == "lu":
+            self._lu = linalg.splu(sparse.csc_matrix(matrix))
+            self._M = linalg.LinearOperator(
+                matrix.shape, matvec=self._lu.solve, dtype=self._lu.L.dtype
+            )
+        else:
+            import pyamg
+
+            self._ml = pyamg.smoothed_aggregation_solver(
+                sparse.csr_matrix(matrix), **self.amg_options
+            )
+            self._M = self._ml.aspreconditioner()
+
+        self._setup_matrix = matrix
+        self._age = 0
+        self._is_stale = False
+        self._base_iterations = None
+        self.num_setups += 1
+
+    def _refresh(self, matrix):
+        if self.method == "amg":
+            from pyamg.multilevel import coarse_grid_solver
+            from pyamg.relaxation.smoothing import change_smoothers
+
+            levels = self._ml.levels
+            levels[0].A = sparse.csr_matrix(matrix)
+            for fine, coarse in zip(levels[:-1], levels[1:]):
+                coarse.A = sparse.csr_matrix(fine.R @ fine.A @ fine.P)
+            # The smoothers and the coarse solver are redone for the new values.
+            options = _get_amg_defaults()
+            options.update(self.amg_options)
+            change_smoothers(self._ml, options["presmoother"], options["postsmoother"])
+            self._ml.coarse_solver = coarse_grid_solver(options["coarse_solver"])
+
+        self._age += 1
+        self.num_refreshes += 1
+
+    def __call__(self, matrix, rhs, rtol=None):
+        if isinstance(matrix, WirtingerOperator):
+            return _solve_real(self, matrix.get_real_matrix(), rhs, rtol)
+        if rtol is None:
+            rtol = self.rtol
+
+        if (
+            self._M is None
+            or self._is_stale
+            or (self.max_age is not None and self._age >= self.max_age)
+        ):
+            self._setup(matrix)
+        elif matrix is not self._matrix:
+            self._refresh(matrix)
+        self._matrix = matrix
+
+        self.num_solves += 1
+        if self.method == "lu" and matrix is self._setup_matrix:
+            self._base_iterations = 0
+            return self._lu.solve(rhs), 0
+
+        x, info, n = self._krylov_solve(matrix, rhs, rtol)
+        self.num_linear_iterations += n
+        num_iterations = n
+        if info != 0 and matrix is not self._setup_matrix:
+            # The setup is too far off; rebuild it and solve again. Only the solve
+            # with the new setup serves as the reference for later solves.
+            self._setup(matrix)
+            if self.method == "lu":
+                self._base_iterations = 0
+                return self._lu.solve(rhs), num_iterations
+            x, info, n = self._krylov_solve(matrix, rhs, rtol)
+            self.num_linear_iterations += n
+            num_iterations += n
+        if info < 0:
+            raise RuntimeError(f"{self.krylov_method} broke down (info = {info})")
+
+        if self._base_iterations is None:
+            self._base_iterations = n
+        elif n > self._base_iterations + self.rebuild_iterations:
+            self._is_stale = True
+        return x, num_iterations
+
+    def _krylov_solve(self, matrix, rhs, rtol):
+        if self._recycler is not None:
+            return self._recycler.solve(matrix, rhs, rtol, M=self._M)
+        return krylov_solve(self.krylov_method, matrix, rhs, rtol, M=self._M)
+
+    def jacobian_solver(self, u, rhs):
+        """Solve J(u) du = rhs; can be passed to `newton`."""
+        return self(self.jacobian.get_linear_operator(u), rhs)[0]
@@ -0,0 +1,117 @@
+import numpy as np
+from scipy import sparse
+
+
+class MeshBatch:
+    """Many independent meshes combined into one mesh.
+
+    A `MeshBatch` can be passed to `discretize_linear` or `discretize` instead of a
+    single mesh. The kernels are then compiled once and evaluated once over the
+    concatenated mesh arrays, yielding one block-diagonal system. Use `split()` to
+    get the per-mesh systems; their data arrays are views into the combined system.
+    """
+
+    def __init__(self, meshes):
+        self.meshes = list(meshes)
+
+        num_points = [len(mesh.points) for mesh in self.meshes]
+        self.point_offsets = np.concatenate([[0], np.cumsum(num_points)])
+        num_cells = [mesh.idx[-1].shape[-1] for mesh in self.meshes]
+        self.cell_offsets = np.concatenate([[0], np.cumsum(num_cells)])
+
+        self.points = np.concatenate([mesh.points for mesh in self.meshes])
+        # Only the node-edge-cell indices are needed by the kernels.
+        self.idx = [
+            np.concatenate(
+                [
+                    mesh.idx[-1] + offset
+                    for mesh, offset in zip(self.meshes, self.point_offsets)
+                ],
+                axis=-1,
+            )
+        ]
+        self._cache = {}
+
+    def __len__(self):
+        return len(self.meshes)
+
+    def _concatenate(self, name):
+        if name not in self._cache:
+            self._cache[name] = np.concatenate(
+                [getattr(mesh, name) for mesh in self.meshes], axis=-1
+            )
+        return self._cache[name]
+
+    @property
+    def ce_ratios(self):
+        return self._concatenate("ce_ratios")
+
+    @property
+    def edge_lengths(self):
+        return self._concatenate("edge_lengths")
+
+    @property
+    def ei_dot_ei(self):
+        return self._concatenate("ei_dot_ei")
+
+    @property
+    def control_volumes(self):
+        return self._concatenate("control_volumes")
+
+    @property
+    def face_partitions(self):
+        return self._concatenate("face_partitions")
+
+    def _get_mask(self, masks, offsets, shape=()):
+        if all(isinstance(mask, slice) and mask == np.s_[:] for mask in masks):
+            return np.s_[:]
+        out = np.ones(shape + (offsets[-1],), dtype=bool)
+        for mask, start, end in zip(masks, offsets[:-1], offsets[1:]):
+            out[..., start:end] = mask if not isinstance(mask, slice) else True
+        return out
+
+    def get_vertex_mask(self, subdomain=None):
+        masks = [mesh.get_vertex_mask(subdomain) for mesh in self.meshes]
+        return self._get_mask(masks, self.point_offsets)
+
+    def get_cell_mask(self, subdomain=None):
+        masks = [mesh.get_cell_mask(subdomain) for mesh in self.meshes]
+        return self._get_mask(masks, self.cell_offsets)
+
+    def get_face_mask(self, subdomain=None):
+        """Mask of the faces of all cells, of shape (faces per cell, num cells)."""
+        masks = [mesh.get_face_mask(subdomain) for mesh in self.meshes]
+        return self._get_mask(masks, self.cell_offsets, self.idx[-1].shape[-2:-1])
+
+    def split(self, matrix, rhs=None):
+        """Split the block-diagonal CSR `matrix` (and `rhs`) of the combined mesh
+        into the per-mesh systems. The data of the per-mesh matrices are views into
+        `matrix.data`, so the combined system can be updated in place.
+        """
+        matrix = sparse.csr_matrix(matrix)
+        out = []
+        for start, end in zip(self.point_offsets[:-1], self.point_offsets[1:]):
+            p0 = matrix.indptr[start]
+            p1 = matrix.indptr[end]
+            block = sparse.csr_matrix(
+                (
+                    matrix.data[p0:p1],
+                    matrix.indices[p0:p1] - start,
+                    matrix.indptr[start : end + 1] - p0,
+                ),
+                shape=(end - start, end - start),
+            )
+            # Make sure the data is a view, not a copy
+            block.data = matrix.data[p0:p1]
+            out.append(block)
+
+        if rhs is None:
+            return out
+        return out, self.split_vector(rhs)
+
+    def split_vector(self, u):
+        """Split a vector on the combined mesh into (views of) per-mesh vectors."""
+        return [
+            u[..., start:end]
+            for start, end in zip(self.point_offsets[:-1], self.point_offsets[1:])
+        ]
@@ -0,0 +1,298 @@
+import npx
+import numpy as np
+from scipy import sparse
+from scipy.sparse import linalg
+
+from .kernel_operator import KernelOperator
+
+
+class AgglomerationMultigrid(linalg.LinearOperator):
+    """Agglomeration multigrid preconditioner for scipy's Krylov methods.
+
+    The control volumes of the mesh are agglomerated along the dual graph whose
+    edge weights are the ce-ratios (covolume over edge length) of the mesh. On every
+    level, the operator is re-discretized on the agglomerated control volumes by
+    summing up the fine couplings between different agglomerates. This is cheaper
+    than smoothed aggregation, whose coarse operators have much larger stencils. For
+    a `KernelOperator` (`matrix_free=True`), the finest operator is never assembled;
+    its first coarse operator is summed up directly from the edge kernels.
+
+    The smoother is a Chebyshev polynomial of degree `smoother_degree` in the
+    Jacobi-preconditioned operator, which needs only matvecs and the diagonal. Its
+    interval is [lmax / `smoother_ratio`, lmax], with lmax the Gershgorin bound.
+    The preconditioner is symmetric if the operator is, so it can be used with CG.
+
+    `cycle` is "W" (default) or "V"; with piecewise constant prolongation, the
+    V-cycle converges noticeably worse on fine meshes. Levels are added until the
+    operator has at most `max_coarse` rows; the coarsest system is solved with a
+    pseudo-inverse, so singular (e.g., pure-Neumann) operators work, too.
+    """
+
+    def __init__(
+        self,
+        A,
+        mesh=None,
+        max_levels=20,
+        max_coarse=200,
+        strength=0.25,
+        smoother_degree=2,
+        smoother_ratio=30.0,
+        cycle="W",
+        seed=0,
+    ):
+        assert cycle in ["V", "W"]
+        if mesh is None:
+            mesh = A.mesh
+        self.cycle = cycle
+        self.smoother_degree = smoother_degree
+        self.smoother_ratio = smoother_ratio
+        rng = np.random.default_rng(seed)
+
+        if not isinstance(A, KernelOperator):
+            A = sparse.csr_matrix(A)
+        weights = get_edge_weights(mesh)
+
+        self.levels = []
+        while True:
+            level = _Level(A, smoother_ratio)
+            self.levels.append(level)
+            if A.shape[0] <= max_coarse or len(self.levels) == max_levels:
+                break
+
+            level.aggregates = _aggregate(weights, strength, rng)
+            nc = np.max(level.aggregates) + 1
+            if nc == A.shape[0]:
+                # no coarsening possible
+                break
+            A = _coarsen(_get_coo(A), level.aggregates, nc)
+            weights = _coarsen(weights.tocoo(), level.aggregates, nc)
+            weights.setdiag(0.0)
+            weights.eliminate_zeros()
+
+        self.levels[-1].aggregates = None
+        coarsest = self.levels[-1].A
+        if isinstance(coarsest, KernelOperator):
+            coarsest = coarsest @ np.eye(coarsest.shape[0])
+        self._coarse_inverse = np.linalg.pinv(
+            coarsest.toarray() if sparse.issparse(coarsest) else coarsest
+        )
+
+        dtype = np.result_type(self.levels[0].A.dtype, float)
+        super().__init__(dtype, self.levels[0].A.shape)
+
+    def _matvec(self, b):
+        b = np.ravel(b)
+        return self._solve(0, b.astype(np.result_type(b, self.dtype)))
+
+    def _solve(self, k, b):
+        level = self.levels[k]
+        if level.aggregates is None:
+            return self._coarse_inverse @ b
+
+        x = level.smooth(b, np.zeros_like(b), self.smoother_degree)
+
+        r = b - level.A @ x
+        nc = self.levels[k + 1].A.shape[0]
+        rc = np.zeros(nc, dtype=r.dtype)
+        if np.iscomplexobj(r):
+            np.add.at(rc, level.aggregates, r)
+        else:
+            npx.add_at(rc, level.aggregates, r)
+
+        num_visits = 1 if self.cycle == "V" or k + 2 == len(self.levels) else 2
+        ec = np.zeros_like(rc)
+        for _ in range(num_visits):
+            ec += self._solve(k + 1, rc - self.levels[k + 1].A @ ec)
+        x += ec[level.aggregates]
+
+        return level.smooth(b, x, self.smoother_degree)
+
+
+class _Level:
+    def __init__(self, A, smoother_ratio):
+        self.A = A
+        self.aggregates = None
+
+        if isinstance(A, KernelOperator):
+            diag = A.diagonal()
+            row_sums = A.row_sums(absolute=True)
+        else:
+            diag = A.diagonal()
+            row_sums = np.asarray(abs(A).sum(axis=1)).reshape(-1)
+        diag = np.where(diag == 0.0, 1.0, diag)
+        self.inv_diag = 1.0 / diag
+        # Gershgorin bound of the spectrum of D^{-1} A
+        self.lmax = np.max(row_sums / np.abs(diag))
+        self.lmin = self.lmax / smoother_ratio
+
+    def smooth(self, b, x, degree):
+        """Chebyshev iteration for D^{-1} A on [lmin, lmax]."""
+        theta = 0.5 * (self.lmax + self.lmin)
+        delta = 0.5 * (self.lmax - self.lmin)
+        sigma = theta / delta
+        rho = 1.0 / sigma
+
+        r = self.inv_diag * (b - self.A @ x)
+        d = r / theta
+        for k in range(degree):
+            x = x + d
+            if k == degree - 1:
+                break
+            r = r - self.inv_diag * (self.A @ d)
+            rho_new = 1.0 / (2.0 * sigma - rho)
+            d = rho_new * rho * d + 2.0 * rho_new / delta * r
+            rho = rho_new
+        return x
+
+
+def get_edge_weights(mesh):
+    """The dual graph of the mesh as a sparse symmetric matrix; the weight of an edge
+    is the sum of its (absolute) ce-ratios over the adjacent cells.
+    """
+    nec = mesh.idx[-1]
+    ce_ratios = np.abs(mesh.ce_ratios)
+    n = len(mesh.points)
+    i = nec[0].reshape(-1)
+    j = nec[1].reshape(-1)
+    w = ce_ratios.reshape(-1)
+    W = sparse.coo_matrix(
+        (np.concatenate([w, w]), (np.concatenate([i, j]), np.concatenate([j, i]))),
+        shape=(n, n),
+    ).tocsr()
+    W.sum_duplicates()
+    return W
+
+
+def _get_coo(A):
+    """COO entries (I, J, V) of the operator. For a `KernelOperator`, they are
+    collected from the kernels, so the matrix is never assembled.
+    """
+    if not isinstance(A, KernelOperator):
+        coo = A.tocoo()
+        return coo.row, coo.col, coo.data, A.shape
+
+    I_ = []
+    J = []
+    V = []
+    for v_matrix, nec, _ in A._get_edge_values():
+        for a in [0, 1]:
+            for b in [0, 1]:
+                I_.append(nec[a].reshape(-1))
+                J.append(nec[b].reshape(-1))
+                V.append(v_matrix[a][b].reshape(-1))
+
+    n = A.shape[0]
+    for vals, vertex_mask in A._get_vertex_values():
+        verts = np.arange(n)[vertex_mask]
+        I_.append(verts)
+        J.append(verts)
+        V.append(np.broadcast_to(vals, verts.shape))
+
+    for vals, ids in A._get_face_values():
+        I_.append(ids.reshape(-1))
+        J.append(ids.reshape(-1))
+        V.append(np.broadcast_to(vals, ids.shape).reshape(-1))
+
+    I_ = np.concatenate(I_)
+    J = np.concatenate(J)
+    V = np.concatenate(V)
+
+    # Dirichlet rows only have their diagonal entry.
+    for coeff, vertex_mask in A._get_dirichlet_values():
+        verts = np.arange(n)[vertex_mask]
+        is_kept = ~np.isin(I_, verts)
+        I_ = np.concatenate([I_[is_kept], verts])
+        J = np.concatenate([J[is_kept], verts])
+        V = np.concatenate([V[is_kept], np.broadcast_to(coeff, verts.shape)])
+
+    return I_, J, V, A.shape
+
+
+def _coarsen(coo, aggregates, nc):
+    """Sum the entries of a COO matrix over the agglomerates."""
+    if sparse.issparse(coo):
+        coo = (coo.row, coo.col, coo.data, coo.shape)
+    I_, J, V, _ = coo
+    return sparse.coo_matrix(
+        (V, (aggregates[I_], aggregates[J])), shape=(nc, nc)
+    ).tocsr()
+
+
+def _aggregate(W, strength, rng):
+    """Agglomerate the vertices of the weighted graph `W`.
+
+    The roots are a maximal independent set of the strength graph, found with
+    Luby's randomized algorithm. Every other vertex joins the agglomerate of its
+    strongest assigned neighbor, the roots' neighbors first. This gives small
+    agglomerates (a coarsening factor of about 3 in 2D); together with the W-cycle,
+    that keeps the convergence of the unsmoothed prolongation in check.
+    """
+    n = W.shape[0]
+    W = sparse.csr_matrix(W)
+
+    # strong connections: at least `strength` times the largest weight in the row
+    row_max, _ = _get_row_max(W)
+    rows = np.repeat(np.arange(n), np.diff(W.indptr))
+    S = W.copy()
+    S.data = (W.data >= strength * row_max[rows]).astype(float)
+    S.eliminate_zeros()
+    S = S.maximum(S.T)
+
+    # Luby's maximal independent set
+    priority = rng.random(n) + 1.0
+    is_undecided = np.ones(n, dtype=bool)
+    is_root = np.zeros(n, dtype=bool)
+    while np.any(is_undecided):
+        p = np.where(is_undecided, priority, 0.0)
+        max_neighbor, _ = _get_row_max(_scale_columns(S, p))
+        new_roots = is_undecided & (p > max_neighbor)
+        is_root |= new_roots
+        is_undecided &= ~new_roots
+        is_undecided &= S @ new_roots.astype(float) == 0.0
+
+    aggregates = np.full(n, -1)
+    aggregates[is_root] = np.arange(np.sum(is_root))
+
+    # Assign the neighbors of the roots, then the rest, to the strongest
+    # neighboring agglomerate.
+    S_weighted = S.multiply(W).tocsr()
+    while np.any(aggregates < 0):
+        is_assigned = (aggregates >= 0).astype(float)
+        max_weight, strongest = _get_row_max(_scale_columns(S_weighted, is_assigned))
+        has_candidate = max_weight > 0.0
+        is_new = (aggregates < 0) & has_candidate
+        if not np.any(is_new):
+            # isolated vertices become their own agglomerates
+            isolated = aggregates < 0
+            aggregates[isolated] = np.max(aggregates) + 1 + np.arange(np.sum(isolated))
+            break
+        aggregates[is_new] = aggregates[strongest[is_new]]
+
+    return aggregates
+
+
+def _get_row_max(M):
+    """The maximum of every row of the nonnegative CSR matrix `M` and (the first)
+    column where it's attained; like `M.max(axis=1)` and `M.argmax(axis=1)`, but
+    vectorized.
+    """
+    n = M.shape[0]
+    counts = np.diff(M.indptr)
+    is_nonempty = counts > 0
+    row_max = np.zeros(n)
+    row_max[is_nonempty] = np.maximum.reduceat(M.data, M.indptr[:-1][is_nonempty])
+
+    rows = np.repeat(np.arange(n), counts)
+    pos = np.flatnonzero(M.data == row_max[rows])
+    # the rows of `pos` are sorted; take the first position in every row
+    is_first = np.diff(rows[pos], prepend=-1) > 0
+    argmax = np.zeros(n, dtype=int)
+    argmax[rows[pos[is_first]]] = M.indices[pos[is_first]]
+    return row_max, argmax
+
+
+def _scale_columns(M, d):
+    """M @ diag(d) for a CSR matrix `M`, keeping its sparsity pattern."""
+    M = M.copy()
+    M.data = M.data * d[M.indices]
+    return M
@@ -1,4 +1,13 @@
+import logging
+import time
+
 import numpy as np
+from scipy import sparse
+from scipy.sparse import linalg
+
+from .linear_solvers import get_linear_solver, get_lu_preconditioner, krylov_solve
+
+logger = logging.getLogger(__name__)
 
 
 def newton(f, jacobian_solver, u0, tol=1.0e-10, max_iter=20, verbose=True):
@@ -26,3 +35,796 @@ def newton(f, jacobian_solver, u0, tol=1.0e-10, max_iter=20, verbose=True):
     assert is_converged
 
     return u
+
+
+class SolverReport:
+    """Outcome of a nonlinear solve: convergence flag, residual history, work
+    counters, and one record (a dict with timings and counts) per iteration.
+    """
+
+    def __init__(self, method):
+        self.method = method
+        self.converged = False
+        self.message = ""
+        self.residual_norms = []
+        self.iterations = []
+        self.num_residual_evaluations = 0
+        self.num_jacobian_evaluations = 0
+        self.num_linear_solves = 0
+        self.num_linear_iterations = 0
+        self.time = 0.0
+
+    @property
+    def num_iterations(self):
+        return len(self.iterations)
+
+    def __repr__(self):
+        status = "converged" if self.converged else "not converged"
+        return (
+            f"<SolverReport {self.method}: {status} after {self.num_iterations} "
+            f"iterations, ||F|| = {self.residual_norms[-1]:.3e}, "
+            f"{self.num_residual_evaluations} residual evaluations, "
+            f"{self.num_jacobian_evaluations} Jacobian evaluations, "
+            f"{self.num_linear_iterations} linear iterations, {self.time:.3e} s>"
+        )
+
+
+def inexact_newton(
+    f,
+    jacobian,
+    u0,
+    tol=1.0e-10,
+    max_iter=50,
+    linear_solver="direct",
+    forcing="eisenstat-walker",
+    line_search="backtracking",
+    jacobian_lag=1,
+):
+    """Newton's method with line search, adaptive linear tolerances, and Jacobian
+    reuse. Returns the solution and a `SolverReport`.
+
+    `jacobian` is a `pyfvm.Jacobian` or a function `u -> matrix`. `linear_solver`
+    is "direct" (sparse LU), the name of a scipy Krylov method (e.g., "gmres"),
+    "gcrodr" (GMRES recycling a subspace across the Newton steps), or a function
+    `(matrix, rhs, rtol) -> (x, num_linear_iterations)`.
+
+    `forcing` sets the relative tolerance of the linear solves: "eisenstat-walker"
+    adapts it to the convergence of the nonlinear iteration, a float fixes it.
+    `line_search` is "backtracking", "cubic", or None (full steps).
+
+    The Jacobian is reassembled every `jacobian_lag` iterations (1: Newton, >1:
+    Shamanskii, `np.inf`: chord); the direct solver then reuses its factorization.
+    A lagged Jacobian is refreshed if its step fails the line search.
+    """
+    report = SolverReport("inexact_newton")
+    t_start = time.perf_counter()
+
+    get_matrix = getattr(jacobian, "get_linear_operator", jacobian)
+    solve = get_linear_solver(linear_solver)
+
+    def F(u):
+        report.num_residual_evaluations += 1
+        return f(u)
+
+    u = u0.copy()
+    fu = F(u)
+    nrm = np.linalg.norm(fu)
+    report.residual_norms.append(nrm)
+    logger.info("inexact_newton: ||F(u)|| = %e", nrm)
+
+    matrix = None
+    age = 0
+    eta = None
+    nrm_prev = None
+    while nrm >= tol:
+        if report.num_iterations >= max_iter:
+            report.message = "maximum number of iterations reached"
+            break
+
+        record = {"time_jacobian": 0.0, "time_linear_solve": 0.0}
+        t_iter = time.perf_counter()
+        eta = _get_forcing_term(forcing, eta, nrm, nrm_prev, tol)
+
+        for _ in range(2):
+            is_fresh = matrix is None or age >= jacobian_lag
+            if is_fresh:
+                t = time.perf_counter()
+                matrix = get_matrix(u)
+                age = 0
+                report.num_jacobian_evaluations += 1
+                record["time_jacobian"] += time.perf_counter() - t
+
+            t = time.perf_counter()
+            du, num_linear_iterations = solve(matrix, -fu, eta)
+            report.num_linear_solves += 1
+            report.num_linear_iterations += num_linear_iterations
+            record["time_linear_solve"] += time.perf_counter() - t
+
+            t = time.perf_counter()
+            step_length, u_new, fu_new, nrm_new, is_accepted = _line_search(
+                F, u, du, nrm, eta, line_search
+            )
+            record["time_line_search"] = time.perf_counter() - t
+
+            if is_accepted or is_fresh:
+                break
+            # The lagged Jacobian gave a poor direction; try again with a fresh one.
+            matrix = None
+
+        record.update(
+            {
+                "residual_norm": nrm_new,
+                "linear_tolerance": eta,
+                "linear_iterations": num_linear_iterations,
+                "step_length": step_length,
+                "jacobian_updated": is_fresh,
+                "time": time.perf_counter() - t_iter,
+            }
+        )
+        report.iterations.append(record)
+
+        if not is_accepted:
+            report.message = "line search failed"
+            break
+
+        age += 1
+        u, fu, nrm_prev, nrm = u_new, fu_new, nrm, nrm_new
+        report.residual_norms.append(nrm)
+        logger.info(
+            "inexact_newton: ||F(u)|| = %e (step length %.2e, eta %.2e)",
+            nrm,
+            step_length,
+            eta,
+        )
+
+    report.converged = nrm < tol
+    if report.converged:
+        report.message = "converged"
+    report.time = time.perf_counter() - t_start
+    return u, report
+
+
+def jfnk(
+    f,
+    u0,
+    tol=1.0e-10,
+    max_iter=50,
+    preconditioner=None,
+    preconditioner_lag=5,
+    krylov_method="gmres",
+    forcing="eisenstat-walker",
+    line_search="backtracking",
+    max_linear_iterations=None,
+):
+    """Jacobian-free Newton-Krylov. The Jacobian is never assembled; Jacobian-vector
+    products are approximated by finite differences of `f` in the direction of the
+    vector. Returns the solution and a `SolverReport`.
+
+    `preconditioner` is a cheap approximation of the Jacobian: a fixed matrix (e.g.,
+    the matrix of the linear part of the problem), a `pyfvm.Jacobian`, or a function
+    `u -> matrix`. It is LU-factored and, unless fixed, reassembled every
+    `preconditioner_lag` iterations. A `LinearOperator` is taken to apply the inverse
+    of such an approximation (e.g., an `AgglomerationMultigrid`) and is used as is.
+    Without a preconditioner, the Krylov method is unpreconditioned.
+
+    `forcing` and `line_search` are as in `inexact_newton`.
+    """
+    report = SolverReport("jfnk")
+    t_start = time.perf_counter()
+
+    M = None
+    get_matrix = getattr(preconditioner, "get_linear_operator", preconditioner)
+    # LinearOperators are callable, too
+    if isinstance(preconditioner, linalg.LinearOperator):
+        M = preconditioner
+        get_matrix = None
+    elif get_matrix is not None and not callable(get_matrix):
+        M = get_lu_preconditioner(get_matrix)
+        get_matrix = None
+
+    def F(u):
+        report.num_residual_evaluations += 1
+        return f(u)
+
+    u = u0.copy()
+    fu = F(u)
+    nrm = np.linalg.norm(fu)
+    report.residual_norms.append(nrm)
+    logger.info("jfnk: ||F(u)|| = %e", nrm)
+
+    age = 0
+    eta = None
+    nrm_prev = None
+    while nrm >= tol:
+        if report.num_iterations >= max_iter:
+            report.message = "maximum number of iterations reached"
+            break
+
+        record = {"time_jacobian": 0.0}
+        t_iter = time.perf_counter()
+        eta = _get_forcing_term(forcing, eta, nrm, nrm_prev, tol)
+
+        is_fresh = get_matrix is not None and (M is None or age >= preconditioner_lag)
+        if is_fresh:
+            t = time.perf_counter()
+            M = get_lu_preconditioner(get_matrix(u))
+            age = 0
+            report.num_jacobian_evaluations += 1
+            record["time_jacobian"] = time.perf_counter() - t
+
+        t = time.perf_counter()
+        num_evals = report.num_residual_evaluations
+        du, info, num_linear_iterations = krylov_solve(
+            krylov_method,
+            _get_jacobian_operator(F, u, fu),
+            -fu,
+            eta,
+            M=M,
+            maxiter=max_linear_iterations,
+        )
+        if info < 0:
+            raise RuntimeError(f"{krylov_method} broke down (info = {info})")
+        report.num_linear_solves += 1
+        report.num_linear_iterations += num_linear_iterations
+        record["time_linear_solve"] = time.perf_counter() - t
+        record["jacobian_vector_products"] = report.num_residual_evaluations - num_evals
+
+        t = time.perf_counter()
+        step_length, u_new, fu_new, nrm_new, is_accepted = _line_search(
+            F, u, du, nrm, eta, line_search
+        )
+        record["time_line_search"] = time.perf_counter() - t
+
+        record.update(
+            {
+                "residual_norm": nrm_new,
+                "linear_tolerance": eta,
+                "linear_iterations": num_linear_iterations,
+                "step_length": step_length,
+                "jacobian_updated": is_fresh,
+                "time": time.perf_counter() - t_iter,
+            }
+        )
+        report.iterations.append(record)
+
+        if not is_accepted:
+            report.message = "line search failed"
+            break
+
+        age += 1
+        u, fu, nrm_prev, nrm = u_new, fu_new, nrm, nrm_new
+        report.residual_norms.append(nrm)
+        logger.info(
+            "jfnk: ||F(u)|| = %e (step length %.2e, eta %.2e, %d linear iterations)",
+            nrm,
+            step_length,
+            eta,
+            num_linear_iterations,
+        )
+
+    report.converged = nrm < tol
+    if report.converged:
+        report.message = "converged"
+    report.time = time.perf_counter() - t_start
+    return u, report
+
+
+def anderson(
+    f,
+    u0,
+    tol=1.0e-10,
+    max_iter=100,
+    preconditioner=None,
+    window=5,
+    mixing=1.0,
+    max_condition=1.0e10,
+    safeguard=True,
+):
+    """Anderson-accelerated (type II) fixed-point iteration for F(u) = 0. Returns
+    the solution and a `SolverReport`.
+
+    The fixed-point map is u -> u - mixing * M^{-1} F(u), where `preconditioner`
+    (M) is a matrix that is LU-factored once (e.g., the matrix of the linear part of
+    the problem), a `LinearOperator` or function applying M^{-1}, or None (M = I).
+    The update is extrapolated from the last `window` iterates; their differences
+    are kept in two ring buffers of shape (window, n). The oldest differences are
+    dropped while the least-squares problem has a condition number above
+    `max_condition`. With `safeguard`, an extrapolated step that increases ||F|| is
+    replaced by a plain fixed-point step and the history is cleared.
+    """
+    assert window > 0
+    report = SolverReport("anderson")
+    t_start = time.perf_counter()
+
+    apply_preconditioner = _get_preconditioner_function(preconditioner)
+
+    def F(u):
+        report.num_residual_evaluations += 1
+        return f(u)
+
+    def get_step(fu):
+        report.num_linear_solves += 1
+        return -apply_preconditioner(fu)
+
+    u = u0.copy()
+    fu = F(u)
+    nrm = np.linalg.norm(fu)
+    r = get_step(fu)
+    report.residual_norms.append(nrm)
+    logger.info("anderson: ||F(u)|| = %e", nrm)
+
+    dtype = np.result_type(u, r)
+    dU = np.empty((window, len(u)), dtype=dtype)
+    dR = np.empty((window, len(u)), dtype=dtype)
+    num_stored = 0
+    head = 0
+
+    while nrm >= tol:
+        if report.num_iterations >= max_iter:
+            report.message = "maximum number of iterations reached"
+            break
+
+        t_iter = time.perf_counter()
+
+        # columns from oldest to newest
+        cols = [(head - num_stored + k) % window for k in range(num_stored)]
+        while len(cols) > 1 and np.linalg.cond(dR[cols].T) > max_condition:
+            cols = cols[1:]
+
+        du = mixing * r
+        if cols:
+            gamma = np.linalg.lstsq(dR[cols].T, r, rcond=None)[0]
+            du -= (dU[cols] + mixing * dR[cols]).T @ gamma
+
+        u_new = u + du
+        fu_new = F(u_new)
+        nrm_new = np.linalg.norm(fu_new)
+
+        is_accelerated = len(cols) > 0
+        if safeguard and is_accelerated and not nrm_new <= nrm:
+            # Fall back to the plain fixed-point step and start over.
+            du = mixing * r
+            u_new = u + du
+            fu_new = F(u_new)
+            nrm_new = np.linalg.norm(fu_new)
+            num_stored = 0
+            is_accelerated = False
+
+        r_new = get_step(fu_new)
+        dU[head] = u_new - u
+        dR[head] = r_new - r
+        head = (head + 1) % window
+        num_stored = min(num_stored + 1, window)
+
+        report.iterations.append(
+            {
+                "residual_norm": nrm_new,
+                "history_size": len(cols) if is_accelerated else 0,
+                "accelerated": is_accelerated,
+                "time": time.perf_counter() - t_iter,
+            }
+        )
+
+        if not np.isfinite(nrm_new):
+            report.message = "diverged"
+            break
+
+        u, fu, r, nrm = u_new, fu_new, r_new, nrm_new
+        report.residual_norms.append(nrm)
+        logger.info("anderson: ||F(u)|| = %e", nrm)
+
+    report.converged = nrm < tol
+    if report.converged:
+        report.message = "converged"
+    report.time = time.perf_counter() - t_start
+    return u, report
+
+
+def pseudo_transient(
+    f,
+    jacobian,
+    u0,
+    tol=1.0e-10,
+    max_iter=100,
+    dt0=1.0e-3,
+    dt_max=1.0e12,
+    mass=None,
+    linear_solver="direct",
+    forcing="eisenstat-walker",
+):
+    """Pseudo-transient continuation (Psi-tc): march
+    (M / dt + J(u)) du = -F(u) to steady state. Returns the solution and a
+    `SolverReport`.
+
+    `jacobian` is a `pyfvm.Jacobian` or a function `u -> matrix` (or
+    `LinearOperator`, e.g., for matrix-free Jacobians). The mass `M` is
+    diagonal; by default, it is taken from the control volumes of the Jacobian's
+    mesh, with zeros on the Dirichlet rows; it must be given if `jacobian` is a
+    function. The time step starts at `dt0` and is adapted by switched evolution
+    relaxation, dt <- dt * ||F(u_old)|| / ||F(u)||, so the iteration turns into
+    Newton's method close to the solution. Steps that lead to non-finite residuals
+    are retried with a smaller time step.
+
+    `linear_solver` and `forcing` are as in `inexact_newton`; since the sparsity
+    pattern doesn't change, a `SolverContext` can be used to keep factorizations or
+    AMG hierarchies across steps.
+    """
+    report = SolverReport("pseudo_transient")
+    t_start = time.perf_counter()
+
+    get_matrix = getattr(jacobian, "get_linear_operator", jacobian)
+    solve = get_linear_solver(linear_solver)
+    if mass is None:
+        if not hasattr(jacobian, "mesh"):
+            raise ValueError("`mass` is required if `jacobian` is a function.")
+        mass = _get_lumped_mass(jacobian)
+
+    def F(u):
+        report.num_residual_evaluations += 1
+        return f(u)
+
+    u = u0.copy()
+    fu = F(u)
+    nrm = np.linalg.norm(fu)
+    report.residual_norms.append(nrm)
+    logger.info("pseudo_transient: ||F(u)|| = %e", nrm)
+
+    dt = dt0
+    eta = None
+    nrm_prev = None
+    while nrm >= tol:
+        if report.num_iterations >= max_iter:
+            report.message = "maximum number of iterations reached"
+            break
+
+        record = {"time_jacobian": 0.0, "time_linear_solve": 0.0}
+        t_iter = time.perf_counter()
+        eta = _get_forcing_term(forcing, eta, nrm, nrm_prev, tol)
+
+        t = time.perf_counter()
+        jac = get_matrix(u)
+        report.num_jacobian_evaluations += 1
+        record["time_jacobian"] += time.perf_counter() - t
+
+        while True:
+            t = time.perf_counter()
+            shift = sparse.diags(mass / dt)
+            if isinstance(jac, linalg.LinearOperator):
+                matrix = jac + linalg.aslinearoperator(shift)
+            else:
+                matrix = jac + shift
+            du, num_linear_iterations = solve(matrix, -fu, eta)
+            report.num_linear_solves += 1
+            report.num_linear_iterations += num_linear_iterations
+            record["time_linear_solve"] += time.perf_counter() - t
+
+            u_new = u + du
+            fu_new = F(u_new)
+            nrm_new = np.linalg.norm(fu_new)
+            if np.isfinite(nrm_new) or dt < 1.0e-14 * dt0:
+                break
+            dt *= 0.25
+
+        record.update(
+            {
+                "residual_norm": nrm_new,
+                "dt": dt,
+                "linear_tolerance": eta,
+                "linear_iterations": num_linear_iterations,
+                "time": time.perf_counter() - t_iter,
+            }
+        )
+        report.iterations.append(record)
+
+        if not np.isfinite(nrm_new):
+            report.message = "diverged"
+            break
+
+        # switched evolution relaxation
+        dt = min(dt * nrm / nrm_new, dt_max)
+
+        u, fu, nrm_prev, nrm = u_new, fu_new, nrm, nrm_new
+        report.residual_norms.append(nrm)
+        logger.info("pseudo_transient: ||F(u)|| = %e (dt = %.2e)", nrm, dt)
+
+    report.converged = nrm < tol
+    if report.converged:
+        report.message = "converged"
+    report.time = time.perf_counter() - t_start
+    return u, report
+
+
+def pseudo_arclength(
+    problem,
+    jacobian,
+    u0,
+    lmbda0,
+    ds=0.1,
+    ds_min=1.0e-6,
+    ds_max=1.0,
+    max_steps=100,
+    lmbda_range=(-np.inf, np.inf),
+    direction=1.0,
+    tol=1.0e-10,
+    max_newton_iter=10,
+    target_newton_iter=3,
+    callback=None,
+):
+    """Trace the solution branch of F(u, lambda) = 0 through `(u0, lmbda0)` with
+    pseudo-arclength continuation. Returns the parameter values, the solutions, and
+    a `SolverReport` with one record per continuation step.
+
+    `problem` and `jacobian` are as returned by `discretize` for a problem with
+    `apply(u, lmbda)`; dF/dlambda comes from
+    `problem.eval_parameter_derivative()`.
+
+    Every step predicts along the tangent of the branch and corrects with Newton's
+    method on the system bordered by the arclength condition. The bordered matrix is
+    factored once per step and kept for all corrector iterations (refactored only
+    if the convergence stalls) and for the next tangent, so folds are passed
+    without special treatment. The step length is adapted to the number of Newton
+    iterations; `direction` gives the initial direction in lambda. The arclength
+    measures u in the root-mean-square norm, so `ds` doesn't depend on the mesh
+    size. `callback(lmbda, u)` is called for every point on the branch.
+    """
+    report = SolverReport("pseudo_arclength")
+    t_start = time.perf_counter()
+
+    n = len(u0)
+    weight = 1.0 / n
+
+    def F(u, lmbda):
+        report.num_residual_evaluations += 1
+        return problem.eval(u, lmbda)
+
+    def get_bordered_lu(u, lmbda, tangent):
+        report.num_jacobian_evaluations += 1
+        jac = jacobian.get_linear_operator(u, lmbda=lmbda)
+        dfdl = problem.eval_parameter_derivative(u, lmbda)
+        matrix = sparse.bmat(
+            [
+                [jac, dfdl.reshape(-1, 1)],
+                [weight * tangent[:n].reshape(1, -1), tangent[n:].reshape(1, 1)],
+            ],
+            format="csc",
+        )
+        return linalg.splu(matrix)
+
+    # Correct the initial guess at fixed lambda, then compute the tangent.
+    u, newton_report = inexact_newton(
+        lambda u: F(u, lmbda0),
+        lambda u: jacobian.get_linear_operator(u, lmbda=lmbda0),
+        u0,
+        tol=tol,
+        max_iter=max_newton_iter,
+    )
+    report.num_residual_evaluations += newton_report.num_residual_evaluations
+    report.num_jacobian_evaluations += newton_report.num_jacobian_evaluations
+    report.num_linear_solves += newton_report.num_linear_solves
+    report.num_linear_iterations += newton_report.num_linear_iterations
+    if not newton_report.converged:
+        report.message = "no solution at the initial parameter value"
+        report.residual_norms.append(newton_report.residual_norms[-1])
+        report.time = time.perf_counter() - t_start
+        return [], [], report
+
+    x = np.append(u, lmbda0)
+    # With the bordering row (0, 1), the tangent solves J du = -dF/dlambda.
+    lu = get_bordered_lu(u, lmbda0, np.append(np.zeros(n), 1.0))
+    tangent = _get_tangent(lu, np.append(np.zeros(n), direction), weight)
+    report.num_linear_solves += 1
+
+    lmbdas = [lmbda0]
+    solutions = [u]
+    report.residual_norms.append(newton_report.residual_norms[-1])
+    if callback is not None:
+        callback(lmbda0, u)
+
+    while report.num_iterations < max_steps:
+        t_iter = time.perf_counter()
+
+        # predictor
+        x_new = x + ds * tangent
+        lu = get_bordered_lu(x_new[:n], x_new[n], tangent)
+
+        # corrector
+        is_converged = False
+        nrm_prev = None
+        for k in range(1, max_newton_iter + 1):
+            fx = np.append(
+                F(x_new[:n], x_new[n]),
+                weight * tangent[:n] @ (x_new[:n] - x[:n])
+                + tangent[n] * (x_new[n] - x[n])
+                - ds,
+            )
+            nrm = np.linalg.norm(fx)
+            if not np.isfinite(nrm):
+                break
+            if nrm < tol:
+                is_converged = True
+                break
+            if nrm_prev is not None and nrm > 0.5 * nrm_prev:
+                # slow convergence; refactor at the current point
+                lu = get_bordered_lu(x_new[:n], x_new[n], tangent)
+            x_new -= lu.solve(fx)
+            report.num_linear_solves += 1
+            nrm_prev = nrm
+
+        report.iterations.append(
+            {
+                "lmbda": x_new[n],
+                "ds": ds,
+                "newton_iterations": k,
+                "converged": is_converged,
+                "time": time.perf_counter() - t_iter,
+            }
+        )
+
+        if not is_converged:
+            ds *= 0.5
+            if ds < ds_min:
+                report.message = "step length too small"
+                break
+            continue
+
+        # new tangent, oriented like the old one
+        tangent = _get_tangent(lu, np.append(np.zeros(n), 1.0), weight, tangent)
+        report.num_linear_solves += 1
+        x = x_new
+        lmbdas.append(x[n])
+        solutions.append(x[:n].copy())
+        report.residual_norms.append(nrm)
+        logger.info("pseudo_arclength: lambda = %e, ds = %.2e", x[n], ds)
+        if callback is not None:
+            callback(x[n], x[:n])
+
+        if not lmbda_range[0] <= x[n] <= lmbda_range[1]:
+            report.message = "left the parameter range"
+            break
+
+        # adapt step length
+        factor = target_newton_iter / max(k - 1, 1)
+        ds = min(max(ds * min(max(factor, 0.5), 2.0), ds_min), ds_max)
+
+    report.converged = len(lmbdas) > 1
+    if not report.message:
+        report.message = "maximum number of steps reached"
+    report.time = time.perf_counter() - t_start
+    return lmbdas, solutions, report
+
+
+def _get_tangent(lu, rhs, weight, previous=None):
+    """Solve the bordered system for the tangent, normalize it, and orient it like
+    `previous`.
+    """
+    n = len(rhs) - 1
+    tangent = lu.solve(rhs)
+    tangent /= np.sqrt(weight * tangent[:n] @ tangent[:n] + tangent[n] ** 2)
+    if previous is None:
+        if tangent[n] * rhs[n] < 0.0:
+            tangent *= -1
+    elif weight * tangent[:n] @ previous[:n] + tangent[n] * previous[n] < 0.0:
+        tangent *= -1
+    return tangent
+
+
+def _get_lumped_mass(jacobian):
+    """Control volumes of the Jacobian's mesh, 0 on the Dirichlet rows."""
+    mesh = jacobian.mesh
+    mass = np.array(mesh.control_volumes, dtype=float)
+    for dirichlet in jacobian.dirichlets:
+        mass[mesh.get_vertex_mask(dirichlet.subdomain)] = 0.0
+    return mass
+
+
+def _get_preconditioner_function(preconditioner):
+    """Turn a matrix, `LinearOperator`, function, or None into a function that
+    applies the inverse of the preconditioner.
+    """
+    if preconditioner is None:
+        return lambda x: x
+    # LinearOperators are callable, too
+    if isinstance(preconditioner, linalg.LinearOperator):
+        return preconditioner.matvec
+    if callable(preconditioner):
+        return preconditioner
+    return get_lu_preconditioner(preconditioner).matvec
+
+
+def _get_jacobian_operator(F, u, fu):
+    """The Jacobian of F at u as a LinearOperator, with J v approximated by the
+    forward difference (F(u + h v) - F(u)) / h. The step size h balances truncation
+    and rounding errors relative to the sizes of u and v.
+    """
+    sqrt_eps = np.sqrt(np.finfo(float).eps)
+    nrm_u = np.linalg.norm(u)
+
+    def matvec(v):
+        v = v.reshape(u.shape)
+        nrm_v = np.linalg.norm(v)
+        if nrm_v == 0.0:
+            return np.zeros_like(fu)
+        h = sqrt_eps * (1.0 + nrm_u) / nrm_v
+        return (F(u + h * v) - fu) / h
+
+    n = len(u)
+    return linalg.LinearOperator((n, n), matvec=matvec, dtype=fu.dtype)
+
+
+def _get_forcing_term(forcing, eta_prev, nrm, nrm_prev, tol, eta_max=0.9):
+    """Relative tolerance for the next linear solve."""
+    if forcing is None:
+        return 0.0
+    if forcing != "eisenstat-walker":
+        return float(forcing)
+
+    # Eisenstat-Walker, choice 2, with the usual safeguards
+    gamma = 0.9
+    alpha = 2.0
+    if eta_prev is None:
+        eta = 0.5
+    else:
+        eta = gamma * (nrm / nrm_prev) ** alpha
+        safeguard = gamma * eta_prev ** alpha
+        if safeguard > 0.1:
+            eta = max(eta, safeguard)
+    # Don't oversolve close to the solution
+    eta = max(eta, 0.5 * tol / nrm)
+    return min(eta, eta_max)
+
+
+def _line_search(F, u, du, nrm, eta, method, alpha=1.0e-4, max_backtracks=20):
+    """Find a step length that sufficiently decreases ||F||. Returns the step length,
+    the new u, F(u), ||F(u)||, and whether the step was accepted.
+    """
+    # Merit function phi(s) = 0.5 ||F(u + s du)||^2
+    phi0 = 0.5 * nrm ** 2
+    dphi0 = -(nrm ** 2)
+
+    step = 1.0
+    step_prev = None
+    phi_prev = None
+    for _ in range(max_backtracks + 1):
+        u_new = u + step * du
+        fu_new = F(u_new)
+        nrm_new = np.linalg.norm(fu_new)
+
+        if method is None:
+            return step, u_new, fu_new, nrm_new, np.isfinite(nrm_new)
+
+        if nrm_new <= (1.0 - alpha * step * (1.0 - eta)) * nrm:
+            return step, u_new, fu_new, nrm_new, True
+
+        phi = 0.5 * nrm_new ** 2
+        if method == "cubic" and np.isfinite(phi):
+            new_step = _interpolate_step(phi0, dphi0, step, phi, step_prev, phi_prev)
+            if not np.isfinite(new_step):
+                new_step = 0.5 * step
+            new_step = min(max(new_step, 0.1 * step), 0.5 * step)
+        else:
+            assert method in ["backtracking", "cubic"]
+            new_step = 0.5 * step
+
+        step_prev, phi_prev = step, phi
+        step = new_step
+
+    return step_prev, u_new, fu_new, nrm_new, False
+
+
+def _interpolate_step(phi0, dphi0, s1, phi1, s2, phi2):
+    """Minimizer of the quadratic (one previous step) or cubic (two previous steps)
+    model of the merit function; cf. Dennis-Schnabel, Algorithm A6.3.1.
+    """
+    if s2 is None:
+        return -dphi0 * s1 ** 2 / (2.0 * (phi1 - phi0 - dphi0 * s1))
+
+    r1 = phi1 - phi0 - dphi0 * s1
+    r2 = phi2 - phi0 - dphi0 * s2
+    a = (r1 / s1 ** 2 - r2 / s2 ** 2) / (s1 - s2)
+    b = (-s2 * r1 / s1 ** 2 + s1 * r2 / s2 ** 2) / (s1 - s2)
+    if a == 0.0:
+        return -dphi0 / (2.0 * b)
+    disc = b ** 2 - 3.0 * a * dphi0
+    if disc < 0.0:
+        return 0.5 * s1
+    return (-b + np.sqrt(disc)) / (3.0 * a)
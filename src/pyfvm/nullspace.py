@@ -0,0 +1,156 @@
+import numpy as np
+import scipy.linalg
+from scipy.sparse import linalg
+
+from .linear_solvers import krylov_solve
+
+
+def constant_mode(mesh):
+    """The constant vector on the vertices of `mesh`, the nullspace of pure-Neumann
+    diffusion operators and (approximately) of the kinetic energy operator for weak
+    magnetic fields.
+    """
+    return np.ones(len(mesh.points))
+
+
+def gauge_mode(psi):
+    """The gauge mode i*psi of gauge-invariant problems like Ginzburg-Landau: their
+    Jacobian at a solution `psi` maps it to 0.
+
+    The Jacobian is only real-linear (it has a conj() part), so the gauge mode is a
+    null vector of its real 2n x 2n form; pass `np.concatenate([z.real, z.imag])`
+    for that.
+    """
+    return 1j * psi
+
+
+class DeflatedSolver:
+    """Krylov solver that deflates a known (near-)nullspace of the matrix, e.g.,
+    `constant_mode()` for pure-Neumann problems or `gauge_mode()` for
+    Ginzburg-Landau Jacobians. `nullspace` holds the vectors as columns; a single
+    vector is fine, too.
+
+    Nullspace directions in which the matrix is numerically singular are projected
+    out of the right-hand side and of the solution. For Hermitian matrices, this
+    gives the minimum-norm solution, e.g., the one with zero mean for pure-Neumann
+    problems. In the remaining near-nullspace directions, the solution is computed
+    from the small coarse matrix E = Z^H A Z. The Krylov method only sees the
+    deflated operator P A with P = I - A Z E^{-1} Z^H, whose spectrum is free of the
+    small eigenvalues, so the iteration count doesn't grow with them.
+
+    Call it as `(matrix, rhs, rtol) -> (x, num_iterations)`, e.g., as the
+    `linear_solver` of `inexact_newton`. `preconditioner` is a function that takes
+    the matrix and returns a preconditioner for scipy's Krylov methods; it is only
+    called when the matrix changes.
+    """
+
+    def __init__(
+        self,
+        nullspace,
+        method="gmres",
+        preconditioner=None,
+        maxiter=None,
+        singular_tol=1.0e-10,
+    ):
+        self.nullspace = nullspace
+        self.method = method
+        self.preconditioner = preconditioner
+        self.maxiter = maxiter
+        self.singular_tol = singular_tol
+
+        self._matrix = None
+        self._M = None
+
+    def _setup(self, matrix):
+        A = linalg.aslinearoperator(matrix)
+        Z = np.asarray(self.nullspace)
+        if Z.ndim == 1:
+            Z = Z[:, None]
+        Z, _ = np.linalg.qr(Z)
+        AZ = np.column_stack([A.matvec(z) for z in Z.T])
+
+        # Rotate Z such that the columns of A Z are orthogonal; their norms tell
+        # the exact nullspace from the near-nullspace.
+        U, s, Vh = np.linalg.svd(AZ, full_matrices=False)
+        Z = Z @ Vh.conj().T
+        AZ = U * s
+        is_null = s <= self.singular_tol * _estimate_norm(A)
+
+        self._Z0 = Z[:, is_null]
+        self._Z1 = Z[:, ~is_null]
+        self._AZ1 = AZ[:, ~is_null]
+        self._E = None
+        if self._Z1.shape[1] > 0:
+            self._E = scipy.linalg.lu_factor(self._Z1.conj().T @ self._AZ1)
+
+        if self.preconditioner is not None:
+            self._M = linalg.aslinearoperator(self.preconditioner(matrix))
+        self._matrix = matrix
+
+    def _project_null(self, v):
+        return v - self._Z0 @ (self._Z0.conj().T @ v)
+
+    def _project(self, v):
+        # orthogonal projection onto the complement of all of Z
+        v = self._project_null(v)
+        return v - self._Z1 @ (self._Z1.conj().T @ v)
+
+    def _coarse_solve(self, v):
+        # Q v = Z1 E^{-1} Z1^H v
+        if self._E is None:
+            return np.zeros_like(v)
+        return self._Z1 @ scipy.linalg.lu_solve(self._E, self._Z1.conj().T @ v)
+
+    def _deflate(self, v):
+        # P v = v - A Z1 E^{-1} Z1^H v
+        if self._E is None:
+            return v
+        return v - self._AZ1 @ scipy.linalg.lu_solve(self._E, self._Z1.conj().T @ v)
+
+    def __call__(self, matrix, rhs, rtol):
+        if matrix is not self._matrix:
+            self._setup(matrix)
+
+        A = linalg.aslinearoperator(matrix)
+        b = self._project_null(rhs)
+        x_coarse = self._coarse_solve(b)
+
+        pb = self._deflate(b)
+        norm_pb = np.linalg.norm(pb)
+        if norm_pb == 0.0:
+            return self._project_null(x_coarse), 0
+
+        dtype = np.result_type(A.dtype, b, self._Z0, self._Z1)
+        op = linalg.LinearOperator(
+            A.shape,
+            matvec=lambda v: self._project_null(self._deflate(A.matvec(v))),
+            dtype=dtype,
+        )
+        M = None
+        if self._M is not None:
+            # P A is singular on Z; keep the preconditioner from adding to that.
+            M = linalg.LinearOperator(
+                A.shape,
+                matvec=lambda v: self._project(self._M.matvec(self._project_null(v))),
+                dtype=dtype,
+            )
+
+        # The tolerance is relative to the full right-hand side.
+        rtol = min(rtol * np.linalg.norm(b) / norm_pb, 0.5)
+        x, info, num_iterations = krylov_solve(
+            self.method, op, pb, rtol, M=M, maxiter=self.maxiter
+        )
+        if info < 0:
+            raise RuntimeError(f"{self.method} broke down (info = {info})")
+
+        # x = Q b + (I - Q A) x; (I - Q A) vanishes on Z, so remove that part of x
+        # first to avoid cancellation.
+        x = self._project(x)
+        x = x_coarse + x - self._coarse_solve(A.matvec(x))
+        return self._project_null(x), num_iterations
+
+
+def _estimate_norm(A):
+    """A cheap lower bound of the 2-norm of `A`."""
+    v = np.random.default_rng(0).standard_normal(A.shape[1])
+    return np.linalg.norm(A.matvec(v)) / np.linalg.norm(v)
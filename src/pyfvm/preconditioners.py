@@ -0,0 +1,57 @@
+import numpy as np
+from scipy import sparse
+from scipy.sparse import linalg
+
+
+def get_jacobi_preconditioner(A, lumped=False):
+    """Jacobi preconditioner for scipy's Krylov methods.
+
+    `A` is a sparse matrix or a matrix-free operator (`discretize_linear(...,
+    matrix_free=True)`, `Jacobian.get_linear_operator(u, matrix_free=True)`). For the
+    latter, the diagonal is computed directly from the kernels, so no matrix is
+    assembled at all. With `lumped=True`, the absolute row sums are used instead of
+    the diagonal (l1-Jacobi).
+
+    With one unknown per vertex, block Jacobi over the vertices is just Jacobi; for
+    systems, see `get_block_jacobi_preconditioner`.
+    """
+    if lumped:
+        if hasattr(A, "row_sums"):
+            d = A.row_sums(absolute=True)
+        else:
+            d = np.asarray(abs(A).sum(axis=1)).reshape(-1)
+    else:
+        d = A.diagonal()
+
+    # Leave empty rows alone
+    d = np.where(d == 0.0, 1.0, d)
+    inv_d = 1.0 / d
+
+    def matvec(x):
+        return inv_d * np.ravel(x)
+
+    return linalg.LinearOperator(A.shape, matvec=matvec, dtype=inv_d.dtype)
+
+
+def get_block_jacobi_preconditioner(A):
+    """Block Jacobi preconditioner for scipy's Krylov methods, e.g., for the
+    `bsr_matrix` Jacobians of `discretize_system`: the diagonal blocks (all fields
+    at one vertex) are inverted at once.
+    """
+    A = sparse.bsr_matrix(A)
+    R, C = A.blocksize
+    assert R == C, "need square blocks"
+    n = A.shape[0] // R
+
+    rows = np.repeat(np.arange(n), np.diff(A.indptr))
+    is_diagonal = A.indices == rows
+    # Leave empty block rows alone
+    blocks = np.tile(np.eye(R, dtype=A.dtype), (n, 1, 1))
+    blocks[rows[is_diagonal]] = A.data[is_diagonal]
+    inv_blocks = np.linalg.inv(blocks)
+
+    def matvec(x):
+        x = np.ravel(x).reshape(n, R, 1)
+        return (inv_blocks @ x).reshape(-1)
+
+    return linalg.LinearOperator(A.shape, matvec=matvec, dtype=inv_blocks.dtype)
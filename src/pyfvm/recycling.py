@@ -0,0 +1,237 @@
+import numpy as np
+import scipy.linalg
+from scipy.sparse import linalg
+
+
+class RecyclingGmres:
+    """GMRES with Krylov subspace recycling (GCRO-DR, Parks et al., 2006) for
+    sequences of slowly changing linear systems, e.g., the Jacobians of a Newton
+    iteration.
+
+    Every cycle builds a Krylov space of dimension `num_vectors` minus the recycled
+    ones. At the end of each cycle, the `num_recycle` harmonic Ritz vectors of
+    smallest magnitude are kept; they approximate the eigenvectors that slow down
+    restarted GMRES. The recycled space is kept across calls: for the next
+    system, it is only multiplied by the new matrix once, and its contribution to
+    the solution is projected out before the first iteration.
+
+    Call it as `(matrix, rhs, rtol) -> (x, num_iterations)`, e.g., as the
+    `linear_solver` of `inexact_newton`. `preconditioner` is a function that takes
+    the matrix and returns a (right) preconditioner; it is only called when the
+    matrix changes. `solve()` takes the preconditioner directly.
+    """
+
+    def __init__(
+        self, num_vectors=30, num_recycle=10, maxiter=None, preconditioner=None
+    ):
+        assert 0 < num_recycle < num_vectors
+        self.num_vectors = num_vectors
+        self.num_recycle = num_recycle
+        self.maxiter = maxiter
+        self.preconditioner = preconditioner
+
+        self.num_solves = 0
+        self.num_iterations = 0
+
+        # The recycled space, in the variables of the preconditioned system
+        self.U = None
+        self._matrix = None
+        self._M = None
+
+    def reset(self):
+        """Forget the recycled space."""
+        self.U = None
+
+    def __call__(self, matrix, rhs, rtol):
+        if self.preconditioner is not None and matrix is not self._matrix:
+            self._M = self.preconditioner(matrix)
+            self._matrix = matrix
+
+        x, info, num_iterations = self.solve(matrix, rhs, rtol, M=self._M)
+        if info < 0:
+            raise RuntimeError(f"GCRO-DR broke down (info = {info})")
+        return x, num_iterations
+
+    def solve(self, A, b, rtol, M=None, x0=None):
+        """Solve A x = b up to the relative residual `rtol`. Like scipy's Krylov
+        methods, returns the solution and the info flag; additionally returns the
+        number of iterations.
+        """
+        A = linalg.aslinearoperator(A)
+        M = None if M is None else linalg.aslinearoperator(M)
+        n = len(b)
+        dtype = np.result_type(A.dtype, b, float)
+
+        def op(v):
+            return A.matvec(v if M is None else M.matvec(v))
+
+        def apply_m(v):
+            return v if M is None else M.matvec(v)
+
+        def op_columns(V):
+            return np.column_stack([op(v) for v in V.T])
+
+        x = np.zeros(n, dtype=dtype) if x0 is None else np.array(x0, dtype=dtype)
+        tol = rtol * np.linalg.norm(b)
+        self.num_solves += 1
+
+        U = None
+        C = None
+        if self.U is not None and self.U.shape[0] == n:
+            # C = A U, orthonormalized; U is scaled accordingly.
+            U = self.U.astype(dtype)
+            Q, R = np.linalg.qr(op_columns(U))
+            is_valid = np.abs(np.diag(R)) > 1.0e-12 * np.max(np.abs(np.diag(R)))
+            if np.any(is_valid):
+                C = Q[:, is_valid]
+                U = scipy.linalg.solve_triangular(
+                    R[np.ix_(is_valid, is_valid)],
+                    U[:, is_valid].T,
+                    trans="T",
+                ).T
+            else:
+                U = None
+
+        num_iterations = 0
+        maxiter = 10 * n if self.maxiter is None else self.maxiter
+        while True:
+            r = b - A.matvec(x)
+            if C is not None:
+                # Take the solution component in the recycled space.
+                c = C.conj().T @ r
+                x += apply_m(U @ c)
+                r -= C @ c
+
+            beta = np.linalg.norm(r)
+            if beta <= tol:
+                info = 0
+                break
+            if num_iterations >= maxiter:
+                info = num_iterations
+                break
+
+            k = 0 if C is None else C.shape[1]
+            # normalize the columns of U
+            d = None if U is None else 1.0 / np.linalg.norm(U, axis=0)
+
+            def solve_least_squares(H, B):
+                # The projected problem min ||beta e_{k+1} - G y|| with
+                # G = [[D, B], [0, H]].
+                j = H.shape[1]
+                G = np.zeros((k + j + 1, k + j), dtype=H.dtype)
+                G[k:, k:] = H
+                if k > 0:
+                    G[:k, :k] = np.diag(d)
+                    G[:k, k:] = B
+                rhs = np.zeros(k + j + 1, dtype=H.dtype)
+                rhs[k] = beta
+                y = np.linalg.lstsq(G, rhs, rcond=None)[0]
+                return G, y, np.linalg.norm(rhs - G @ y)
+
+            m = min(self.num_vectors - k, maxiter - num_iterations)
+            V, H, B = _arnoldi(
+                op,
+                r / beta,
+                m,
+                C,
+                is_converged=lambda H, B: solve_least_squares(H, B)[2] <= tol,
+            )
+            j = H.shape[1]
+            num_iterations += j
+
+            G, y, _ = solve_least_squares(H, B)
+            if C is None:
+                W = V[:, :j]
+                V_hat = V
+            else:
+                W = np.column_stack([U * d, V[:, :j]])
+                V_hat = np.column_stack([C, V])
+            x += apply_m(W @ y)
+
+            if H[j, j - 1] == 0.0:
+                # The Krylov space was invariant, so x is the solution; don't
+                # update the recycled space with the degenerate basis.
+                continue
+
+            # update the recycled space
+            P = _get_harmonic_ritz_vectors(
+                G, W, V_hat, self.num_recycle, np.isrealobj(V)
+            )
+            if P is not None:
+                Q, R = np.linalg.qr(G @ P)
+                C = V_hat @ Q
+                U = W @ scipy.linalg.solve_triangular(R, P.T, trans="T").T
+
+        self.U = U
+        self.num_iterations += num_iterations
+        return x, info, num_iterations
+
+
+def _arnoldi(op, v, m, C=None, is_converged=None):
+    """Arnoldi process for `op` projected onto the orthogonal complement of the
+    orthonormal columns `C`. Returns the basis V (n x (j+1)), the Hessenberg matrix H
+    ((j+1) x j), and the coefficients B = C^H op(V_j). The process stops early if
+    `is_converged(H, B)` or on breakdown, where the last entry of H is 0.
+    Orthogonalization is done by classical Gram-Schmidt with reorthogonalization.
+    """
+    n = len(v)
+    V = np.zeros((n, m + 1), dtype=v.dtype)
+    H = np.zeros((m + 1, m), dtype=v.dtype)
+    B = None if C is None else np.zeros((C.shape[1], m), dtype=v.dtype)
+    V[:, 0] = v
+    for j in range(m):
+        w = op(V[:, j])
+        if w.dtype != V.dtype:
+            V = V.astype(np.result_type(V, w))
+            H = H.astype(V.dtype)
+            B = None if B is None else B.astype(V.dtype)
+        norm_w = np.linalg.norm(w)
+        for _ in range(2):
+            if C is not None:
+                b = C.conj().T @ w
+                w -= C @ b
+                B[:, j] += b
+            h = V[:, : j + 1].conj().T @ w
+            w -= V[:, : j + 1] @ h
+            H[: j + 1, j] += h
+        H[j + 1, j] = np.linalg.norm(w)
+        if H[j + 1, j] <= 1.0e-14 * norm_w:
+            # lucky breakdown; the Krylov space is invariant
+            H[j + 1, j] = 0.0
+            m = j + 1
+            break
+        V[:, j + 1] = w / H[j + 1, j]
+        if is_converged is not None and is_converged(
+            H[: j + 2, : j + 1], None if B is None else B[:, : j + 1]
+        ):
+            m = j + 1
+            break
+
+    return V[:, : m + 1], H[: m + 1, :m], None if B is None else B[:, :m]
+
+
+def _get_harmonic_ritz_vectors(G, W, V_hat, k, is_real):
+    """Coefficients (w.r.t. W) of the k harmonic Ritz vectors of smallest magnitude
+    from the generalized eigenproblem G^H G z = theta G^H V_hat^H W z. For real
+    problems, the real and imaginary parts of complex pairs are used.
+    """
+    if G.shape[1] <= k:
+        return None
+
+    theta, Z = scipy.linalg.eig(G.conj().T @ G, G.conj().T @ (V_hat.conj().T @ W))
+    magnitude = np.where(np.isfinite(theta), np.abs(theta), np.inf)
+    Z = Z[:, np.argsort(magnitude)]
+    if is_real:
+        Z = np.column_stack([part for z in Z.T for part in [z.real, z.imag]])
+
+    # Orthonormalize in order and drop linearly dependent vectors.
+    P = []
+    for z in Z.T:
+        norm_z = np.linalg.norm(z)
+        for p in P:
+            z = z - (p.conj() @ z) * p
+        if np.linalg.norm(z) > 1.0e-8 * norm_z:
+            P.append(z / np.linalg.norm(z))
+        if len(P) == k:
+            break
+    return np.column_stack(P) if P else None
@@ -0,0 +1,138 @@
+from collections import OrderedDict
+
+import npx
+import numpy as np
+from scipy import sparse
+
+
+class Restriction:
+    """The parts of the mesh that contribute to the rows of a subset of the vertices:
+    the cells touching them (per subdomain) and the positions of their edge nodes in
+    the subset. Everything is computed once, at a cost proportional to the size of
+    the subset.
+    """
+
+    def __init__(self, mesh, vertices, vertex_cells):
+        self.mesh = mesh
+        self.vertices = np.asarray(vertices)
+        assert self.vertices.ndim == 1
+        self._sorter = np.argsort(self.vertices)
+        self._sorted = self.vertices[self._sorter]
+        assert np.all(self._sorted[1:] != self._sorted[:-1]), "vertices not unique"
+
+        self.cells = np.unique(vertex_cells[self.vertices].indices)
+        self._cell_data = {}
+        self._vertex_data = {}
+        self._face_data = {}
+
+    def get_local(self, ids):
+        """The positions of the vertex `ids` in the subset; -1 for the other
+        vertices.
+        """
+        if len(self._sorted) == 0:
+            return np.full(np.shape(ids), -1)
+        pos = np.minimum(np.searchsorted(self._sorted, ids), len(self._sorted) - 1)
+        return np.where(self._sorted[pos] == ids, self._sorter[pos], -1)
+
+    def get_cells(self, subdomain):
+        """The cells of `subdomain` touching the subset and the local positions
+        (`get_local`) of the nodes of their edges, in the layout of `mesh.idx[-1]`.
+        """
+        if subdomain not in self._cell_data:
+            cell_mask = self.mesh.get_cell_mask(subdomain)
+            cells = self.cells
+            if not isinstance(cell_mask, slice):
+                cells = cells[cell_mask[cells]]
+            self._cell_data[subdomain] = (
+                cells,
+                self.get_local(self.mesh.idx[-1][..., cells]),
+            )
+        return self._cell_data[subdomain]
+
+    def get_vertices(self, subdomain):
+        """The vertices of the subset in `subdomain` and their local positions."""
+        if subdomain not in self._vertex_data:
+            vertex_mask = self.mesh.get_vertex_mask(subdomain)
+            local = np.arange(len(self.vertices))
+            if not isinstance(vertex_mask, slice):
+                local = local[vertex_mask[self.vertices]]
+            self._vertex_data[subdomain] = self.vertices[local], local
+        return self._vertex_data[subdomain]
+
+    def get_faces(self, subdomain):
+        """The boundary faces of `subdomain` that touch the subset, their nodes, and
+        the local positions of the nodes.
+        """
+        if subdomain not in self._face_data:
+            face_mask = np.flatnonzero(self.mesh.get_face_mask(subdomain))
+            local = self.get_local(self.mesh.idx[-1][face_mask])
+            is_touching = np.any(local.reshape(len(face_mask), -1) >= 0, axis=1)
+            face_mask = face_mask[is_touching]
+            self._face_data[subdomain] = (
+                face_mask,
+                self.mesh.idx[-1][face_mask],
+                local[is_touching],
+            )
+        return self._face_data[subdomain]
+
+
+class RestrictionCache:
+    """The `Restriction`s of the last `maxsize` vertex subsets of a mesh."""
+
+    def __init__(self, mesh, maxsize=128):
+        self.mesh = mesh
+        self.maxsize = maxsize
+        self._vertex_cells = None
+        self._restrictions = OrderedDict()
+
+    @property
+    def vertex_cells(self):
+        if self._vertex_cells is None:
+            self._vertex_cells = get_vertex_cells(self.mesh)
+        return self._vertex_cells
+
+    def get(self, vertices, cache=True):
+        """The `Restriction` to `vertices`. With `cache=False`, it is neither looked
+        up nor stored, e.g., for subsets that are only used once.
+        """
+        vertices = np.asarray(vertices)
+        if not cache:
+            return Restriction(self.mesh, vertices, self.vertex_cells)
+
+        key = vertices.tobytes()
+        if key in self._restrictions:
+            self._restrictions.move_to_end(key)
+            return self._restrictions[key]
+
+        restriction = Restriction(self.mesh, vertices, self.vertex_cells)
+        self._restrictions[key] = restriction
+        if len(self._restrictions) > self.maxsize:
+            self._restrictions.popitem(last=False)
+        return restriction
+
+
+def get_vertex_cells(mesh):
+    """The vertex-to-cell incidence as a (num_vertices x num_cells) CSR matrix."""
+    nec = mesh.idx[-1]
+    num_cells = nec.shape[-1]
+    cells = np.broadcast_to(np.arange(num_cells), nec.shape)
+    incidence = sparse.csr_matrix(
+        (np.ones(nec.size, dtype=bool), (nec.reshape(-1), cells.reshape(-1))),
+        shape=(len(mesh.points), num_cells),
+    )
+    incidence.sum_duplicates()
+    return incidence
+
+
+def scatter(out, local, vals):
+    """Add the values `vals` (with leading batch axes) to the positions `local` of
+    `out`; values with a negative position are dropped.
+    """
+    is_inside = local >= 0
+    vals = vals[..., is_inside]
+    if out.ndim == 1 and not np.iscomplexobj(vals):
+        npx.add_at(out, local[is_inside], vals)
+    elif out.ndim == 1:
+        np.add.at(out, local[is_inside], vals)
+    else:
+        np.add.at(out.T, local[is_inside], np.moveaxis(vals, 0, -1))
@@ -0,0 +1,286 @@
+import multiprocessing
+import traceback
+import weakref
+
+import numpy as np
+import scipy.linalg
+from scipy import sparse
+from scipy.sparse import linalg
+
+from .kernel_operator import KernelOperator
+from .restriction import get_vertex_cells
+
+
+class SchwarzPreconditioner(linalg.LinearOperator):
+    """Overlapping Schwarz preconditioner for scipy's Krylov methods.
+
+    The vertices of the mesh are split into `num_subdomains` parts by recursive
+    coordinate bisection; every part is extended by `overlap` layers of neighbors in
+    the mesh (vertices sharing a cell). The subdomain matrices are the corresponding
+    principal submatrices, i.e., the problems with homogeneous Dirichlet conditions
+    on the artificial boundaries. Every subdomain matrix is LU-factored once. For a
+    `KernelOperator` (`matrix_free=True`), they are computed from the kernels on the
+    cells of the subdomain only, so the full matrix is never formed.
+
+    With `restricted=False`, this is the additive Schwarz method, which is
+    symmetric if the operator is, so it can be used with CG. With `restricted=True`
+    (RAS), every vertex only takes the solution of the subdomain it belongs to
+    without the overlap; that saves communication and usually converges faster,
+    but needs GMRES.
+
+    With `coarse_space=True`, a coarse correction on the span Z of the
+    partition-of-unity vectors (the indicator function of each subdomain divided by
+    the number of subdomains sharing the vertex) is added in the balanced way,
+    Q + (I - Q A) M (I - A Q) with Q = Z (Z^T A Z)^{-1} Z^T. It connects all
+    subdomains, which keeps the iteration count from growing with their number, at
+    the cost of two more matvecs per application.
+
+    With `processes`, the subdomains are distributed over that many worker
+    processes, which set up and keep the factorizations of their subdomains; the
+    vectors are exchanged through shared memory (Python 3.8+). The workers are
+    forked (the kernels can't be pickled), so this needs a platform with `fork`.
+    Call `close()` to stop them; otherwise, they are stopped when the
+    preconditioner is garbage-collected.
+    """
+
+    def __init__(
+        self,
+        A,
+        mesh=None,
+        num_subdomains=4,
+        overlap=1,
+        restricted=False,
+        coarse_space=False,
+        processes=None,
+    ):
+        if mesh is None:
+            mesh = A.mesh
+        n = A.shape[0]
+        if not isinstance(A, KernelOperator):
+            A = sparse.csr_matrix(A)
+        self.restricted = restricted
+
+        parts = partition(mesh.points, num_subdomains)
+        vertex_cells = get_vertex_cells(mesh).astype(float)
+        adjacency = vertex_cells @ vertex_cells.T
+
+        # The subdomains (with overlap) and, for every one of them, the mask of the
+        # vertices it writes its solution to.
+        self.subdomains = []
+        multiplicity = np.zeros(n)
+        for k in range(num_subdomains):
+            is_inside = parts == k
+            for _ in range(overlap):
+                is_inside = adjacency @ is_inside.astype(float) > 0.0
+            idx = np.flatnonzero(is_inside)
+            write_mask = parts[idx] == k if restricted else np.ones(len(idx), bool)
+            self.subdomains.append((idx, write_mask))
+            multiplicity[idx] += 1.0
+
+        dtype = np.result_type(A.dtype, float)
+        super().__init__(dtype, A.shape)
+
+        self._A = A
+        self._Z = None
+        if coarse_space:
+            Z = np.zeros((n, num_subdomains))
+            for k, (idx, _) in enumerate(self.subdomains):
+                Z[idx, k] = 1.0 / multiplicity[idx]
+            self._Z = Z
+            self._E = scipy.linalg.lu_factor(Z.T @ (A @ Z))
+
+        self._pool = None
+        if processes is None or processes <= 1:
+            self._solvers = _factorize(A, self.subdomains)
+        else:
+            task_lists = [self.subdomains[k::processes] for k in range(processes)]
+            self._pool = _WorkerPool(A, [t for t in task_lists if t], n, dtype)
+
+    def close(self):
+        """Stop the worker processes."""
+        if self._pool is not None:
+            self._pool.close()
+
+    def _matvec(self, b):
+        b = np.ravel(b)
+        if np.iscomplexobj(b) and not np.issubdtype(self.dtype, np.complexfloating):
+            return self._matvec(b.real) + 1j * self._matvec(b.imag)
+        b = b.astype(self.dtype)
+
+        if self._Z is None:
+            return self._solve_local(b)
+
+        y = self._coarse_solve(b)
+        z = self._solve_local(b - self._A @ y)
+        return y + z - self._coarse_solve(self._A @ z)
+
+    def _coarse_solve(self, b):
+        return self._Z @ scipy.linalg.lu_solve(self._E, self._Z.T @ b)
+
+    def _solve_local(self, b):
+        if self._pool is not None:
+            return self._pool.solve(b)
+        x = np.zeros_like(b)
+        _apply(self._solvers, b, x)
+        return x
+
+
+def partition(points, num_parts):
+    """Split the points into `num_parts` parts of (nearly) equal size by recursive
+    coordinate bisection; returns the part index of every point.
+    """
+    parts = np.zeros(len(points), dtype=int)
+
+    def bisect(idx, num_parts, offset):
+        if num_parts == 1:
+            parts[idx] = offset
+            return
+        # Cut perpendicular to the longest extent of the bounding box, with the
+        # number of points in proportion to the number of parts on either side.
+        x = points[idx]
+        axis = np.argmax(np.max(x, axis=0) - np.min(x, axis=0))
+        order = np.argsort(x[:, axis], kind="stable")
+        num_left = num_parts // 2
+        k = len(idx) * num_left // num_parts
+        bisect(idx[order[:k]], num_left, offset)
+        bisect(idx[order[k:]], num_parts - num_left, offset + num_left)
+
+    bisect(np.arange(len(points)), num_parts, 0)
+    return parts
+
+
+def _factorize(A, subdomains):
+    """Set up and LU-factor the subdomain matrices, one at a time."""
+    solvers = []
+    for idx, write_mask in subdomains:
+        if isinstance(A, KernelOperator):
+            A_local = A.get_submatrix(idx)
+        else:
+            A_local = A[idx][:, idx]
+        solvers.append((idx, write_mask, linalg.splu(sparse.csc_matrix(A_local))))
+    return solvers
+
+
+def _apply(solvers, b, x):
+    """Add the subdomain solutions for the right-hand side `b` to `x`."""
+    for idx, write_mask, lu in solvers:
+        x[idx[write_mask]] += lu.solve(b[idx])[write_mask]
+
+
+def _worker(conn, A, subdomains, b_name, x_name, n, dtype):
+    """Factor the subdomains, then solve for every request from the parent. Every
+    reply is None on success and the traceback of the error otherwise.
+    """
+    from multiprocessing import shared_memory
+
+    b_shm = shared_memory.SharedMemory(name=b_name)
+    x_shm = shared_memory.SharedMemory(name=x_name)
+    b = np.ndarray(n, dtype=dtype, buffer=b_shm.buf)
+    x = np.ndarray(n, dtype=dtype, buffer=x_shm.buf)
+    try:
+        try:
+            solvers = _factorize(A, subdomains)
+        except Exception:
+            conn.send(traceback.format_exc())
+            return
+        conn.send(None)
+
+        while conn.recv():
+            try:
+                x[:] = 0.0
+                _apply(solvers, b, x)
+            except Exception:
+                conn.send(traceback.format_exc())
+            else:
+                conn.send(None)
+    finally:
+        del b, x
+        b_shm.close()
+        x_shm.close()
+
+
+class _WorkerPool:
+    """Worker processes that keep the factorizations of their subdomains. The
+    right-hand side is read from one shared array; every worker writes its
+    contributions to its own shared array, so they don't have to be locked.
+    """
+
+    def __init__(self, A, task_lists, n, dtype):
+        from multiprocessing import shared_memory
+
+        # Registered before anything is allocated, so that the shared memory and
+        # the processes are released however the setup ends.
+        self._conns = []
+        self._processes = []
+        self._shms = []
+        self._finalizer = weakref.finalize(
+            self, _shutdown, self._conns, self._processes, self._shms
+        )
+
+        try:
+            size = n * np.dtype(dtype).itemsize
+            for _ in range(len(task_lists) + 1):
+                self._shms.append(shared_memory.SharedMemory(create=True, size=size))
+            self._b = np.ndarray(n, dtype=dtype, buffer=self._shms[0].buf)
+            self._x = [
+                np.ndarray(n, dtype=dtype, buffer=shm.buf) for shm in self._shms[1:]
+            ]
+
+            context = multiprocessing.get_context("fork")
+            for tasks, shm in zip(task_lists, self._shms[1:]):
+                conn, child_conn = context.Pipe()
+                process = context.Process(
+                    target=_worker,
+                    args=(child_conn, A, tasks, self._shms[0].name, shm.name, n, dtype),
+                    daemon=True,
+                )
+                process.start()
+                self._conns.append(conn)
+                self._processes.append(process)
+
+            # wait for the factorizations
+            self._wait()
+        except BaseException:
+            self.close()
+            raise
+
+    def _wait(self):
+        errors = []
+        for conn in self._conns:
+            try:
+                reply = conn.recv()
+            except EOFError:
+                reply = "worker process died"
+            if reply is not None:
+                errors.append(reply)
+        if errors:
+            raise RuntimeError("Schwarz worker failed:\n" + "\n".join(errors))
+
+    def solve(self, b):
+        self._b[:] = b
+        for conn in self._conns:
+            conn.send(True)
+        self._wait()
+        return np.sum(self._x, axis=0)
+
+    def close(self):
+        # The arrays must be gone before the shared memory can be closed.
+        self._b = None
+        self._x = None
+        self._finalizer()
+
+
+def _shutdown(conns, processes, shms):
+    for conn in conns:
+        try:
+            conn.send(False)
+        except OSError:
+            pass
+    for process in processes:
+        process.join(timeout=10.0)
+        if process.is_alive():
+            process.terminate()
+            process.join()
+    for shm in shms:
+        shm.close()
+        shm.unlink()
@@ -0,0 +1,141 @@
+import numpy as np
+from scipy import sparse
+
+
+class SparsityPattern:
+    """CSR sparsity pattern of a COO index set (I, J), including the diagonal.
+
+    The COO-to-CSR conversion is done once; afterwards, COO values (with any
+    number of leading batch axes) are summed into CSR data arrays with a single
+    `np.bincount`, or, for values in single precision, with `np.add.reduceat` over
+    the COO values sorted by their CSR entry.
+    """
+
+    def __init__(self, I, J, n):
+        self.shape = (n, n)
+
+        I = np.concatenate([np.asarray(I).reshape(-1), np.arange(n)])
+        J = np.concatenate([np.asarray(J).reshape(-1), np.arange(n)])
+        # The diagonal is appended to the COO entries; don't expect values for it.
+        self.num_coo = len(I) - n
+
+        keys, coo_to_csr = np.unique(I * n + J, return_inverse=True)
+        self.coo_to_csr = coo_to_csr.reshape(-1)[: self.num_coo]
+        self.nnz = len(keys)
+        self._keys = keys
+
+        self.rows = keys // n
+        self.indices = keys % n
+        self.indptr = np.concatenate(
+            [[0], np.cumsum(np.bincount(self.rows, minlength=n))]
+        )
+        self.diagonal_index = np.searchsorted(keys, np.arange(n) * (n + 1))
+        self._sorted = None
+
+    def get_data(self, V):
+        """Sum the COO values `V` of shape (..., num_coo) into CSR data of shape
+        (..., nnz). The data has the precision of `V`; np.bincount only sums in
+        double precision, so other values are summed by `_get_sorted_data()`.
+        """
+        V = np.asarray(V)
+        if V.dtype in [np.float32, np.complex64]:
+            return self._get_sorted_data(V)
+
+        batch_shape = V.shape[:-1]
+        V = V.reshape(-1, self.num_coo)
+        k = len(V)
+
+        idx = (self.coo_to_csr + self.nnz * np.arange(k)[:, None]).reshape(-1)
+        if np.iscomplexobj(V):
+            data = np.bincount(idx, weights=V.real.reshape(-1), minlength=k * self.nnz)
+            data = data + 1j * np.bincount(
+                idx, weights=V.imag.reshape(-1), minlength=k * self.nnz
+            )
+        else:
+            data = np.bincount(idx, weights=V.reshape(-1), minlength=k * self.nnz)
+
+        return data.reshape(batch_shape + (self.nnz,))
+
+    def _get_sorted_data(self, V):
+        if self._sorted is None:
+            order = np.argsort(self.coo_to_csr, kind="stable")
+            keys = self.coo_to_csr[order]
+            starts = np.flatnonzero(np.concatenate([[True], keys[1:] != keys[:-1]]))
+            self._sorted = order, starts, keys[starts]
+
+        order, starts, entries = self._sorted
+        data = np.zeros(V.shape[:-1] + (self.nnz,), dtype=V.dtype)
+        if len(order) > 0:
+            data[..., entries] = np.add.reduceat(V[..., order], starts, axis=-1)
+        return data
+
+    def get_row_entries(self, rows):
+        """Indices into the data array of all entries in `rows`."""
+        rows = np.asarray(rows)
+        counts = self.indptr[rows + 1] - self.indptr[rows]
+        starts = np.repeat(self.indptr[rows], counts)
+        offsets = np.arange(np.sum(counts)) - np.repeat(
+            np.cumsum(counts) - counts, counts
+        )
+        return starts + offsets
+
+    def get_entries(self, I, J):
+        """Indices into the data array of the entries (I, J); they must be part of
+        the pattern.
+        """
+        return np.searchsorted(self._keys, I * self.shape[1] + J)
+
+    def set_rows(self, data, rows, diag_vals):
+        """In-place, set the rows `rows` to 0 and their diagonal to `diag_vals`."""
+        data[..., self.get_row_entries(rows)] = 0.0
+        data[..., self.diagonal_index[rows]] = diag_vals
+        return data
+
+    def get_csr(self, data):
+        return sparse.csr_matrix((data, self.indices, self.indptr), shape=self.shape)
+
+
+def cast_data(data, dtype):
+    """Cast matrix data to `dtype` (e.g., `np.float32`); complex data stays complex
+    with the same precision.
+    """
+    if dtype is None:
+        return data
+    if np.iscomplexobj(data):
+        dtype = np.promote_types(dtype, np.complex64)
+    return data.astype(dtype, copy=False)
+
+
+class CsrBatch:
+    """A batch of CSR matrices sharing one sparsity pattern. `data` has shape
+    (k, nnz); `batch[i]` is a `csr_matrix` that shares the buffers of the batch.
+    """
+
+    def __init__(self, indptr, indices, data, shape):
+        self.indptr = indptr
+        self.indices = indices
+        self.data = data
+        self.shape = shape
+
+    def __len__(self):
+        return len(self.data)
+
+    def __getitem__(self, k):
+        return sparse.csr_matrix(
+            (self.data[k], self.indices, self.indptr), shape=self.shape
+        )
+
+    def __iter__(self):
+        for k in range(len(self)):
+            yield self[k]
+
+    def dot(self, x):
+        """Multiply each matrix with the corresponding row of `x` (shape (k, n))."""
+        prod = self.data * x[:, self.indices]
+        out = np.zeros((len(self), self.shape[0]), dtype=prod.dtype)
+        counts = np.diff(self.indptr)
+        is_nonempty = counts > 0
+        out[:, is_nonempty] = np.add.reduceat(
+            prod, self.indptr[:-1][is_nonempty], axis=1
+        )
+        return out
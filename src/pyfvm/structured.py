@@ -0,0 +1,212 @@
+import numpy as np
+from scipy import sparse
+
+
+class Stencil:
+    """Edge layout of a mesh whose edges connect vertices at a small, fixed set of
+    index offsets, e.g., tensor-product meshes from `meshzoo.rectangle_tri`.
+
+    The cell-edges are grouped by their offset j - i and, within one offset, by how
+    often the row i has already appeared. In every group, the rows (and hence the
+    columns) are pairwise distinct, so contributions can be added with plain indexed
+    additions instead of `np.add.at`, and the operator can be stored in DIA format.
+
+    On tensor-product meshes, the rows of a group are contiguous runs, one per grid
+    line, and the edges are equally spaced in the cell array. Such groups are stored
+    as `_Block`s and added via strided views, without gathering or scattering
+    through index arrays.
+    """
+
+    def __init__(self, nec, n):
+        self.n = n
+        self.shape = nec.shape[1:]
+
+        i = nec[0].reshape(-1)
+        j = nec[1].reshape(-1)
+        diff = j - i
+
+        # Sort by (offset, row) and rank repeated (offset, row) pairs.
+        order = np.lexsort((i, diff))
+        key = np.stack([diff[order], i[order]])
+        is_new = np.concatenate([[True], np.any(key[:, 1:] != key[:, :-1], axis=0)])
+        run_start = np.maximum.accumulate(np.where(is_new, np.arange(len(order)), 0))
+        rank = np.arange(len(order)) - run_start
+
+        self.groups = []
+        for r in np.unique(rank):
+            in_rank = order[rank == r]
+            d = diff[in_rank]
+            for offset in np.unique(d):
+                perm = in_rank[d == offset]
+                self.groups.append(_get_group(int(offset), perm, i[perm], j[perm]))
+
+        self.offsets = np.unique(np.concatenate([[0], diff, -diff]))
+        self._offset_index = {int(o): k for k, o in enumerate(self.offsets)}
+
+    def scatter(self, out, vals):
+        """Adds edge contributions of shape (..., 2, *nec.shape[1:]) to `out`, where
+        the leading axes are batch axes.
+        """
+        vals = np.asarray(vals)
+        vals = vals.reshape(vals.shape[: vals.ndim - len(self.shape)] + (-1,))
+        v0 = vals[..., 0, :]
+        v1 = vals[..., 1, :]
+        for _, perm, rows, cols in self.groups:
+            _add(out, rows, _take(v0, perm))
+            _add(out, cols, _take(v1, perm))
+        return out
+
+    def get_dia_data(self, diag, edge_vals):
+        """Assemble the DIA data array from a diagonal and a list of edge matrix
+        contributions, each of shape (2, 2, *nec.shape[1:]).
+        """
+        diag = np.asarray(diag)
+        dtype = np.result_type(diag, *edge_vals)
+        data = np.zeros((len(self.offsets), self.n), dtype=dtype)
+
+        k0 = self._offset_index[0]
+        data[k0] += diag
+        for v in edge_vals:
+            v00, v01, v10, v11 = (v[a][b].reshape(-1) for a, b in np.ndindex(2, 2))
+            for offset, perm, rows, cols in self.groups:
+                _add(data[k0], rows, _take(v00, perm))
+                _add(data[k0], cols, _take(v11, perm))
+                # A[i, j] lives in data[k(j - i), j]
+                _add(data[self._offset_index[offset]], cols, _take(v01, perm))
+                _add(data[self._offset_index[-offset]], rows, _take(v10, perm))
+        return data
+
+    def get_dia_matrix(self, data):
+        return sparse.dia_matrix((data, self.offsets), shape=(self.n, self.n))
+
+    def zero_rows(self, data, rows):
+        """Set the matrix rows `rows` to 0 in the DIA data array."""
+        for k, offset in enumerate(self.offsets):
+            cols = rows + offset
+            is_valid = (cols >= 0) & (cols < self.n)
+            data[k, cols[is_valid]] = 0.0
+        return data
+
+    def set_diagonal(self, data, rows, vals):
+        data[self._offset_index[0], rows] = vals
+        return data
+
+
+class _Block:
+    """The indices start + a * strides[0] + b * strides[1] of the last axis, with
+    (a, b) < shape, accessed as a strided view.
+    """
+
+    def __init__(self, start, shape, strides):
+        self.start = start
+        self.shape = shape
+        self.strides = strides
+
+    def shift(self, offset):
+        return _Block(self.start + offset, self.shape, self.strides)
+
+    def view(self, a):
+        s = a.strides[-1]
+        return np.lib.stride_tricks.as_strided(
+            a[..., self.start :],
+            shape=a.shape[:-1] + self.shape,
+            strides=a.strides[:-1] + (self.strides[0] * s, self.strides[1] * s),
+        )
+
+
+def _get_group(offset, perm, rows, cols):
+    """Returns the group as `_Block`s if the rows and the edges `perm` are regularly
+    spaced runs of equal length, and as index arrays otherwise.
+    """
+    n = len(perm)
+    length = n
+    for index in [perm, rows]:
+        steps = np.diff(index)
+        breaks = np.flatnonzero(steps != steps[0]) if n > 1 else []
+        if len(breaks) > 0:
+            length = min(length, breaks[0] + 1)
+
+    if n % length == 0:
+        perm_block = _get_block(perm, (n // length, length))
+        row_block = _get_block(rows, (n // length, length))
+        if perm_block is not None and row_block is not None:
+            return offset, perm_block, row_block, row_block.shift(offset)
+
+    return offset, perm, rows, cols
+
+
+def _get_block(index, shape):
+    index = index.reshape(shape)
+    start = index[0, 0]
+    strides = (
+        index[1, 0] - start if shape[0] > 1 else 0,
+        index[0, 1] - start if shape[1] > 1 else 0,
+    )
+    if strides[0] < 0 or strides[1] < 0:
+        return None
+    expected = (
+        start
+        + strides[0] * np.arange(shape[0])[:, None]
+        + strides[1] * np.arange(shape[1])
+    )
+    if not np.array_equal(index, expected):
+        return None
+    return _Block(int(start), shape, tuple(int(s) for s in strides))
+
+
+def _take(a, index):
+    if isinstance(index, _Block):
+        return index.view(a)
+    return a[..., index]
+
+
+def _add(out, index, vals):
+    """out[..., index] += vals for pairwise distinct indices."""
+    if isinstance(index, _Block):
+        view = index.view(out)
+        view += vals
+    else:
+        out[..., index] += vals
+
+
+def is_tensor_product(points, decimals=10):
+    """Check if the points are the nodes of a tensor-product grid."""
+    num_nodes = 1
+    for coord in points.T:
+        num_nodes *= len(np.unique(np.round(coord, decimals)))
+    return num_nodes == len(points)
+
+
+def get_stencil(mesh, max_offsets=None):
+    """Returns the `Stencil` for the edges of `mesh` if `mesh` is a structured
+    tensor-product mesh, `None` otherwise.
+    """
+    points = mesh.points
+    if not is_tensor_product(points):
+        return None
+
+    nec = mesh.idx[-1]
+    if max_offsets is None:
+        # In a box stencil, every vertex has at most (3^dim - 1) / 2 forward
+        # neighbors.
+        dim = np.sum(np.ptp(points, axis=0) > 0.0)
+        max_offsets = (3 ** dim - 1) // 2
+
+    num_offsets = len(np.unique(np.abs(nec[1] - nec[0])))
+    if num_offsets > max_offsets:
+        return None
+
+    return Stencil(nec, len(points))
+
+
+def get_mesh_stencil(mesh, structured):
+    """Interprets the `structured` argument of the discretization functions: `True`
+    requires a structured mesh, `"auto"` detects it, `False` turns it off.
+    """
+    if structured is False or structured is None:
+        return None
+
+    stencil = get_stencil(mesh)
+    if stencil is None and structured is True:
+        raise ValueError("The mesh is not a structured tensor-product mesh.")
+    return stencil
@@ -0,0 +1,66 @@
+import numpy as np
+from scipy import sparse
+from scipy.sparse import linalg
+
+
+class WirtingerOperator:
+    """The real-linear operator phi -> A phi + B conj(phi), e.g., the Jacobian of a
+    residual with conj() or abs() terms of complex unknowns like Ginzburg-Landau's
+    psi |psi|^2. A and B are the Wirtinger derivatives dF/du and dF/dconj(u).
+
+    The operator is not complex-linear, so complex Krylov methods don't apply to
+    it directly. `get_real_operator()` gives the equivalent real operator on
+    [Re(phi), Im(phi)] without storing its 2n x 2n matrix; `get_real_matrix()`
+    assembles that for factorization. The linear solvers of pyfvm ("direct" and
+    the Krylov methods) do the conversion themselves.
+    """
+
+    def __init__(self, A, B):
+        assert A.shape == B.shape
+        self.A = A
+        self.B = B
+        self.shape = A.shape
+        self.dtype = np.result_type(A.dtype, B.dtype, complex)
+        self._real_operator = None
+        self._real_matrix = None
+
+    def dot(self, phi):
+        return self.A @ phi + self.B @ np.conj(phi)
+
+    def __matmul__(self, phi):
+        return self.dot(phi)
+
+    def get_real_operator(self):
+        """The operator as a real `LinearOperator` on [Re(phi), Im(phi)]."""
+        if self._real_operator is None:
+            n = self.shape[1]
+
+            def matvec(x):
+                x = np.ravel(x)
+                return to_real(self.dot(x[:n] + 1j * x[n:]))
+
+            self._real_operator = linalg.LinearOperator(
+                (2 * self.shape[0], 2 * n), matvec=matvec, dtype=float
+            )
+        return self._real_operator
+
+    def get_real_matrix(self):
+        """The sparse real 2n x 2n matrix of the operator on [Re(phi), Im(phi)]."""
+        if self._real_matrix is None:
+            # With phi = x + iy, A phi + B conj(phi) = (A + B) x + i (A - B) y.
+            P = sparse.csr_matrix(self.A + self.B)
+            Q = sparse.csr_matrix(self.A - self.B)
+            self._real_matrix = sparse.bmat(
+                [[P.real, -Q.imag], [P.imag, Q.real]], format="csr"
+            )
+        return self._real_matrix
+
+
+def to_real(z):
+    """[Re(z), Im(z)]"""
+    return np.concatenate([z.real, z.imag])
+
+
+def from_real(x):
+    n = len(x) // 2
+    return x[:n] + 1j * x[n:]
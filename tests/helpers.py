@@ -1,8 +1,39 @@
-import matplotlib.pyplot as plt
 import meshplex
 import numpy as np
 import sympy
 
+from pyfvm.form_language import Boundary, dS, dV, integrate, n_dot_grad
+
+
+class Bratu:
+    """-Delta u = 2 exp(u) with u = x y on the boundary."""
+
+    def apply(self, u):
+        return integrate(lambda x: -n_dot_grad(u(x)), dS) - integrate(
+            lambda x: 2.0 * sympy.exp(u(x)), dV
+        )
+
+    def dirichlet(self, u):
+        return [(lambda x: u(x) - x[0] * x[1], Boundary())]
+
+
+def get_rectangle_mesh(nx, ny=None, width=1.0, height=1.0, permute=False):
+    """Triangle mesh of [0, width] x [0, height] with nx x ny (default: nx x nx)
+    squares. With `permute`, the vertices are numbered randomly.
+    """
+    import meshzoo
+
+    if ny is None:
+        ny = nx
+    points, cells = meshzoo.rectangle_tri(
+        np.linspace(0.0, width, nx + 1), np.linspace(0.0, height, ny + 1)
+    )
+    if permute:
+        perm = np.random.permutation(len(points))
+        points = points[perm]
+        cells = np.argsort(perm)[cells]
+    return meshplex.Mesh(points, cells)
+
 
 def perform_convergence_tests(discrete_solver, exact_sol, get_mesh, rng, verbose=False):
     n = len(rng)
@@ -84,11 +115,15 @@ def perform_convergence_tests(discrete_solver, exact_sol, get_mesh, rng, verbose
 
 
 def show_error_data(*args, **kwargs):
+    import matplotlib.pyplot as plt
+
     plot_error_data(*args, **kwargs)
     plt.show()
 
 
 def plot_error_data(H, error_norm_1, error_norm_inf):
+    import matplotlib.pyplot as plt
+
     # plot error data
     plt.loglog(H, error_norm_1, "xk", label="||error||_1")
     plt.loglog(H, error_norm_inf, "ok", label="||error||_inf")
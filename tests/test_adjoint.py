@@ -0,0 +1,172 @@
+import helpers
+import numpy as np
+from sympy import I, exp, pi, sin
+
+import pyfvm
+from pyfvm.form_language import Boundary, dS, dV, integrate, n_dot_grad
+
+
+class ParametrizedBratu:
+    """-Delta u - lambda_0 exp(u) = lambda_1 sin(pi x) sin(pi y), u = lambda_2 x on
+    the boundary
+    """
+
+    def apply(self, u, lmbda):
+        return (
+            integrate(lambda x: -n_dot_grad(u(x)), dS)
+            - integrate(lambda x: lmbda[0] * exp(u(x)), dV)
+            - integrate(lambda x: lmbda[1] * sin(pi * x[0]) * sin(pi * x[1]), dV)
+        )
+
+    def dirichlet(self, u, lmbda):
+        return [(lambda x: u(x) - lmbda[2] * x[0], Boundary())]
+
+
+def test_gradient():
+    mesh = helpers.get_rectangle_mesh(20)
+    obj = ParametrizedBratu()
+    lmbda = np.array([1.0, 2.0, 0.5])
+    problem, jacobian = pyfvm.discretize(obj, mesh, lmbda=lmbda, num_parameters=3)
+
+    cv = mesh.control_volumes
+
+    def solve(lmbda, linear_solver="direct"):
+        u0 = np.zeros(len(mesh.points))
+        u, report = pyfvm.inexact_newton(
+            lambda u: problem.eval(u, lmbda),
+            lambda u: jacobian.get_linear_operator(u, lmbda=lmbda),
+            u0,
+            tol=1.0e-13,
+            forcing=1.0e-12,
+            linear_solver=linear_solver,
+        )
+        assert report.converged
+        return u
+
+    def objective(u):
+        return 0.5 * np.dot(cv, u ** 2)
+
+    linear_solver = pyfvm.SolverContext()
+    u = solve(lmbda, linear_solver)
+    adjoint = pyfvm.AdjointSolver(problem, jacobian, linear_solver=linear_solver)
+    gradient = adjoint.get_gradient(u, cv * u)
+    # the factorization of the forward solve is reused
+    assert adjoint.num_factorizations == 0
+
+    h = 1.0e-5
+    ref = np.empty(3)
+    for k in range(3):
+        e = np.zeros(3)
+        e[k] = h
+        ref[k] = (objective(solve(lmbda + e)) - objective(solve(lmbda - e))) / (2 * h)
+
+    assert np.all(np.abs(gradient - ref) < 1.0e-6 * np.max(np.abs(ref)))
+
+
+class Helmholtz:
+    def apply(self, u, lmbda):
+        return integrate(lambda x: -n_dot_grad(u(x)), dS) - integrate(
+            lambda x: lmbda[0] * (1.0 + 2.0j) * u(x) ** 2 - 1.0, dV
+        )
+
+    def dirichlet(self, u, lmbda):
+        return [(u, Boundary())]
+
+
+def test_complex():
+    mesh = helpers.get_rectangle_mesh(20)
+    problem, jacobian = pyfvm.discretize(
+        Helmholtz(), mesh, lmbda=np.array([1.0]), num_parameters=1
+    )
+
+    n = len(mesh.points)
+    u = np.random.rand(n) + 1j * np.random.rand(n)
+    rhs = np.random.rand(n) + 1j * np.random.rand(n)
+    matrix = jacobian.get_linear_operator(u)
+
+    # the Hermitian adjoint, with a new factorization and with the one of a
+    # slightly different matrix
+    linear_solver = pyfvm.SolverContext()
+    linear_solver(jacobian.get_linear_operator(1.01 * u), rhs)
+    for ls in [None, linear_solver]:
+        adjoint = pyfvm.AdjointSolver(problem, jacobian, linear_solver=ls)
+        psi = adjoint.solve(u, rhs)
+        res = matrix.conj().T @ psi - rhs
+        assert np.linalg.norm(res) < 1.0e-10 * np.linalg.norm(rhs)
+
+
+def test_reuse():
+    mesh = helpers.get_rectangle_mesh(20)
+    problem, jacobian = pyfvm.discretize(
+        Helmholtz(), mesh, lmbda=np.array([1.0]), num_parameters=1
+    )
+    n = len(mesh.points)
+    u = np.random.rand(n) + 1j * np.random.rand(n)
+    rhs = np.random.rand(n) + 1j * np.random.rand(n)
+
+    adjoint = pyfvm.AdjointSolver(problem, jacobian, max_age=1)
+    adjoint.solve(u, rhs)
+    # the same state: the factorization is used as is
+    adjoint.solve(u, 2.0 * rhs)
+    assert adjoint.num_factorizations == 1
+    assert adjoint.num_linear_iterations == 0
+
+    # another state: the factorization preconditions GMRES, until max_age
+    adjoint.solve(1.01 * u, rhs)
+    assert adjoint.num_factorizations == 1
+    assert adjoint.num_linear_iterations > 0
+    adjoint.solve(1.02 * u, rhs)
+    assert adjoint.num_factorizations == 2
+
+
+class ParametrizedGinzburgLandau:
+    """-Delta psi + (-lambda_0 + |psi|^2) psi = 0"""
+
+    def apply(self, psi, lmbda):
+        return integrate(lambda x: -n_dot_grad(psi(x)), dS) + integrate(
+            lambda x: (-lmbda[0] + abs(psi(x)) ** 2) * psi(x), dV
+        )
+
+    def dirichlet(self, psi, lmbda):
+        return [(lambda x: psi(x) - exp(I * pi * x[0]), Boundary())]
+
+
+def test_wirtinger():
+    mesh = helpers.get_rectangle_mesh(10)
+    lmbda = np.array([1.0])
+    problem, jacobian = pyfvm.discretize(
+        ParametrizedGinzburgLandau(), mesh, lmbda=lmbda, num_parameters=1
+    )
+    cv = mesh.control_volumes
+
+    def solve(lmbda):
+        psi0 = np.ones(len(mesh.points), dtype=complex)
+        psi, report = pyfvm.inexact_newton(
+            lambda psi: problem.eval(psi, lmbda),
+            lambda psi: jacobian.get_linear_operator(psi, lmbda=lmbda),
+            psi0,
+            tol=1.0e-13,
+            forcing=1.0e-12,
+        )
+        assert report.converged
+        return psi
+
+    def objective(psi):
+        return 0.5 * np.dot(cv, np.abs(psi) ** 2)
+
+    # the adjoint of the real-linear Jacobian: Re(psi^H J phi) = Re(rhs^H phi)
+    psi = solve(lmbda)
+    n = len(mesh.points)
+    rhs = np.random.rand(n) + 1j * np.random.rand(n)
+    phi = np.random.rand(n) + 1j * np.random.rand(n)
+    adjoint = pyfvm.AdjointSolver(problem, jacobian)
+    psi_adjoint = adjoint.solve(psi, rhs)
+    J = jacobian.get_linear_operator(psi)
+    assert abs(np.vdot(psi_adjoint, J @ phi).real - np.vdot(rhs, phi).real) < 1.0e-10
+
+    # dJ/dRe(psi) + i dJ/dIm(psi) = cv psi
+    gradient = adjoint.get_gradient(psi, cv * psi)
+    assert np.isrealobj(gradient)
+    h = 1.0e-5
+    ref = (objective(solve(lmbda + h)) - objective(solve(lmbda - h))) / (2 * h)
+    assert abs(gradient[0] - ref) < 1.0e-6 * abs(ref)
@@ -0,0 +1,76 @@
+import helpers
+import numpy as np
+
+import pyfvm
+from pyfvm.autodiff import Dual
+
+
+class Diffusion:
+    """Nonlinear diffusion with the conductivity 1 + u^2 at the edge midpoint."""
+
+    def __init__(self):
+        self.subdomains = [None]
+
+    def eval(self, u, mesh, cell_mask):
+        nec = mesh.idx[-1][..., cell_mask]
+        ce_ratios = mesh.ce_ratios[..., cell_mask]
+        u0 = u[nec[0]]
+        u1 = u[nec[1]]
+        flux = ce_ratios * (1.0 + (0.5 * (u0 + u1)) ** 2) * (u0 - u1)
+        return np.stack([flux, -flux])
+
+
+class Source:
+    def __init__(self):
+        self.subdomains = [None]
+
+    def eval(self, u, mesh, vertex_mask):
+        return -mesh.control_volumes[vertex_mask] * np.exp(u[vertex_mask])
+
+
+class Boundary:
+    def __init__(self):
+        self.subdomain = pyfvm.form_language.Boundary()
+
+    def eval(self, u, mesh, vertex_mask):
+        return u[vertex_mask] - mesh.points[vertex_mask, 0]
+
+
+def test_dual():
+    x = np.linspace(0.1, 2.0, 7)
+    d = Dual(x, [np.ones_like(x)])
+    y = np.sin(d) * d ** 2 / (1.0 + np.exp(-d)) - np.sqrt(d)
+    ref = (
+        (np.cos(x) * x ** 2 + 2 * x * np.sin(x)) / (1.0 + np.exp(-x))
+        + np.sin(x) * x ** 2 * np.exp(-x) / (1.0 + np.exp(-x)) ** 2
+        - 0.5 / np.sqrt(x)
+    )
+    assert np.all(np.abs(y.deriv[0] - ref) < 1.0e-12)
+
+
+def test_jacobian():
+    mesh = helpers.get_rectangle_mesh(20)
+    problem = pyfvm.AutodiffProblem(
+        mesh, edge_kernels=[Diffusion()], vertex_kernels=[Source()]
+    )
+    fd = pyfvm.FiniteDifferenceJacobian(problem.eval, mesh)
+
+    u = np.random.rand(len(mesh.points))
+    matrix = problem.get_linear_operator(u)
+    assert abs(matrix - fd.get_linear_operator(u)).max() < 1.0e-6
+
+
+def test_newton():
+    mesh = helpers.get_rectangle_mesh(20)
+    problem = pyfvm.AutodiffProblem(
+        mesh,
+        edge_kernels=[Diffusion()],
+        vertex_kernels=[Source()],
+        dirichlets=[Boundary()],
+    )
+    u0 = np.zeros(len(mesh.points))
+    u, report = pyfvm.inexact_newton(problem.eval, problem, u0, forcing=1.0e-10)
+    assert report.converged
+    # quadratic convergence with the exact Jacobian
+    assert report.num_iterations <= 6
+    assert np.linalg.norm(problem.eval(u)) < 1.0e-10
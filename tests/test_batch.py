@@ -0,0 +1,130 @@
+import helpers
+import numpy as np
+from sympy import exp
+
+import pyfvm
+from pyfvm.form_language import (
+    Boundary,
+    Subdomain,
+    dGamma,
+    dS,
+    dV,
+    integrate,
+    n_dot_grad,
+)
+
+
+class Bratu:
+    def apply(self, u):
+        return integrate(lambda x: -n_dot_grad(u(x)), dS) - integrate(
+            lambda x: 2.0 * exp(u(x)) + x[0], dV
+        )
+
+    def dirichlet(self, u):
+        return [(lambda x: u(x) - x[1], Boundary())]
+
+
+def test_batch():
+    mesh = helpers.get_rectangle_mesh(10)
+    f, jacobian = pyfvm.discretize(Bratu(), mesh)
+
+    k = 4
+    u = np.random.rand(k, len(mesh.points))
+
+    vals = f.eval(u)
+    assert vals.shape == u.shape
+    for i in range(k):
+        assert np.all(abs(vals[i] - f.eval(u[i])) < 1.0e-13)
+
+    jacs = jacobian.get_linear_operator(u)
+    assert len(jacs) == k
+    x = np.random.rand(k, len(mesh.points))
+    y = jacs.dot(x)
+    for i in range(k):
+        jac = jacobian.get_linear_operator(u[i])
+        assert abs(jacs[i] - jac).max() < 1.0e-13
+        assert np.all(abs(y[i] - jac @ x[i]) < 1.0e-13)
+
+
+class Helmholtz:
+    def apply(self, u, lmbda):
+        return integrate(lambda x: -n_dot_grad(u(x)), dS) - integrate(
+            lambda x: lmbda * u(x) + lmbda ** 2, dV
+        )
+
+    def dirichlet(self, u):
+        return [(lambda x: u(x) - x[1], Boundary())]
+
+
+def test_parameter_sweep():
+    mesh = helpers.get_rectangle_mesh(10)
+
+    lmbda = np.linspace(0.0, 2.0, 5)
+    matrices, rhs = pyfvm.discretize_linear(Helmholtz(), mesh, lmbda=lmbda)
+    assert matrices.data.shape[0] == len(lmbda)
+    assert rhs.shape == (len(lmbda), len(mesh.points))
+
+    for k, val in enumerate(lmbda):
+        matrix, r = pyfvm.discretize_linear(Helmholtz(), mesh, lmbda=val)
+        assert abs(matrices[k] - matrix).max() < 1.0e-13
+        assert np.all(abs(rhs[k] - r) < 1.0e-13)
+
+
+class Poisson:
+    def apply(self, u):
+        return integrate(lambda x: -n_dot_grad(u(x)), dS) - integrate(
+            lambda x: 1.0 + x[0], dV
+        )
+
+    def dirichlet(self, u):
+        return [(lambda x: u(x) - x[1], Boundary())]
+
+
+def test_mesh_batch():
+    meshes = []
+    for k in range(5):
+        meshes.append(helpers.get_rectangle_mesh(3 + k, 4, width=1.0 + 0.1 * k))
+
+    batch = pyfvm.MeshBatch(meshes)
+    matrix, rhs = pyfvm.discretize_linear(Poisson(), batch)
+    matrices, rhss = batch.split(matrix, rhs)
+
+    for mesh, m, r in zip(meshes, matrices, rhss):
+        ref_matrix, ref_rhs = pyfvm.discretize_linear(Poisson(), mesh)
+        assert abs(m - ref_matrix).max() < 1.0e-13
+        assert np.all(abs(r - ref_rhs) < 1.0e-13)
+        assert np.shares_memory(m.data, matrix.data)
+
+
+class North(Subdomain):
+    def is_inside(self, x):
+        return x[1] > 1.0 - 1.0e-10
+
+    is_boundary_only = True
+
+
+class Neumann:
+    def apply(self, u):
+        return (
+            integrate(lambda x: -n_dot_grad(u(x)), dS)
+            - integrate(lambda x: 1.0 + x[0], dGamma)
+            - integrate(lambda x: 1.0, dV)
+        )
+
+    def dirichlet(self, u):
+        return [(lambda x: u(x) - x[0], North())]
+
+
+def test_mesh_batch_face_integrals():
+    meshes = []
+    for k in range(5):
+        meshes.append(helpers.get_rectangle_mesh(3 + k, 4, width=1.0 + 0.1 * k))
+
+    batch = pyfvm.MeshBatch(meshes)
+    matrix, rhs = pyfvm.discretize_linear(Neumann(), batch)
+    matrices, rhss = batch.split(matrix, rhs)
+
+    for mesh, m, r in zip(meshes, matrices, rhss):
+        ref_matrix, ref_rhs = pyfvm.discretize_linear(Neumann(), mesh)
+        assert abs(m - ref_matrix).max() < 1.0e-13
+        assert np.all(abs(r - ref_rhs) < 1.0e-13)
@@ -3,10 +3,13 @@ import meshplex
 import meshzoo
 import numpy as np
 import pytest
+import sympy
+from scipy.sparse.linalg import spsolve
 from sympy import cos, exp, pi, sin
 
 import pyfvm
 from pyfvm.form_language import Boundary, dS, dV, integrate, n_dot_grad
+from pyfvm.linear_solvers import get_lu_preconditioner
 
 
 class Square:
@@ -143,6 +146,220 @@ def test(problem, max_k):
     assert order_inf[-1] > expected_order - tol
 
 
+@pytest.mark.parametrize(
+    "kwargs",
+    [
+        {},
+        {"line_search": "cubic", "jacobian_lag": 3},
+        {"linear_solver": "gmres"},
+        {"linear_solver": "bicgstab", "forcing": 1.0e-3, "line_search": None},
+    ],
+)
+def test_inexact_newton(kwargs):
+    problem = Square()
+    mesh = problem.get_mesh(3)
+    f, jacobian = pyfvm.discretize(problem, mesh)
+
+    u0 = np.zeros(len(mesh.points))
+    u, report = pyfvm.inexact_newton(f.eval, jacobian, u0, **kwargs)
+    assert report.converged
+    assert np.linalg.norm(f.eval(u)) < 1.0e-10
+    assert report.num_iterations == len(report.iterations)
+    assert len(report.residual_norms) == report.num_iterations + 1
+    if kwargs.get("jacobian_lag", 1) > 1:
+        assert report.num_jacobian_evaluations < report.num_iterations
+
+    # compare with plain Newton
+    ref = pyfvm.newton(
+        f.eval,
+        lambda u, rhs: spsolve(jacobian.get_linear_operator(u), rhs),
+        u0,
+        verbose=False,
+    )
+    assert np.all(np.abs(u - ref) < 1.0e-8)
+
+
+@pytest.mark.parametrize("with_preconditioner", [False, True])
+def test_jfnk(with_preconditioner):
+    problem = Square()
+    mesh = problem.get_mesh(3)
+    f, jacobian = pyfvm.discretize(problem, mesh)
+
+    u0 = np.zeros(len(mesh.points))
+    ref, _ = pyfvm.inexact_newton(f.eval, jacobian, u0)
+
+    preconditioner = jacobian if with_preconditioner else None
+    u, report = pyfvm.jfnk(f.eval, u0, preconditioner=preconditioner)
+    assert report.converged
+    assert np.all(np.abs(u - ref) < 1.0e-8)
+    if with_preconditioner:
+        assert report.num_jacobian_evaluations == 1
+
+
+def test_jfnk_linear_operator():
+    problem = Square()
+    mesh = problem.get_mesh(3)
+    f, jacobian = pyfvm.discretize(problem, mesh)
+
+    u0 = np.zeros(len(mesh.points))
+    ref, _ = pyfvm.inexact_newton(f.eval, jacobian, u0)
+
+    # a fixed preconditioner that applies the inverse
+    M = get_lu_preconditioner(jacobian.get_linear_operator(u0))
+    u, report = pyfvm.jfnk(f.eval, u0, preconditioner=M)
+    assert report.converged
+    assert report.num_jacobian_evaluations == 0
+    assert np.all(np.abs(u - ref) < 1.0e-8)
+
+    # the same for Anderson
+    u, report = pyfvm.anderson(f.eval, u0, preconditioner=M)
+    assert report.converged
+    assert np.all(np.abs(u - ref) < 1.0e-8)
+
+
+@pytest.mark.parametrize("method", ["lu", "amg"])
+def test_solver_context(method):
+    problem = Square()
+    mesh = problem.get_mesh(4)
+    f, jacobian = pyfvm.discretize(problem, mesh)
+
+    u0 = np.zeros(len(mesh.points))
+    ref, _ = pyfvm.inexact_newton(f.eval, jacobian, u0)
+
+    context = pyfvm.SolverContext(jacobian, method=method)
+    u = pyfvm.newton(f.eval, context.jacobian_solver, u0, verbose=False)
+    assert np.all(np.abs(u - ref) < 1.0e-8)
+    assert context.num_setups < context.num_solves
+
+    # rebuild for every new matrix
+    context = pyfvm.SolverContext(method=method, max_age=0)
+    u, report = pyfvm.inexact_newton(f.eval, jacobian, u0, linear_solver=context)
+    assert report.converged
+    assert context.num_setups == context.num_solves
+    assert context.num_linear_iterations == report.num_linear_iterations
+    assert np.all(np.abs(u - ref) < 1.0e-8)
+
+
+def test_amg_smoothers():
+    problem = Square()
+    mesh = problem.get_mesh(4)
+    f, jacobian = pyfvm.discretize(problem, mesh)
+
+    u0 = np.zeros(len(mesh.points))
+    ref, _ = pyfvm.inexact_newton(f.eval, jacobian, u0)
+
+    # only the options given are passed on to pyamg
+    assert pyfvm.SolverContext(method="amg").amg_options == {}
+
+    context = pyfvm.SolverContext(
+        jacobian, method="amg", presmoother="jacobi", postsmoother="jacobi"
+    )
+    u = pyfvm.newton(f.eval, context.jacobian_solver, u0, verbose=False)
+    assert context.num_refreshes > 0
+    assert np.all(np.abs(u - ref) < 1.0e-8)
+
+
+class Laplace:
+    def apply(self, u):
+        return integrate(lambda x: -n_dot_grad(u(x)), dS)
+
+    def dirichlet(self, u):
+        return [(u, Boundary())]
+
+
+@pytest.mark.parametrize("window", [1, 5])
+def test_anderson(window):
+    problem = Square()
+    mesh = problem.get_mesh(3)
+    f, jacobian = pyfvm.discretize(problem, mesh)
+
+    u0 = np.zeros(len(mesh.points))
+    ref, _ = pyfvm.inexact_newton(f.eval, jacobian, u0)
+
+    # precondition with the linear part
+    matrix, _ = pyfvm.discretize_linear(Laplace(), mesh)
+    u, report = pyfvm.anderson(f.eval, u0, preconditioner=matrix, window=window)
+    assert report.converged
+    assert report.num_jacobian_evaluations == 0
+    assert np.all(np.abs(u - ref) < 1.0e-8)
+
+
+class ParametrizedBratu:
+    def apply(self, u, lmbda):
+        return integrate(lambda x: -n_dot_grad(u(x)), dS) - integrate(
+            lambda x: lmbda * exp(u(x)), dV
+        )
+
+    def dirichlet(self, u):
+        return [(u, Boundary())]
+
+
+def test_parameter_argument():
+    parameters = []
+
+    class Problem:
+        def apply(self, u, lmbda):
+            parameters.append(lmbda)
+            return integrate(lambda x: -n_dot_grad(u(x)), dS)
+
+        def dirichlet(self, u):
+            return [(u, Boundary())]
+
+    mesh = Square().get_mesh(1)
+    # without a value, the parameter is the undefined function `lambda` as before
+    pyfvm.discretize(Problem(), mesh)
+    pyfvm.discretize(Problem(), mesh, lmbda=1.0)
+    assert parameters == [sympy.Function("lambda"), sympy.Symbol("lambda")]
+
+    # errors in apply() aren't mistaken for a missing parameter
+    class Broken:
+        def apply(self, u, lmbda):
+            raise TypeError("broken apply")
+
+    with pytest.raises(TypeError, match="broken apply"):
+        pyfvm.discretize(Broken(), mesh)
+
+
+def test_pseudo_arclength():
+    mesh = Square().get_mesh(2)
+    f, jacobian = pyfvm.discretize(ParametrizedBratu(), mesh, lmbda=1.0)
+
+    # dF/dlambda
+    u = np.random.rand(len(mesh.points))
+    h = 1.0e-6
+    fd = (f.eval(u, 1.0 + h) - f.eval(u, 1.0 - h)) / (2 * h)
+    assert np.all(np.abs(f.eval_parameter_derivative(u) - fd) < 1.0e-6)
+
+    u0 = np.zeros(len(mesh.points))
+    lmbdas, solutions, report = pyfvm.pseudo_arclength(
+        f, jacobian, u0, 0.0, ds=0.5, lmbda_range=(-1.0, 10.0), max_steps=100
+    )
+    assert report.converged
+    for lmbda, u in zip(lmbdas, solutions):
+        assert np.linalg.norm(f.eval(u, lmbda)) < 1.0e-8
+
+    # The branch has a fold at lambda ~ 6.8 and turns back.
+    k = np.argmax(lmbdas)
+    assert 6.0 < lmbdas[k] < 7.5
+    assert lmbdas[-1] < lmbdas[k] - 1.0
+    assert np.max(solutions[-1]) > np.max(solutions[k])
+
+    # The linear solves of the initial Newton correction are counted, too.
+    _, newton_report = pyfvm.inexact_newton(
+        lambda u: f.eval(u, 1.0),
+        lambda u: jacobian.get_linear_operator(u, lmbda=1.0),
+        u0,
+    )
+    _, _, report = pyfvm.pseudo_arclength(f, jacobian, u0, 1.0, max_steps=1)
+    assert report.iterations[0]["converged"]
+    # one corrector solve per Newton iteration but the last, plus two tangents
+    num_corrector_solves = report.iterations[0]["newton_iterations"] - 1
+    assert report.num_linear_solves == (
+        newton_report.num_linear_solves + num_corrector_solves + 2
+    )
+    assert report.num_linear_iterations == newton_report.num_linear_iterations
+
+
 if __name__ == "__main__":
     # problem = Square()
     problem = Disk()
@@ -0,0 +1,95 @@
+import helpers
+import numpy as np
+import pytest
+from scipy import sparse
+
+import pyfvm
+from pyfvm.finite_differences import get_coloring
+from pyfvm.form_language import dS, integrate, n_dot_grad
+
+
+class Laplace:
+    def apply(self, u):
+        return integrate(lambda x: -n_dot_grad(u(x)), dS)
+
+
+def test_coloring():
+    mesh = helpers.get_rectangle_mesh(20)
+    fd = pyfvm.FiniteDifferenceJacobian(None, mesh)
+
+    # columns of the same color don't share a row
+    matrix = fd.pattern.get_csr(np.ones(fd.pattern.nnz)).tocoo()
+    num_per_row_and_color = np.zeros((len(mesh.points), fd.num_colors))
+    np.add.at(num_per_row_and_color, (matrix.row, fd.colors[matrix.col]), 1)
+    assert np.max(num_per_row_and_color) == 1
+    assert fd.num_colors < 20
+
+
+@pytest.mark.parametrize(
+    "distance, ordering",
+    [
+        (1, "largest_first"),
+        (1, "smallest_last"),
+        (2, "largest_first"),
+        (2, "smallest_last"),
+    ],
+)
+def test_coloring_bound(distance, ordering):
+    mesh = helpers.get_rectangle_mesh(20)
+    nec = mesh.idx[-1]
+    n = len(mesh.points)
+    data = np.ones(nec[0].size)
+    graph = sparse.csr_matrix((data, (nec[0].ravel(), nec[1].ravel())), shape=(n, n))
+    colors = get_coloring(graph, distance, ordering)
+
+    adjacency = graph + graph.T
+    if distance == 2:
+        adjacency = adjacency + sparse.identity(n)
+        adjacency = sparse.csr_matrix(adjacency @ adjacency)
+    adjacency.setdiag(0.0)
+    adjacency.eliminate_zeros()
+    adjacency = adjacency.tocoo()
+    assert np.all(colors[adjacency.row] != colors[adjacency.col])
+
+    # the greedy coloring needs at most max degree + 1 colors
+    max_degree = np.max(np.bincount(adjacency.row, minlength=n))
+    assert np.max(colors) + 1 <= max_degree + 1
+
+
+def test_bratu():
+    mesh = helpers.get_rectangle_mesh(20)
+    f, jacobian = pyfvm.discretize(helpers.Bratu(), mesh)
+    fd = pyfvm.FiniteDifferenceJacobian(f.eval, mesh)
+
+    u = np.random.rand(len(mesh.points))
+    ref = jacobian.get_linear_operator(u)
+    assert abs(fd.get_linear_operator(u) - ref).max() < 1.0e-6
+
+    u0 = np.zeros(len(mesh.points))
+    ref, _ = pyfvm.inexact_newton(f.eval, jacobian, u0)
+    u, report = pyfvm.inexact_newton(f.eval, fd, u0)
+    assert report.converged
+    assert np.all(np.abs(u - ref) < 1.0e-8)
+
+
+def test_wirtinger():
+    # Ginzburg-Landau-type residual with a |psi|^2 term
+    mesh = helpers.get_rectangle_mesh(20)
+    laplace, _ = pyfvm.discretize_linear(Laplace(), mesh)
+    cv = mesh.control_volumes
+
+    def f(psi):
+        return laplace @ psi + cv * psi * (-1.0 + abs(psi) ** 2)
+
+    fd = pyfvm.FiniteDifferenceJacobian(f, mesh)
+    n = len(mesh.points)
+    psi = np.random.rand(n) + 1j * np.random.rand(n)
+    A, B = fd.get_wirtinger_matrices(psi)
+
+    phi = np.random.rand(n) + 1j * np.random.rand(n)
+    ref = (
+        laplace @ phi
+        + cv * (-1.0 + 2.0 * abs(psi) ** 2) * phi
+        + cv * psi ** 2 * phi.conj()
+    )
+    assert np.all(np.abs(A @ phi + B @ phi.conj() - ref) < 1.0e-6)
@@ -0,0 +1,150 @@
+import tracemalloc
+
+import helpers
+import numpy as np
+import pytest
+from scipy.sparse import linalg
+from sympy import exp
+
+import pyfvm
+from pyfvm.form_language import Boundary, dS, dV, integrate, n_dot, n_dot_grad
+
+
+class Convection:
+    def apply(self, u):
+        a = np.array([2, 1])
+        return integrate(lambda x: -n_dot_grad(u(x)) + n_dot(a) * u(x), dS) + integrate(
+            lambda x: 3.0 * u(x) - 1.0 - x[0], dV
+        )
+
+    def dirichlet(self, u):
+        return [(lambda x: u(x) - x[1], Boundary())]
+
+
+class Bratu:
+    def apply(self, u):
+        return integrate(lambda x: -n_dot_grad(u(x)), dS) - integrate(
+            lambda x: 2.0 * exp(u(x)), dV
+        )
+
+    def dirichlet(self, u):
+        return [(u, Boundary())]
+
+
+@pytest.mark.parametrize("structured", [False, True])
+def test_linear(structured):
+    mesh = helpers.get_rectangle_mesh(20, 10, width=2.0)
+
+    matrix, rhs = pyfvm.discretize_linear(Convection(), mesh, structured=structured)
+    op, op_rhs = pyfvm.discretize_linear(
+        Convection(), mesh, structured=structured, matrix_free=True
+    )
+    assert isinstance(op, linalg.LinearOperator)
+    assert op.dtype == float
+    assert np.all(abs(rhs - op_rhs) < 1.0e-13)
+
+    x = np.random.rand(len(mesh.points))
+    assert np.all(abs(matrix @ x - op @ x) < 1.0e-13)
+
+    _check_diagonal_and_row_sums(matrix, op)
+
+
+@pytest.mark.parametrize("structured", [False, True])
+def test_jacobian(structured):
+    mesh = helpers.get_rectangle_mesh(20, 10, width=2.0)
+    _, jacobian = pyfvm.discretize(Bratu(), mesh, structured=structured)
+
+    u = np.random.rand(len(mesh.points))
+    matrix = jacobian.get_linear_operator(u)
+    op = jacobian.get_linear_operator(u, matrix_free=True)
+    assert op.dtype == float
+
+    x = np.random.rand(len(mesh.points))
+    assert np.all(abs(matrix @ x - op @ x) < 1.0e-13)
+
+    _check_diagonal_and_row_sums(matrix, op)
+
+
+@pytest.mark.parametrize("structured", [False, True])
+def test_complex(structured):
+    mesh = helpers.get_rectangle_mesh(20, 10, width=2.0)
+    _, jacobian = pyfvm.discretize(Bratu(), mesh, structured=structured)
+
+    n = len(mesh.points)
+    u = np.random.rand(n) + 1j * np.random.rand(n)
+    matrix = jacobian.get_linear_operator(u)
+    op = jacobian.get_linear_operator(u, matrix_free=True)
+    assert op.dtype == complex
+
+    x = np.random.rand(n)
+    assert np.all(abs(matrix @ x - op @ x) < 1.0e-13)
+    assert np.all(abs(matrix.diagonal() - op.diagonal()) < 1.0e-13)
+    row_sums = np.asarray(matrix.sum(axis=1)).reshape(-1)
+    assert np.all(abs(row_sums - op.row_sums()) < 1.0e-13)
+
+
+def _check_diagonal_and_row_sums(matrix, op):
+    assert np.all(abs(matrix.diagonal() - op.diagonal()) < 1.0e-13)
+    row_sums = np.asarray(matrix.sum(axis=1)).reshape(-1)
+    assert np.all(abs(row_sums - op.row_sums()) < 1.0e-13)
+    # upper bound of the l1 row norms
+    abs_row_sums = np.asarray(abs(matrix).sum(axis=1)).reshape(-1)
+    assert np.all(op.row_sums(absolute=True) > abs_row_sums - 1.0e-13)
+
+
+@pytest.mark.parametrize("lumped", [False, True])
+def test_jacobi(lumped):
+    mesh = helpers.get_rectangle_mesh(20, 10, width=2.0)
+    matrix, rhs = pyfvm.discretize_linear(Convection(), mesh)
+    op, _ = pyfvm.discretize_linear(Convection(), mesh, matrix_free=True)
+
+    M_op = pyfvm.get_jacobi_preconditioner(op, lumped=lumped)
+    if not lumped:
+        x = np.random.rand(len(mesh.points))
+        M = pyfvm.get_jacobi_preconditioner(matrix)
+        assert np.all(abs(M @ x - M_op @ x) < 1.0e-13)
+
+    u, info, _ = pyfvm.linear_solvers.krylov_solve("gmres", op, rhs, 1.0e-12, M=M_op)
+    assert info == 0
+    assert np.all(abs(matrix @ u - rhs) < 1.0e-8)
+
+
+@pytest.mark.parametrize("method", ["lu", "amg"])
+def test_mixed_precision(method):
+    mesh = helpers.get_rectangle_mesh(20, 10, width=2.0)
+    matrix, rhs = pyfvm.discretize_linear(Convection(), mesh)
+    matrix32, rhs32 = pyfvm.discretize_linear(Convection(), mesh, dtype=np.float32)
+    assert matrix32.dtype == np.float32
+    assert np.all(rhs == rhs32)
+
+    solver = pyfvm.MixedPrecisionSolver(method=method)
+    u, _ = solver(matrix, rhs, setup_matrix=matrix32)
+    assert np.linalg.norm(matrix @ u - rhs) < 1.0e-10 * np.linalg.norm(rhs)
+
+    # Newton with the Jacobian assembled in single precision only
+    f, jacobian = pyfvm.discretize(Bratu(), mesh)
+    u0 = np.zeros(len(mesh.points))
+    ref, _ = pyfvm.inexact_newton(f.eval, jacobian, u0)
+    solver = pyfvm.MixedPrecisionSolver(jacobian, method=method)
+    u = pyfvm.newton(f.eval, solver.jacobian_solver, u0, verbose=False)
+    assert np.all(np.abs(u - ref) < 1.0e-10)
+
+
+def test_single_precision_assembly():
+    mesh = helpers.get_rectangle_mesh(80, 40, width=2.0)
+    _, jacobian = pyfvm.discretize(Bratu(), mesh)
+    u = np.random.rand(len(mesh.points))
+    ref = jacobian.get_linear_operator(u)
+    jacobian.get_linear_operator(u, dtype=np.float32)
+
+    peaks = []
+    for dtype in [None, np.float32]:
+        tracemalloc.start()
+        matrix = jacobian.get_linear_operator(u, dtype=dtype)
+        peaks.append(tracemalloc.get_traced_memory()[1])
+        tracemalloc.stop()
+
+    assert matrix.dtype == np.float32
+    assert abs(matrix - ref).max() < 1.0e-6 * abs(ref).max()
+    # the kernels are evaluated and summed up in single precision
+    assert peaks[1] < 0.7 * peaks[0]
@@ -0,0 +1,61 @@
+import helpers
+import numpy as np
+import pytest
+
+import pyfvm
+from pyfvm.form_language import Boundary, dS, dV, integrate, n_dot_grad
+from pyfvm.linear_solvers import krylov_solve
+
+
+class Poisson:
+    def apply(self, u):
+        return integrate(lambda x: -n_dot_grad(u(x)), dS) - integrate(
+            lambda x: 1.0 + x[0], dV
+        )
+
+    def dirichlet(self, u):
+        return [(u, Boundary())]
+
+
+def test_mesh_independence():
+    num_iterations = []
+    for n in [32, 64, 128]:
+        mesh = helpers.get_rectangle_mesh(n)
+        matrix, rhs = pyfvm.discretize_linear(Poisson(), mesh)
+        M = pyfvm.AgglomerationMultigrid(matrix, mesh)
+        assert len(M.levels) > 1
+
+        u, info, k = krylov_solve("gmres", matrix, rhs, 1.0e-10, M=M)
+        assert info == 0
+        assert np.linalg.norm(matrix @ u - rhs) < 1.0e-10 * np.linalg.norm(rhs)
+        num_iterations.append(k)
+
+    assert num_iterations[-1] < 2 * num_iterations[0]
+
+
+@pytest.mark.parametrize("cycle", ["V", "W"])
+def test_matrix_free(cycle):
+    mesh = helpers.get_rectangle_mesh(32)
+    matrix, rhs = pyfvm.discretize_linear(Poisson(), mesh)
+    op, _ = pyfvm.discretize_linear(Poisson(), mesh, matrix_free=True)
+
+    # The coarse operators summed up from the kernels are the ones of the matrix.
+    M = pyfvm.AgglomerationMultigrid(matrix, mesh, cycle=cycle)
+    M_free = pyfvm.AgglomerationMultigrid(op, cycle=cycle)
+    for level, level_free in zip(M.levels[1:], M_free.levels[1:]):
+        assert abs(level.A - level_free.A).max() < 1.0e-12
+
+    b = np.random.rand(len(mesh.points))
+    assert np.all(np.abs(M @ b - M_free @ b) < 1.0e-12)
+
+
+def test_complex():
+    mesh = helpers.get_rectangle_mesh(32)
+    matrix, _ = pyfvm.discretize_linear(Poisson(), mesh)
+    M = pyfvm.AgglomerationMultigrid(matrix, mesh)
+
+    # the cycle is linear, so it acts on real and imaginary parts separately
+    n = len(mesh.points)
+    b0 = np.random.rand(n)
+    b1 = np.random.rand(n)
+    assert np.all(np.abs(M @ (b0 + 1j * b1) - (M @ b0 + 1j * (M @ b1))) < 1.0e-12)
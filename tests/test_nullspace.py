@@ -0,0 +1,69 @@
+import helpers
+import numpy as np
+import pyamg
+import pytest
+
+import pyfvm
+from pyfvm.form_language import dS, dV, integrate, n_dot_grad
+
+
+class Neumann:
+    def __init__(self, eps):
+        self.eps = eps
+
+    def apply(self, u):
+        return integrate(lambda x: -n_dot_grad(u(x)), dS) + integrate(
+            lambda x: self.eps * u(x) - x[0] ** 2 * x[1], dV
+        )
+
+
+def _amg(matrix):
+    return pyamg.smoothed_aggregation_solver(matrix.tocsr()).aspreconditioner()
+
+
+def test_singular():
+    num_iterations = []
+    for n in [20, 40, 80]:
+        mesh = helpers.get_rectangle_mesh(n)
+        matrix, rhs = pyfvm.discretize_linear(Neumann(0.0), mesh)
+
+        solver = pyfvm.DeflatedSolver(
+            pyfvm.constant_mode(mesh), method="cg", preconditioner=_amg
+        )
+        u, k = solver(matrix, rhs, 1.0e-10)
+        num_iterations.append(k)
+
+        # The consistent part of the right-hand side is solved for; the solution
+        # has zero mean.
+        rhs -= np.mean(rhs)
+        assert np.linalg.norm(matrix @ u - rhs) < 1.0e-9 * np.linalg.norm(rhs)
+        assert abs(np.mean(u)) < 1.0e-12
+
+    assert num_iterations[-1] < 2 * num_iterations[0]
+
+
+@pytest.mark.parametrize("preconditioner", [pyfvm.get_jacobi_preconditioner, _amg])
+def test_near_singular(preconditioner):
+    mesh = helpers.get_rectangle_mesh(20)
+    matrix, rhs = pyfvm.discretize_linear(Neumann(1.0e-4), mesh)
+
+    solver = pyfvm.DeflatedSolver(
+        pyfvm.constant_mode(mesh), preconditioner=preconditioner
+    )
+    u, _ = solver(matrix, rhs, 1.0e-10)
+    # The solution is large (~1/eps); compare with the rounding error level.
+    scale = np.linalg.norm(rhs) + abs(matrix).max() * np.linalg.norm(u)
+    assert np.linalg.norm(matrix @ u - rhs) < 1.0e-10 * scale
+
+
+def test_amg_candidates():
+    mesh = helpers.get_rectangle_mesh(20)
+    matrix, rhs = pyfvm.discretize_linear(Neumann(1.0e-4), mesh)
+
+    context = pyfvm.SolverContext(
+        method="amg", near_nullspace=pyfvm.constant_mode(mesh)
+    )
+    u, _ = context(matrix.tocsr(), rhs)
+    assert context.amg_options["B"].shape == (len(mesh.points), 1)
+    scale = np.linalg.norm(rhs) + abs(matrix).max() * np.linalg.norm(u)
+    assert np.linalg.norm(matrix @ u - rhs) < 1.0e-9 * scale
@@ -0,0 +1,49 @@
+import helpers
+import numpy as np
+from sympy import exp, pi, sin
+
+import pyfvm
+from pyfvm.form_language import Boundary, dS, dV, integrate, n_dot, n_dot_grad
+
+
+class Convection:
+    def apply(self, u):
+        a = np.array([2, 1])
+        return (
+            integrate(lambda x: -n_dot_grad(u(x)) + n_dot(a) * u(x), dS)
+            - integrate(lambda x: 1.0 + x[0], dV)
+            - integrate(lambda x: sin(pi * x[0]) * u(x), dV)
+        )
+
+    def dirichlet(self, u):
+        return [(lambda x: u(x) - x[1], Boundary())]
+
+
+class Bratu:
+    def apply(self, u):
+        return (
+            integrate(lambda x: -n_dot_grad(u(x)), dS)
+            - integrate(lambda x: 2.0 * exp(u(x)), dV)
+            - integrate(lambda x: sin(pi * x[0]), dV)
+        )
+
+    def dirichlet(self, u):
+        return [(u, Boundary())]
+
+
+def test_linear():
+    mesh = helpers.get_rectangle_mesh(10)
+    matrix, rhs = pyfvm.discretize_linear(Convection(), mesh)
+    matrix2, rhs2 = pyfvm.discretize_linear(Convection(), mesh, processes=2)
+    assert abs(matrix - matrix2).max() < 1.0e-13
+    assert np.all(abs(rhs - rhs2) < 1.0e-13)
+
+
+def test_nonlinear():
+    mesh = helpers.get_rectangle_mesh(10)
+    f, jac = pyfvm.discretize(Bratu(), mesh)
+    f2, jac2 = pyfvm.discretize(Bratu(), mesh, processes=2)
+
+    u = np.random.rand(len(mesh.points))
+    assert np.all(abs(f.eval(u) - f2.eval(u)) < 1.0e-13)
+    assert abs(jac.get_linear_operator(u) - jac2.get_linear_operator(u)).max() < 1.0e-13
@@ -135,6 +135,65 @@ def test(problem, max_k):
     assert order_inf[-1] > expected_order - tol
 
 
+class AllenCahn:
+    def apply(self, u):
+        return integrate(lambda x: -n_dot_grad(u(x)), dS) + integrate(
+            lambda x: 100.0 * (u(x) ** 3 - u(x)) - 1.0, dV
+        )
+
+    def dirichlet(self, u):
+        return [(lambda x: u(x) - 1.0, Boundary())]
+
+
+@pytest.mark.parametrize("linear_solver", ["direct", "context"])
+def test_pseudo_transient(linear_solver):
+    if linear_solver == "context":
+        linear_solver = pyfvm.SolverContext()
+
+    vertices, cells = meshzoo.rectangle_tri(
+        np.linspace(0.0, 1.0, 41), np.linspace(0.0, 1.0, 41)
+    )
+    mesh = meshplex.Mesh(vertices, cells)
+    f, jacobian = pyfvm.discretize(AllenCahn(), mesh)
+
+    ref, _ = pyfvm.inexact_newton(f.eval, jacobian, np.ones(len(vertices)))
+
+    # poor initial guess
+    x = vertices.T
+    u0 = 10.0 * np.cos(13 * x[0]) * np.sin(17 * x[1])
+    u, report = pyfvm.pseudo_transient(
+        f.eval, jacobian, u0, linear_solver=linear_solver
+    )
+    assert report.converged
+    assert report.iterations[-1]["dt"] > report.iterations[0]["dt"]
+    assert np.all(np.abs(u - ref) < 1.0e-10)
+
+
+def test_pseudo_transient_matrix_free():
+    mesh = helpers.get_rectangle_mesh(20)
+    f, jacobian = pyfvm.discretize(AllenCahn(), mesh)
+    n = len(mesh.points)
+    ref, _ = pyfvm.inexact_newton(f.eval, jacobian, np.ones(n))
+
+    mass = mesh.control_volumes.copy()
+    mass[mesh.is_boundary_point] = 0.0
+
+    x = mesh.points.T
+    u0 = 10.0 * np.cos(13 * x[0]) * np.sin(17 * x[1])
+    u, report = pyfvm.pseudo_transient(
+        f.eval,
+        lambda u: jacobian.get_linear_operator(u, matrix_free=True),
+        u0,
+        mass=mass,
+        linear_solver="gmres",
+    )
+    assert report.converged
+    assert np.all(np.abs(u - ref) < 1.0e-10)
+
+    with pytest.raises(ValueError, match="mass"):
+        pyfvm.pseudo_transient(f.eval, jacobian.get_linear_operator, u0)
+
+
 if __name__ == "__main__":
     # problem = Square()
     problem = Disk()
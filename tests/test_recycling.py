@@ -0,0 +1,96 @@
+import helpers
+import numpy as np
+import pytest
+import sympy
+
+import pyfvm
+from pyfvm.form_language import Boundary, dS, dV, integrate, n_dot, n_dot_grad
+
+
+class Convection:
+    def apply(self, u, lmbda):
+        a = sympy.Matrix([2, 1])
+        return integrate(
+            lambda x: -n_dot_grad(u(x)) + lmbda * n_dot(a) * u(x), dS
+        ) - integrate(lambda x: 1.0, dV)
+
+    def dirichlet(self, u):
+        return [(lambda x: u(x), Boundary())]
+
+
+def test_newton():
+    mesh = helpers.get_rectangle_mesh(30)
+    f, jacobian = pyfvm.discretize(helpers.Bratu(), mesh)
+    u0 = np.zeros(len(mesh.points))
+
+    ref, report_gmres = pyfvm.inexact_newton(
+        f.eval, jacobian, u0, linear_solver="gmres", forcing=1.0e-8
+    )
+    u, report = pyfvm.inexact_newton(
+        f.eval, jacobian, u0, linear_solver="gcrodr", forcing=1.0e-8
+    )
+    assert report.converged
+    assert np.all(np.abs(u - ref) < 1.0e-8)
+    assert report.num_linear_iterations < report_gmres.num_linear_iterations
+
+
+@pytest.mark.parametrize("preconditioner", [None, pyfvm.get_jacobi_preconditioner])
+def test_same_matrix(preconditioner):
+    mesh = helpers.get_rectangle_mesh(30)
+    _, jacobian = pyfvm.discretize(helpers.Bratu(), mesh)
+    matrix = jacobian.get_linear_operator(np.zeros(len(mesh.points)))
+
+    solver = pyfvm.RecyclingGmres(preconditioner=preconditioner)
+    num_iterations = []
+    for _ in range(3):
+        b = np.random.rand(len(mesh.points))
+        x, k = solver(matrix, b, 1.0e-10)
+        assert np.linalg.norm(matrix @ x - b) < 1.0e-10 * np.linalg.norm(b)
+        num_iterations.append(k)
+
+    # the recycled space pays off for the following systems
+    assert num_iterations[1] < num_iterations[0]
+    assert num_iterations[2] < num_iterations[0]
+
+
+def test_solver_context():
+    mesh = helpers.get_rectangle_mesh(30)
+    f, jacobian = pyfvm.discretize(helpers.Bratu(), mesh)
+    u0 = np.zeros(len(mesh.points))
+    ref, _ = pyfvm.inexact_newton(f.eval, jacobian, u0)
+
+    context = pyfvm.SolverContext(jacobian, method="amg", krylov_method="gcrodr")
+    u = pyfvm.newton(f.eval, context.jacobian_solver, u0, verbose=False)
+    assert np.all(np.abs(u - ref) < 1.0e-8)
+
+
+def test_nonsymmetric_sequence():
+    # convection-diffusion with a slowly changing convection coefficient
+    mesh = helpers.get_rectangle_mesh(30)
+    solver = pyfvm.RecyclingGmres()
+    num_iterations = []
+    for c in [1.0, 1.1, 1.2]:
+        matrix, rhs = pyfvm.discretize_linear(Convection(), mesh, lmbda=c)
+        x, k = solver(matrix, rhs, 1.0e-10)
+        assert np.linalg.norm(matrix @ x - rhs) < 1.0e-10 * np.linalg.norm(rhs)
+        num_iterations.append(k)
+
+    assert num_iterations[1] < num_iterations[0]
+    assert num_iterations[2] < num_iterations[0]
+
+
+def test_harmonic_ritz_vectors():
+    # nonnormal matrix with three isolated small eigenvalues; their eigenvectors
+    # must be in the recycled space after one solve
+    rng = np.random.default_rng(0)
+    n = 200
+    eigenvalues = np.concatenate([[1.0e-2, 2.0e-2, 3.0e-2], 1.0 + rng.random(n - 3)])
+    S = np.eye(n) + 0.3 * rng.standard_normal((n, n)) / np.sqrt(n)
+    A = S @ np.diag(eigenvalues) @ np.linalg.inv(S)
+
+    solver = pyfvm.RecyclingGmres()
+    solver(A, rng.random(n), 1.0e-10)
+
+    Q, _ = np.linalg.qr(solver.U)
+    E = S[:, :3] / np.linalg.norm(S[:, :3], axis=0)
+    assert np.all(np.linalg.norm(E - Q @ (Q.T @ E), axis=0) < 1.0e-8)
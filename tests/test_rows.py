@@ -0,0 +1,52 @@
+import helpers
+import numpy as np
+
+import pyfvm
+
+
+def test_rows():
+    mesh = helpers.get_rectangle_mesh(20)
+    f, jacobian = pyfvm.discretize(helpers.Bratu(), mesh)
+    n = len(mesh.points)
+    u = np.random.rand(n)
+
+    # interior and boundary vertices, in no particular order
+    vertices = np.random.choice(n, 50, replace=False)
+    res = f.eval_rows(u, vertices)
+    assert np.all(np.abs(res - f.eval(u)[vertices]) < 1.0e-12)
+    # the cached restriction is used the second time
+    assert np.all(f.eval_rows(u, vertices) == res)
+
+    rows = jacobian.get_rows(u, vertices)
+    ref = jacobian.get_linear_operator(u)[vertices]
+    assert rows.shape == (50, n)
+    assert abs(rows - ref).max() < 1.0e-12
+
+
+def test_batch():
+    mesh = helpers.get_rectangle_mesh(20)
+    f, _ = pyfvm.discretize(helpers.Bratu(), mesh)
+    n = len(mesh.points)
+    u = np.random.rand(3, n)
+
+    vertices = np.arange(0, n, 7)
+    assert np.all(np.abs(f.eval_rows(u, vertices) - f.eval(u)[:, vertices]) < 1.0e-12)
+
+
+def test_incremental():
+    mesh = helpers.get_rectangle_mesh(20)
+    _, jacobian = pyfvm.discretize(helpers.Bratu(), mesh)
+    n = len(mesh.points)
+    u = np.random.rand(n)
+    jacobian.get_linear_operator(u, incremental=True)
+
+    for _ in range(3):
+        # change u in a small region, which includes boundary vertices
+        center = np.random.rand(2)
+        is_active = np.linalg.norm(mesh.points[:, :2] - center, axis=1) < 0.2
+        u = u.copy()
+        u[is_active] += np.random.rand(np.sum(is_active))
+
+        matrix = jacobian.get_linear_operator(u, incremental=True)
+        ref = jacobian.get_linear_operator(u)
+        assert abs(matrix - ref).max() < 1.0e-12
@@ -0,0 +1,81 @@
+import helpers
+import numpy as np
+import pytest
+from scipy import sparse
+
+import pyfvm
+from pyfvm.form_language import Boundary, dS, dV, integrate, n_dot_grad
+from pyfvm.linear_solvers import krylov_solve
+
+
+class Poisson:
+    def apply(self, u):
+        return integrate(lambda x: -n_dot_grad(u(x)), dS) - integrate(
+            lambda x: 1.0 + x[0], dV
+        )
+
+    def dirichlet(self, u):
+        return [(u, Boundary())]
+
+
+@pytest.mark.parametrize("restricted", [False, True])
+def test_processes(restricted):
+    mesh = helpers.get_rectangle_mesh(32)
+    matrix, rhs = pyfvm.discretize_linear(Poisson(), mesh)
+    op, _ = pyfvm.discretize_linear(Poisson(), mesh, matrix_free=True)
+
+    M = pyfvm.SchwarzPreconditioner(matrix, mesh, restricted=restricted)
+    # subdomain matrices from the kernels, factored in worker processes
+    M_pool = pyfvm.SchwarzPreconditioner(op, restricted=restricted, processes=2)
+
+    b = np.random.rand(len(mesh.points))
+    assert np.all(np.abs(M @ b - M_pool @ b) < 1.0e-12)
+
+    u, info, _ = krylov_solve("gmres", matrix, rhs, 1.0e-10, M=M_pool)
+    assert info == 0
+    assert np.linalg.norm(matrix @ u - rhs) < 1.0e-10 * np.linalg.norm(rhs)
+    M_pool.close()
+
+
+def test_submatrix():
+    mesh = helpers.get_rectangle_mesh(16)
+    matrix, _ = pyfvm.discretize_linear(Poisson(), mesh)
+    op, _ = pyfvm.discretize_linear(Poisson(), mesh, matrix_free=True)
+    matrix = sparse.csr_matrix(matrix)
+
+    idx = np.flatnonzero(mesh.points[:, 0] < 0.4)
+    ref = matrix[idx][:, idx].toarray()
+    assert np.all(np.abs(op.get_submatrix(idx).toarray() - ref) < 1.0e-12)
+
+
+def test_worker_error():
+    mesh = helpers.get_rectangle_mesh(8)
+    n = len(mesh.points)
+    # singular subdomain matrices; the error is passed on from the workers
+    with pytest.raises(RuntimeError, match="singular"):
+        pyfvm.SchwarzPreconditioner(sparse.csr_matrix((n, n)), mesh, processes=2)
+
+
+def test_coarse_space():
+    mesh = helpers.get_rectangle_mesh(64)
+    matrix, rhs = pyfvm.discretize_linear(Poisson(), mesh)
+
+    num_iterations = []
+    for coarse_space in [False, True]:
+        M = pyfvm.SchwarzPreconditioner(
+            matrix, mesh, num_subdomains=16, coarse_space=coarse_space
+        )
+        u, info, k = krylov_solve("gmres", matrix, rhs, 1.0e-10, M=M)
+        assert info == 0
+        assert np.linalg.norm(matrix @ u - rhs) < 1.0e-10 * np.linalg.norm(rhs)
+        num_iterations.append(k)
+
+    assert num_iterations[1] < num_iterations[0]
+
+
+def test_partition():
+    points = np.random.rand(1000, 2)
+    parts = pyfvm.schwarz.partition(points, 6)
+    sizes = np.bincount(parts)
+    assert len(sizes) == 6
+    assert np.max(sizes) - np.min(sizes) <= 1
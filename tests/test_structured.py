@@ -0,0 +1,84 @@
+import helpers
+import numpy as np
+import pytest
+from sympy import exp
+
+import pyfvm
+from pyfvm.form_language import Boundary, dS, dV, integrate, n_dot, n_dot_grad
+
+
+class Convection:
+    def apply(self, u):
+        a = np.array([2, 1])
+        return integrate(lambda x: -n_dot_grad(u(x)) + n_dot(a) * u(x), dS) - integrate(
+            lambda x: 1.0 + x[0], dV
+        )
+
+    def dirichlet(self, u):
+        return [(lambda x: u(x) - x[1], Boundary())]
+
+
+class Bratu:
+    def apply(self, u):
+        return integrate(lambda x: -n_dot_grad(u(x)), dS) - integrate(
+            lambda x: 2.0 * exp(u(x)), dV
+        )
+
+    def dirichlet(self, u):
+        return [(u, Boundary())]
+
+
+def test_linear():
+    mesh = helpers.get_rectangle_mesh(20, 10, width=2.0)
+    assert pyfvm.structured.get_stencil(mesh) is not None
+
+    matrix, rhs = pyfvm.discretize_linear(Convection(), mesh)
+    dia, dia_rhs = pyfvm.discretize_linear(Convection(), mesh, structured=True)
+
+    assert dia.format == "dia"
+    assert abs(matrix - dia).max() < 1.0e-13
+    assert np.all(abs(rhs - dia_rhs) < 1.0e-13)
+
+
+def test_nonlinear():
+    mesh = helpers.get_rectangle_mesh(20, 10, width=2.0)
+
+    f, jac = pyfvm.discretize(Bratu(), mesh)
+    f_dia, jac_dia = pyfvm.discretize(Bratu(), mesh, structured="auto")
+
+    u = np.random.rand(len(mesh.points))
+    assert np.all(abs(f.eval(u) - f_dia.eval(u)) < 1.0e-13)
+
+    matrix = jac_dia.get_linear_operator(u)
+    assert matrix.format == "dia"
+    assert abs(jac.get_linear_operator(u) - matrix).max() < 1.0e-13
+
+
+def test_unstructured():
+    mesh = helpers.get_rectangle_mesh(20, 10, width=2.0, permute=True)
+
+    assert pyfvm.structured.get_stencil(mesh) is None
+    with pytest.raises(ValueError):
+        pyfvm.discretize_linear(Convection(), mesh, structured=True)
+
+
+@pytest.mark.parametrize("shuffle", [False, True])
+def test_scatter(shuffle):
+    mesh = helpers.get_rectangle_mesh(20, 10, width=2.0)
+    nec = mesh.idx[-1]
+    if shuffle:
+        # irregular cell order, so the groups are kept as index arrays
+        nec = nec[..., np.random.permutation(nec.shape[-1])]
+    n = len(mesh.points)
+    stencil = pyfvm.structured.Stencil(nec, n)
+    is_block = [isinstance(g[1], pyfvm.structured._Block) for g in stencil.groups]
+    assert all(is_block) != shuffle
+
+    # a batch of two sets of edge values
+    vals = np.random.rand(2, 2, *nec.shape[1:])
+    ref = np.zeros((2, n))
+    for k in range(2):
+        np.add.at(ref[k], nec, vals[k])
+
+    out = stencil.scatter(np.zeros((2, n)), vals)
+    assert np.all(abs(out - ref) < 1.0e-13)
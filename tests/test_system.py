@@ -0,0 +1,75 @@
+import helpers
+import numpy as np
+from scipy import sparse
+
+import pyfvm
+from pyfvm.form_language import Boundary, dS, dV, integrate, n_dot_grad
+
+
+class Coupled:
+    """-Delta u + u v = 1, -div((1 + u^2) grad v) + v - u = 0"""
+
+    def apply(self, fields):
+        u, v = fields
+        return [
+            integrate(lambda x: -n_dot_grad(u(x)), dS)
+            + integrate(lambda x: u(x) * v(x) - 1.0, dV),
+            integrate(lambda x: -(1.0 + u(x) ** 2) * n_dot_grad(v(x)), dS)
+            + integrate(lambda x: v(x) - u(x), dV),
+        ]
+
+    def dirichlet(self, fields):
+        u, v = fields
+        return [
+            (lambda x: u(x) - 1.0, Boundary(), 0),
+            (lambda x: v(x) - x[0], Boundary(), 1),
+        ]
+
+
+def test_jacobian():
+    mesh = helpers.get_rectangle_mesh(5)
+    problem, jacobian = pyfvm.discretize_system(Coupled(), mesh, 2)
+
+    u = np.random.default_rng(0).random(2 * len(mesh.points))
+    J = jacobian.get_linear_operator(u)
+    assert isinstance(J, sparse.bsr_matrix)
+    assert J.blocksize == (2, 2)
+
+    # central differences
+    h = 1.0e-6
+    ref = np.empty((len(u), len(u)))
+    for j in range(len(u)):
+        e = np.zeros(len(u))
+        e[j] = h
+        ref[:, j] = (problem.eval(u + e) - problem.eval(u - e)) / (2 * h)
+    assert np.max(np.abs(J.toarray() - ref)) < 1.0e-7
+
+
+def test_newton():
+    mesh = helpers.get_rectangle_mesh(20)
+    problem, jacobian = pyfvm.discretize_system(Coupled(), mesh, 2)
+
+    u0 = np.zeros(2 * len(mesh.points))
+    u, report = pyfvm.inexact_newton(problem.eval, jacobian, u0, tol=1.0e-10)
+    assert report.converged
+
+    # the boundary values of the interleaved fields
+    is_boundary = (mesh.points[:, 0] % 1.0 == 0.0) | (mesh.points[:, 1] % 1.0 == 0.0)
+    U = u.reshape(-1, 2)
+    assert np.all(np.abs(U[is_boundary, 0] - 1.0) < 1.0e-10)
+    assert np.all(np.abs(U[is_boundary, 1] - mesh.points[is_boundary, 0]) < 1.0e-10)
+
+    # block Jacobi
+    def linear_solver(matrix, rhs, rtol):
+        M = pyfvm.get_block_jacobi_preconditioner(matrix)
+        x, info, num_iterations = pyfvm.linear_solvers.krylov_solve(
+            "gmres", matrix, rhs, rtol, M=M
+        )
+        assert info == 0
+        return x, num_iterations
+
+    u2, report = pyfvm.inexact_newton(
+        problem.eval, jacobian, u0, tol=1.0e-10, linear_solver=linear_solver
+    )
+    assert report.converged
+    assert np.max(np.abs(u - u2)) < 1.0e-8
@@ -0,0 +1,63 @@
+import helpers
+import numpy as np
+import pytest
+from sympy import I, exp, pi
+
+import pyfvm
+from pyfvm.form_language import Boundary, dS, dV, integrate, n_dot_grad
+
+
+class GinzburgLandau:
+    """-Delta psi + (V + g |psi|^2) psi = 0 without magnetic field"""
+
+    def apply(self, psi):
+        return integrate(lambda x: -n_dot_grad(psi(x)), dS) + integrate(
+            lambda x: (-1.0 + abs(psi(x)) ** 2) * psi(x), dV
+        )
+
+    def dirichlet(self, psi):
+        return [(lambda x: psi(x) - exp(I * pi * x[0]), Boundary())]
+
+
+def test_jacobian():
+    mesh = helpers.get_rectangle_mesh(20)
+    problem, jacobian = pyfvm.discretize(GinzburgLandau(), mesh)
+
+    n = len(mesh.points)
+    rng = np.random.default_rng(0)
+    psi = rng.random(n) + 1j * rng.random(n)
+
+    J = jacobian.get_linear_operator(psi)
+    assert isinstance(J, pyfvm.WirtingerOperator)
+
+    A, B = pyfvm.FiniteDifferenceJacobian(problem.eval, mesh).get_wirtinger_matrices(
+        psi
+    )
+    assert abs(J.A - A).max() < 1.0e-6
+    assert abs(J.B - B).max() < 1.0e-6
+
+    # the real form
+    phi = rng.random(n) + 1j * rng.random(n)
+    x = np.concatenate([phi.real, phi.imag])
+    y = J @ phi
+    ref = np.concatenate([y.real, y.imag])
+    assert np.all(np.abs(J.get_real_matrix() @ x - ref) < 1.0e-12)
+    assert np.all(np.abs(J.get_real_operator() @ x - ref) < 1.0e-12)
+
+
+@pytest.mark.parametrize("linear_solver", ["direct", "gmres"])
+def test_newton(linear_solver):
+    mesh = helpers.get_rectangle_mesh(20)
+    problem, jacobian = pyfvm.discretize(GinzburgLandau(), mesh)
+
+    psi0 = np.ones(len(mesh.points), dtype=complex)
+    psi, report = pyfvm.inexact_newton(
+        problem.eval,
+        jacobian,
+        psi0,
+        tol=1.0e-10,
+        linear_solver=linear_solver,
+        forcing=1.0e-12,
+    )
+    assert report.converged
+    assert report.num_iterations <= 8